@@ -41,6 +41,37 @@ GOCARDLESS_ACCESS_TOKEN = ""
 GOCARDLESS_ENVIRONMENT = "sandbox"
 GOCARDLESS_WEBHOOK_SECRET = ""
 
+# POSTCODES
+# offline postcode index used to geocode spaces, built with build_postcode_index
+POSTCODE_INDEX_PATH = os.path.join(BASE_DIR, 'postcodes.idx')
+
+# LOGOS
+# where space logo thumbnails are stored, and the function used to fetch logos
+LOGO_ROOT = os.path.join(BASE_DIR, 'logos')
+LOGO_FETCHER = 'main.logos.fetch_logo'
+
+# GITHUB
+# how long (in seconds) pages fetched for the resources/foundation browser are fresh, how
+# long a stale copy may be served after that, and the function used to fetch them
+GITHUB_CACHE_TTL = 300
+GITHUB_CACHE_STALE = 60 * 60 * 24 * 7
+GITHUB_FETCHER = 'main.github.fetch_page'
+
+# DOCS
+# local mirror of the resources and foundation repos, kept up to date by sync_docs. pages
+# are served from here once it has been synced, and fetched from GitHub until then
+DOCS_MIRROR_ROOT = os.path.join(BASE_DIR, 'docs_mirror')
+DOCS_UPSTREAM = 'https://github.com/UKHackspaceFoundation/{repo}/archive/refs/heads/master.tar.gz'
+# serve other files in the repos (pdfs, images...) ourselves, from the mirror or a disk cache
+# of them, rather than redirecting to GitHub
+DOCS_PROXY_FILES = False
+DOCS_FILE_CACHE_ROOT = os.path.join(BASE_DIR, 'cache', 'files')
+# the oldest files are removed from the disk cache once it's bigger than this
+DOCS_FILE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+GITHUB_FILE_FETCHER = 'main.github.fetch_file'
+# full text index of the pages in the repos, for /resources/search
+DOCS_SEARCH_INDEX = os.path.join(BASE_DIR, 'docs_search.sqlite3')
+
 
 # Application definition
 
@@ -100,6 +131,41 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# Cached space data is invalidated by a version counter held in the cache, so the
+# cache must be shared by all worker processes - hence file based, not local memory
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+        },
+    },
+    # pages fetched from github, kept along with their validators after they go stale so
+    # they can be revalidated with a conditional request
+    'github': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'github'),
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+        },
+    },
+    # map vector tiles - there can be far more of them than anything else, so they're kept
+    # apart where they can't evict the space data version or the documents
+    'tiles': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'tiles'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
 
@@ -1,9 +1,12 @@
 from django.contrib import admin
 
-from .models import User, Space, SupporterMembership, GocardlessMandate, GocardlessPayment
+from .models import (User, Space, SupporterMembership, GocardlessMandate, GocardlessPayment,
+                     GocardlessWebhookEvent, SupporterRenewal)
 
 admin.site.register(User)
 admin.site.register(Space)
 admin.site.register(SupporterMembership)
 admin.site.register(GocardlessMandate)
 admin.site.register(GocardlessPayment)
+admin.site.register(GocardlessWebhookEvent)
+admin.site.register(SupporterRenewal)
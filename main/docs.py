@@ -0,0 +1,252 @@
+from collections import OrderedDict
+from django.conf import settings
+import hashlib
+import html
+import logging
+import markdown
+import os
+import requests
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+
+# get instance of a logger
+logger = logging.getLogger(__name__)
+
+# Local mirror of the resources and foundation repositories, so the markdown browser
+# can read pages from disk instead of GitHub. `manage.py sync_docs` copies each repo
+# from DOCS_UPSTREAM - a tarball url or path, a (bare) git repository, or a plain
+# directory - into a new snapshot under DOCS_MIRROR_ROOT/<repo>/, then switches the
+# <repo>/current symlink over to it, so readers never see a half updated mirror.
+
+DOCS_REPOSITORIES = ('resources', 'foundation')
+
+FETCH_TIMEOUT = (5, 60)
+
+CURRENT = 'current'
+
+# file in each snapshot recording what it was made from
+VERSION_FILE = '.mirror-version'
+
+# how many rendered pages to keep in memory
+RENDER_CACHE_SIZE = 256
+
+# headings included in a page's table of contents
+TOC_DEPTH = 4
+
+
+class SyncError(Exception):
+    pass
+
+
+def mirror_root():
+    return getattr(settings, "DOCS_MIRROR_ROOT", None)
+
+
+def upstream(repo):
+    return getattr(settings, "DOCS_UPSTREAM", "").format(repo=repo)
+
+
+def current_path(repo):
+    return os.path.join(mirror_root(), repo, CURRENT)
+
+
+# is there a local mirror of this repo to serve from?
+def is_mirrored(repo):
+    return bool(mirror_root()) and os.path.isdir(current_path(repo))
+
+
+# the version of the current snapshot of a repo, or None
+def mirror_version(repo):
+    try:
+        with open(os.path.join(current_path(repo), VERSION_FILE)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+# get the path of a file in the current snapshot of a repo, or None if it isn't there
+def mirror_file(repo, path):
+    root = os.path.realpath(current_path(repo))
+    full_path = os.path.realpath(os.path.join(root, path))
+    # don't follow .. or symlinks out of the mirror
+    if not full_path.startswith(root + os.sep) or not os.path.isfile(full_path):
+        return None
+    return full_path
+
+
+# read a page from the current snapshot of a repo, or None if it isn't there
+def mirror_page(repo, path):
+    full_path = mirror_file(repo, path)
+    if full_path is None:
+        return None
+    with open(full_path, encoding='utf-8', errors='replace') as f:
+        return f.read()
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(64 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+# extract a tarball (e.g. a github archive) into dest, dropping the top level directory
+# and anything that isn't a plain file or directory or would land outside dest
+def extract_tarball(tar, dest):
+    for member in tar:
+        parts = [part for part in member.name.split('/')[1:] if part not in ('', '.')]
+        if not parts or '..' in parts or member.name.startswith('/'):
+            continue
+        path = os.path.join(dest, *parts)
+        if member.isdir():
+            os.makedirs(path, exist_ok=True)
+        elif member.isfile():
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tar.extractfile(member) as src, open(path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+
+
+# the git directory of a bare repository or a checkout, or None if path isn't either
+def git_dir(path):
+    if os.path.isdir(os.path.join(path, '.git')):
+        return os.path.join(path, '.git')
+    if os.path.isfile(os.path.join(path, 'HEAD')) and os.path.isdir(os.path.join(path, 'objects')):
+        return path
+    return None
+
+
+# copy the upstream of a repo into dest, given the version of the current snapshot.
+# returns the new version, or None if the upstream hasn't changed
+def fetch_upstream(source, dest, current_version):
+    if source.startswith(('http://', 'https://')):
+        with tempfile.TemporaryFile() as f:
+            with requests.get(source, timeout=FETCH_TIMEOUT, stream=True) as r:
+                r.raise_for_status()
+                sha = hashlib.sha256()
+                for block in r.iter_content(64 * 1024):
+                    sha.update(block)
+                    f.write(block)
+            version = 'sha256:' + sha.hexdigest()
+            if version == current_version:
+                return None
+            f.seek(0)
+            with tarfile.open(fileobj=f, mode='r:*') as tar:
+                extract_tarball(tar, dest)
+        return version
+
+    if os.path.isfile(source):
+        version = 'sha256:' + file_sha256(source)
+        if version != current_version:
+            with tarfile.open(source, mode='r:*') as tar:
+                extract_tarball(tar, dest)
+            return version
+        return None
+
+    if os.path.isdir(source) and git_dir(source):
+        git = ['git', '--git-dir', git_dir(source)]
+        commit = subprocess.run(git + ['rev-parse', 'HEAD'], check=True, capture_output=True,
+                                text=True).stdout.strip()
+        version = 'git:' + commit
+        if version == current_version:
+            return None
+        archive = subprocess.run(git + ['archive', '--format=tar', '--prefix=repo/', commit],
+                                 check=True, capture_output=True).stdout
+        with tempfile.TemporaryFile() as f:
+            f.write(archive)
+            f.seek(0)
+            with tarfile.open(fileobj=f) as tar:
+                extract_tarball(tar, dest)
+        return version
+
+    if os.path.isdir(source):
+        # a plain directory can't cheaply tell us if it has changed, so it's always copied
+        shutil.copytree(source, dest, dirs_exist_ok=True, ignore=shutil.ignore_patterns('.git'))
+        return 'dir:{}'.format(time.time())
+
+    raise SyncError("Unknown upstream {}".format(source))
+
+
+# bring the mirror of a repo up to date, returns True if it changed
+def sync_repo(repo, source=None):
+    source = source or upstream(repo)
+    repo_root = os.path.join(mirror_root(), repo)
+    os.makedirs(repo_root, exist_ok=True)
+
+    snapshot = tempfile.mkdtemp(prefix='snapshot-', dir=repo_root)
+    try:
+        version = fetch_upstream(source, snapshot, mirror_version(repo))
+    except (OSError, requests.RequestException, subprocess.CalledProcessError, tarfile.TarError) as e:
+        shutil.rmtree(snapshot, ignore_errors=True)
+        raise SyncError("Unable to sync {} from {}: {}".format(repo, source, e))
+    if version is None:
+        shutil.rmtree(snapshot)
+        return False
+
+    with open(os.path.join(snapshot, VERSION_FILE), 'w') as f:
+        f.write(version)
+    os.chmod(snapshot, 0o755)
+
+    # atomically point current at the new snapshot, then tidy up the old ones - apart
+    # from the previous one, which requests may still be reading from
+    current = os.path.join(repo_root, CURRENT)
+    keep = {os.path.basename(snapshot)}
+    if os.path.islink(current):
+        keep.add(os.readlink(current))
+    link = current + '.tmp'
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(snapshot), link)
+    os.replace(link, current)
+    for name in os.listdir(repo_root):
+        if name.startswith('snapshot-') and name not in keep:
+            shutil.rmtree(os.path.join(repo_root, name), ignore_errors=True)
+    logger.info("Mirrored %s from %s (%s)", repo, source, version)
+    return True
+
+
+# rendered pages, keyed by a hash of their path and source, least recently used first
+rendered_pages = OrderedDict()
+rendered_pages_lock = threading.Lock()
+
+
+# flatten markdown's nested table of contents into a list of {level, id, name}
+def flatten_toc(tokens):
+    toc = []
+    for token in tokens:
+        toc.append({'level': token['level'], 'id': token['id'], 'name': html.unescape(token['name'])})
+        toc.extend(flatten_toc(token['children']))
+    return toc
+
+
+# render a markdown page, returns a dict of its html, table of contents and breadcrumbs.
+# pages are only parsed again when their source changes
+def render_page(path, text):
+    key = hashlib.sha256('{}\0{}'.format(path, text).encode('utf-8')).digest()
+    with rendered_pages_lock:
+        if key in rendered_pages:
+            rendered_pages.move_to_end(key)
+            return rendered_pages[key]
+
+    md = markdown.Markdown(extensions=['toc'], extension_configs={'toc': {'toc_depth': TOC_DEPTH}})
+    breadcrumbs = []
+    url = ''
+    for slug in path.split('/'):
+        if slug != '':
+            url = '%s/%s' % (url, slug)
+            breadcrumbs.append({'slug': slug, 'url': url})
+    page = {
+        'html': md.convert(text),
+        'toc': flatten_toc(md.toc_tokens),
+        'breadcrumbs': breadcrumbs,
+    }
+
+    with rendered_pages_lock:
+        rendered_pages[key] = page
+        while len(rendered_pages) > RENDER_CACHE_SIZE:
+            rendered_pages.popitem(last=False)
+    return page
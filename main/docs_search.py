@@ -0,0 +1,161 @@
+from contextlib import contextmanager
+from django.conf import settings
+from django.utils.html import escape, strip_tags
+import hashlib
+import html
+import logging
+import markdown
+import os
+import re
+import sqlite3
+
+# get instance of a logger
+logger = logging.getLogger(__name__)
+
+# Full text search over the markdown pages in the resources and foundation repos. The
+# index is an FTS5 table in its own SQLite file (DOCS_SEARCH_INDEX), whatever database
+# the site itself uses. Repos are indexed by sync_docs after each sync, and pages fetched
+# live from GitHub are indexed as they're fetched. Each page's content hash is stored, so
+# only new or changed pages are parsed and indexed again.
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, repo TEXT NOT NULL, path TEXT NOT NULL, "
+    "hash TEXT NOT NULL, UNIQUE (repo, path))",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS pages USING fts5(title, body, tokenize='porter unicode61')",
+]
+
+TERM_RE = re.compile(r'\w+')
+HEADING_RE = re.compile(r'^#\s+(.+?)\s*#*\s*$', re.MULTILINE)
+
+# ignore anything past this many words
+MAX_SEARCH_TERMS = 10
+
+# bm25 column weights - title, body
+WEIGHTS = (10.0, 1.0)
+
+# snippets are marked up with these, then escaped and turned into <mark>s
+SNIPPET_START, SNIPPET_END = '\x02', '\x03'
+SNIPPET_WORDS = 24
+
+
+def index_path():
+    return getattr(settings, "DOCS_SEARCH_INDEX", None)
+
+
+# open the index, committing any changes made with it on success
+@contextmanager
+def open_index():
+    connection = sqlite3.connect(index_path(), timeout=10)
+    try:
+        with connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            for statement in SCHEMA:
+                connection.execute(statement)
+            yield connection
+    finally:
+        connection.close()
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+# the title and plain text of a markdown page
+def page_text(path, text):
+    match = HEADING_RE.search(text)
+    title = match.group(1) if match else os.path.basename(path)
+    return title, html.unescape(strip_tags(markdown.markdown(text)))
+
+
+# add or update pages in the index, given (path, text) pairs for a repo. pages whose
+# hash hasn't changed are skipped. returns how many were indexed
+def index_pages(connection, repo, pages):
+    stored = dict(connection.execute("SELECT path, hash FROM files WHERE repo = ?", [repo]))
+    count = 0
+    for path, text in pages:
+        digest = content_hash(text)
+        if stored.get(path) == digest:
+            continue
+        title, body = page_text(path, text)
+        row = connection.execute("SELECT id FROM files WHERE repo = ? AND path = ?", [repo, path]).fetchone()
+        if row is None:
+            file_id = connection.execute("INSERT INTO files (repo, path, hash) VALUES (?, ?, ?)",
+                                         [repo, path, digest]).lastrowid
+        else:
+            file_id = row[0]
+            connection.execute("UPDATE files SET hash = ? WHERE id = ?", [digest, file_id])
+            connection.execute("DELETE FROM pages WHERE rowid = ?", [file_id])
+        connection.execute("INSERT INTO pages (rowid, title, body) VALUES (?, ?, ?)", [file_id, title, body])
+        count += 1
+    return count
+
+
+# index a single page (e.g. one just fetched from github)
+def index_page(repo, path, text):
+    if not index_path():
+        return
+    try:
+        with open_index() as connection:
+            index_pages(connection, repo, [(path, text)])
+    except sqlite3.Error as e:
+        logger.warning("Unable to index %s/%s: %s", repo, path, e)
+
+
+# yield (path, text) for the markdown files in a directory
+def markdown_files(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+        for filename in filenames:
+            if filename.endswith('.md'):
+                full_path = os.path.join(dirpath, filename)
+                with open(full_path, encoding='utf-8', errors='replace') as f:
+                    yield os.path.relpath(full_path, root).replace(os.sep, '/'), f.read()
+
+
+# bring the index of a repo in line with a directory of its files, returns (pages indexed,
+# pages removed)
+def index_repo(repo, root):
+    if not index_path():
+        return 0, 0
+    with open_index() as connection:
+        seen = set()
+
+        def pages():
+            for path, text in markdown_files(root):
+                seen.add(path)
+                yield path, text
+        indexed = index_pages(connection, repo, pages())
+
+        files = connection.execute("SELECT id, path FROM files WHERE repo = ?", [repo]).fetchall()
+        removed = [(file_id,) for file_id, path in files if path not in seen]
+        connection.executemany("DELETE FROM pages WHERE rowid = ?", removed)
+        connection.executemany("DELETE FROM files WHERE id = ?", removed)
+    return indexed, len(removed)
+
+
+# turn an fts5 snippet into html
+def snippet_html(snippet):
+    return escape(snippet).replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+
+
+# search the index, returns a page of results, best first, as dicts of repo, path, title
+# and snippet (html), and whether there are more results
+def search_docs(query, page=1, per_page=20, repo=None):
+    terms = TERM_RE.findall((query or '').lower())[:MAX_SEARCH_TERMS]
+    if not terms or not index_path() or not os.path.exists(index_path()):
+        return [], False
+
+    sql = ("SELECT files.repo, files.path, pages.title, snippet(pages, 1, ?, ?, '...', ?) "
+           "FROM pages JOIN files ON files.id = pages.rowid WHERE pages MATCH ?")
+    params = [SNIPPET_START, SNIPPET_END, SNIPPET_WORDS, ' '.join('"{}"*'.format(term) for term in terms)]
+    if repo is not None:
+        sql += " AND files.repo = ?"
+        params.append(repo)
+    sql += " ORDER BY bm25(pages, {}, {}) LIMIT ? OFFSET ?".format(*WEIGHTS)
+    params += [per_page + 1, (page - 1) * per_page]
+
+    with open_index() as connection:
+        rows = connection.execute(sql, params).fetchall()
+    results = [{'repo': repo, 'path': path, 'title': title, 'snippet': snippet_html(snippet)}
+               for repo, path, title, snippet in rows[:per_page]]
+    return results, len(rows) > per_page
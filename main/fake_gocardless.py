@@ -0,0 +1,303 @@
+from bisect import bisect_right, insort
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+import hashlib
+import hmac
+import json
+import random
+import re
+import threading
+import time
+
+# A stand-in for the GoCardless API, so the GoCardless jobs and the payment pages can be
+# tried out and benchmarked offline. `manage.py fake_gocardless` serves it, and setting
+# GOCARDLESS_BASE_URL to its url points the site at it. It keeps mandates, payments and
+# redirect flows in memory and serves the endpoints main/models uses - getting and
+# listing mandates and payments (lists are cursor paginated and can be filtered on
+# created_at, like the real ones), creating payments (honouring Idempotency-Key),
+# cancelling mandates, and creating and completing redirect flows. A redirect flow's
+# redirect_url goes straight back to its success_redirect_url, as if the customer had
+# filled in their bank details.
+#
+# There are also helpers to make signed webhooks, as GoCardless would send them.
+
+MAX_LIMIT = 500
+DEFAULT_LIMIT = 50
+
+PATH_RE = re.compile(r'^/(mandates|payments|redirect_flows)(?:/(\w+)(?:/(actions/\w+|flow))?)?$')
+CREATED_AT_RE = re.compile(r'^created_at\[(gt|gte|lt|lte)\]$')
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.000Z'
+
+MANDATE_STATUSES = ('pending_submission', 'submitted', 'active', 'cancelled', 'failed')
+PAYMENT_STATUSES = ('pending_submission', 'submitted', 'confirmed', 'paid_out', 'failed')
+
+# payments can only be taken from mandates in these states
+PAYABLE_MANDATE_STATUSES = ('pending_customer_approval', 'pending_submission', 'submitted', 'active')
+
+ID_PREFIXES = {'mandates': 'MD', 'payments': 'PM', 'redirect_flows': 'RE'}
+
+
+def api_time(value):
+    return value.strftime(TIME_FORMAT)
+
+
+def mandate_resource(mandate_id, status, created_at, reference=''):
+    return {'id': mandate_id, 'status': status, 'created_at': created_at, 'reference': reference,
+            'scheme': 'bacs', 'metadata': {},
+            'links': {'creditor': 'CR000001', 'customer': 'CU' + mandate_id[2:],
+                      'customer_bank_account': 'BA' + mandate_id[2:]}}
+
+
+def payment_resource(payment_id, mandate_id, status, created_at, amount, charge_date, amount_refunded=0):
+    return {'id': payment_id, 'status': status, 'created_at': created_at, 'amount': amount,
+            'amount_refunded': amount_refunded, 'currency': 'GBP', 'charge_date': charge_date,
+            'description': '', 'reference': '', 'metadata': {},
+            'links': {'mandate': mandate_id, 'creditor': 'CR000001'}}
+
+
+# made up mandates, each with some payments
+def generate_resources(mandates, payments_per_mandate=1, seed=0):
+    rng = random.Random(seed)
+    start = datetime(2020, 1, 1)
+    resources = {'mandates': [], 'payments': []}
+    for i in range(mandates):
+        created_at = start + timedelta(minutes=i)
+        mandate_id = 'MD{:08d}'.format(i)
+        resources['mandates'].append(
+            mandate_resource(mandate_id, rng.choice(MANDATE_STATUSES), api_time(created_at)))
+        for j in range(payments_per_mandate):
+            resources['payments'].append(payment_resource(
+                'PM{:08d}'.format(i * payments_per_mandate + j), mandate_id, rng.choice(PAYMENT_STATUSES),
+                api_time(created_at + timedelta(days=j)), 1000,
+                (created_at + timedelta(days=j + 3)).date().isoformat()))
+    return resources
+
+
+# the mandates and payments in the database, with the status of change_rate of them changed
+def database_resources(change_rate=0.1, seed=0):
+    from .models import GocardlessMandate, GocardlessPayment
+    rng = random.Random(seed)
+
+    def status(current, statuses):
+        if rng.random() < change_rate:
+            return rng.choice([other for other in statuses if other != current])
+        return current
+    return {
+        'mandates': [mandate_resource(mandate.id, status(mandate.status, MANDATE_STATUSES),
+                                      api_time(mandate.created_at), mandate.reference)
+                     for mandate in GocardlessMandate.objects.all()],
+        'payments': [payment_resource(payment.id, payment.mandate_id or '',
+                                      status(payment.status, PAYMENT_STATUSES),
+                                      api_time(payment.created_at), payment.amount,
+                                      payment.charge_date.isoformat(), payment.amount_refunded)
+                     for payment in GocardlessPayment.objects.all()],
+    }
+
+
+# an event as it appears in a webhook
+def webhook_event(event_id, resource_type, action, resource_id, created_at=None):
+    return {'id': event_id, 'created_at': created_at or api_time(datetime.now(timezone.utc)),
+            'resource_type': resource_type, 'action': action,
+            'links': {resource_type.rstrip('s'): resource_id}, 'details': {'description': action}}
+
+
+# the body of a webhook carrying some events, and its Webhook-Signature header
+def sign_webhook(events, secret):
+    body = json.dumps({'events': events}).encode('utf-8')
+    return body, hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+
+
+class ApiError(Exception):
+    def __init__(self, status, error_type, message, reason, links=None):
+        super(ApiError, self).__init__(message)
+        self.status = status
+        self.body = {'error': {'type': error_type, 'code': status, 'message': message, 'errors': [
+            {'reason': reason, 'message': message, 'links': links or {}}]}}
+
+
+def not_found():
+    return ApiError(404, 'invalid_api_usage', 'Resource not found', 'resource_not_found')
+
+
+class FakeGocardless(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # resources are {'mandates': [...], 'payments': [...]}, latency is added to every
+    # response (in seconds)
+    def __init__(self, address, resources, latency=0):
+        super(FakeGocardless, self).__init__(address, FakeGocardlessHandler)
+        self.resources = {name: {item['id']: item for item in resources.get(name, [])}
+                          for name in ID_PREFIXES}
+        # list endpoints page through resources in id order
+        self.ids = {name: sorted(items) for name, items in self.resources.items()}
+        # payment ids by the idempotency key they were created with
+        self.idempotency_keys = {}
+        self.latency = latency
+        self.request_count = 0
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(*self.server_address[:2])
+
+    def count_request(self):
+        with self.lock:
+            self.request_count += 1
+
+    # store a new resource, giving it an id (the caller holds the lock)
+    def add(self, name, item):
+        self.next_id += 1
+        item['id'] = '{}F{:07d}'.format(ID_PREFIXES[name], self.next_id)
+        item['created_at'] = api_time(datetime.now(timezone.utc))
+        self.resources[name][item['id']] = item
+        insort(self.ids[name], item['id'])
+        return item
+
+    def get(self, name, resource_id):
+        item = self.resources[name].get(resource_id)
+        if item is None:
+            raise not_found()
+        return {name: item}
+
+    def list(self, name, query):
+        limit = min(int(query.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+        ids = self.ids[name]
+        start = bisect_right(ids, query['after']) if query.get('after') else 0
+        filters = [(CREATED_AT_RE.match(key).group(1), value) for key, value in query.items()
+                   if CREATED_AT_RE.match(key)]
+        items = []
+        for resource_id in ids[start:]:
+            item = self.resources[name][resource_id]
+            if all(compare(item['created_at'], op, value) for op, value in filters):
+                items.append(item)
+                if len(items) > limit:
+                    break
+        more = len(items) > limit
+        items = items[:limit]
+        return {name: items, 'meta': {'limit': limit, 'cursors': {
+            'before': None, 'after': items[-1]['id'] if more else None}}}
+
+    def create_payment(self, params, idempotency_key):
+        with self.lock:
+            if idempotency_key in self.idempotency_keys:
+                raise ApiError(409, 'invalid_state', 'A resource has already been created with this '
+                               'idempotency key', 'idempotent_creation_conflict',
+                               {'conflicting_resource_id': self.idempotency_keys[idempotency_key]})
+            mandate = self.resources['mandates'].get(params['links']['mandate'])
+            if mandate is None or mandate['status'] not in PAYABLE_MANDATE_STATUSES:
+                raise ApiError(422, 'invalid_state', 'The mandate is not active', 'mandate_is_inactive')
+            payment = self.add('payments', payment_resource(
+                None, mandate['id'], 'pending_submission', None, params['amount'],
+                (datetime.now(timezone.utc) + timedelta(days=3)).date().isoformat()))
+            payment.update(currency=params.get('currency', 'GBP'), metadata=params.get('metadata', {}))
+            if idempotency_key:
+                self.idempotency_keys[idempotency_key] = payment['id']
+        return {'payments': payment}
+
+    def cancel_mandate(self, mandate_id):
+        with self.lock:
+            mandate = self.get('mandates', mandate_id)['mandates']
+            if mandate['status'] in ('cancelled', 'failed', 'expired'):
+                raise ApiError(422, 'invalid_state', 'The mandate can not be cancelled',
+                               'cancellation_failed')
+            mandate['status'] = 'cancelled'
+        return {'mandates': mandate}
+
+    def create_redirect_flow(self, params):
+        with self.lock:
+            flow = self.add('redirect_flows', {
+                'description': params.get('description', ''), 'session_token': params['session_token'],
+                'success_redirect_url': params['success_redirect_url'], 'links': {'creditor': 'CR000001'}})
+            flow['redirect_url'] = '{}redirect_flows/{}/flow'.format(self.url, flow['id'])
+        return {'redirect_flows': flow}
+
+    def complete_redirect_flow(self, flow_id, params):
+        with self.lock:
+            flow = self.get('redirect_flows', flow_id)['redirect_flows']
+            if params.get('session_token') != flow['session_token']:
+                raise ApiError(422, 'invalid_api_usage', 'The session token does not match',
+                               'session_token_mismatch')
+            if 'mandate' not in flow['links']:
+                mandate = self.add('mandates', mandate_resource('MD', 'pending_submission', None))
+                mandate['links'] = {'creditor': 'CR000001', 'customer': 'CU' + mandate['id'][2:],
+                                    'customer_bank_account': 'BA' + mandate['id'][2:]}
+                flow['links'].update(mandate['links'], mandate=mandate['id'])
+        return {'redirect_flows': flow}
+
+
+# compare api timestamps, which sort as strings once their fractions of a second are dropped
+def compare(value, op, other):
+    value, other = value[:19], other[:19]
+    return {'gt': value > other, 'gte': value >= other, 'lt': value < other, 'lte': value <= other}[op]
+
+
+class FakeGocardlessHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, so don't wait to batch them up
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.handle_api(self.get)
+
+    def do_POST(self):
+        self.handle_api(self.post)
+
+    def handle_api(self, method):
+        self.server.count_request()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urlsplit(self.path)
+        match = PATH_RE.match(url.path)
+        try:
+            if match is None:
+                raise not_found()
+            method(url, *match.groups())
+        except ApiError as e:
+            self.respond(e.status, e.body)
+
+    def get(self, url, name, resource_id, action):
+        if resource_id is None and action is None:
+            self.respond(200, self.server.list(name, dict(parse_qsl(url.query))))
+        elif action is None:
+            self.respond(200, self.server.get(name, resource_id))
+        elif name == 'redirect_flows' and action == 'flow':
+            # the customer has "filled in their details" - send them back to the site
+            flow = self.server.get(name, resource_id)['redirect_flows']
+            location = '{}{}{}'.format(flow['success_redirect_url'],
+                                       '&' if '?' in flow['success_redirect_url'] else '?',
+                                       urlencode({'redirect_flow_id': flow['id']}))
+            self.send_response(302)
+            self.send_header('Location', location)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            raise not_found()
+
+    def post(self, url, name, resource_id, action):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'null') or {}
+        params = body.get(name) or body.get('data') or {}
+        if name == 'payments' and resource_id is None:
+            self.respond(201, self.server.create_payment(params, self.headers.get('Idempotency-Key')))
+        elif name == 'mandates' and action == 'actions/cancel':
+            self.respond(200, self.server.cancel_mandate(resource_id))
+        elif name == 'redirect_flows' and resource_id is None:
+            self.respond(201, self.server.create_redirect_flow(params))
+        elif name == 'redirect_flows' and action == 'actions/complete':
+            self.respond(200, self.server.complete_redirect_flow(resource_id, params))
+        else:
+            raise not_found()
+
+    def respond(self, status, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
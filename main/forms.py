@@ -1,6 +1,7 @@
 from django.forms import ModelForm
 from django.contrib.auth.forms import UserCreationForm
-from .models import User, SupporterMembership
+from .models import User, SupporterMembership, Space
+from .postcodes import normalise_postcode, geocode
 from django.utils import timezone
 from django.core.mail import EmailMessage
 from django.template.loader import get_template
@@ -8,6 +9,7 @@ from django.conf import settings
 import uuid
 from django.urls import reverse
 from django import forms
+from decimal import Decimal
 from simplemathcaptcha.fields import MathCaptchaField
 import logging
 
@@ -15,6 +17,21 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# a text box that suggests spaces as you type (see static/js/space_autocomplete.js) - only
+# the selected space's id is submitted, so the page doesn't have to list every space
+class SpaceAutocompleteWidget(forms.Widget):
+    template_name = 'main/widgets/space_autocomplete.html'
+
+    def get_context(self, name, value, attrs):
+        context = super(SpaceAutocompleteWidget, self).get_context(name, value, attrs)
+        space_name = ''
+        if value not in (None, ''):
+            space_name = Space.objects.filter(pk=value).values_list('name', flat=True).first() or ''
+        context['widget']['space_name'] = space_name
+        context['widget']['url'] = reverse('space_autocomplete')
+        return context
+
+
 class CustomUserCreationForm(ModelForm):
     # insert a field to indicate approval to Code of Conduct, defaults to false
     agree_to_coc = forms.BooleanField()
@@ -22,6 +39,9 @@ class CustomUserCreationForm(ModelForm):
     class Meta(UserCreationForm.Meta):
         model = User
         fields = ('email', 'first_name', 'last_name', 'space', 'agree_to_coc')
+        widgets = {
+            'space': SpaceAutocompleteWidget,
+        }
 
     def __init__(self, *args, **kwargs):
         self.request = kwargs.pop('request', None)
@@ -134,8 +154,26 @@ class NewSpaceForm(forms.Form):
     email = forms.EmailField(required=True)
     main_website_url = forms.URLField(required=False)
     address = forms.CharField(widget=forms.Textarea, required=True)
+    postcode = forms.CharField(max_length=9, required=False)
     have_premises = forms.BooleanField(required=False)
     notes = forms.CharField(widget=forms.Textarea, required=False)
     lat = forms.DecimalField(max_digits=10, decimal_places=7, initial=54.1)
     lng = forms.DecimalField(max_digits=10, decimal_places=7, initial=-2.1)
     captcha = MathCaptchaField()
+
+    def clean_postcode(self):
+        data = self.cleaned_data['postcode']
+        if data != "" and normalise_postcode(data) is None:
+            raise forms.ValidationError("Please enter a full UK postcode")
+        return data
+
+    # if the pin was left where it started, put it at the postcode instead
+    def clean(self):
+        cleaned_data = super(NewSpaceForm, self).clean()
+        if (cleaned_data.get('postcode') and
+                cleaned_data.get('lat') == Decimal(str(self.fields['lat'].initial)) and
+                cleaned_data.get('lng') == Decimal(str(self.fields['lng'].initial))):
+            location = geocode(cleaned_data['postcode'])
+            if location is not None:
+                cleaned_data['lat'], cleaned_data['lng'] = (Decimal(str(value)) for value in location)
+        return cleaned_data
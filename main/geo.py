@@ -0,0 +1,183 @@
+import math
+
+
+# parse a "min_lng,min_lat,max_lng,max_lat" bounding box query parameter
+# raises ValueError if it isn't a valid bounding box
+def parse_bbox(value):
+    parts = [float(part) for part in value.split(',')]
+    if len(parts) != 4:
+        raise ValueError("bbox must have 4 comma separated values")
+    if not all(math.isfinite(part) for part in parts):
+        raise ValueError("bbox values must be finite numbers")
+    min_lng, min_lat, max_lng, max_lat = parts
+    if min_lng > max_lng or min_lat > max_lat:
+        raise ValueError("bbox minimums must not be greater than maximums")
+    if min_lng < -180 or max_lng > 180 or min_lat < -90 or max_lat > 90:
+        raise ValueError("bbox is out of range")
+    return (min_lng, min_lat, max_lng, max_lat)
+
+
+# parse repeated and/or comma separated status query parameters
+def parse_statuses(values):
+    return [status for value in values for status in value.split(',') if status]
+
+
+# web mercator tile size in pixels, as used by leaflet
+TILE_SIZE = 256
+
+# web mercator can't represent the poles, so clamp latitudes to this
+MAX_LATITUDE = 85.0511287798
+
+# zoom levels supported by the map
+MIN_ZOOM = 0
+MAX_ZOOM = 18
+
+# size (in pixels at the requested zoom) of the grid cells points are clustered into
+CLUSTER_CELL_SIZE = 60
+
+
+# project lng/lat to web mercator world pixel coordinates at a given zoom
+def lng_lat_to_pixel(lng, lat, zoom):
+    size = TILE_SIZE * 2 ** zoom
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    sin_lat = math.sin(math.radians(lat))
+    x = (lng + 180.0) / 360.0 * size
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * size
+    return x, y
+
+
+# does the grid cell a cluster (or single feature) from cluster_features() is in overlap
+# a bounding box? a cluster is placed at the mean of its points, so is always in their cell,
+# and testing the cell rather than the point keeps clusters straddling the bbox edge
+def cluster_in_bbox(lng, lat, bbox, zoom):
+    x, y = lng_lat_to_pixel(lng, lat, zoom)
+    cell_x, cell_y = x // CLUSTER_CELL_SIZE * CLUSTER_CELL_SIZE, y // CLUSTER_CELL_SIZE * CLUSTER_CELL_SIZE
+    min_x, min_y = lng_lat_to_pixel(bbox[0], bbox[3], zoom)
+    max_x, max_y = lng_lat_to_pixel(bbox[2], bbox[1], zoom)
+    return (cell_x <= max_x and cell_x + CLUSTER_CELL_SIZE >= min_x and
+            cell_y <= max_y and cell_y + CLUSTER_CELL_SIZE >= min_y)
+
+
+# cluster geojson point features into a grid of CLUSTER_CELL_SIZE pixel cells at the
+# given zoom. every feature returned has a "count" property - clusters of more than
+# one point are placed at the mean of their points and carry no other properties
+def cluster_features(features, zoom):
+    cells = {}
+    for feature in features:
+        lng, lat = feature['geometry']['coordinates']
+        x, y = lng_lat_to_pixel(lng, lat, zoom)
+        cells.setdefault((int(x // CLUSTER_CELL_SIZE), int(y // CLUSTER_CELL_SIZE)), []).append(feature)
+
+    clusters = []
+    for members in cells.values():
+        if len(members) == 1:
+            feature = dict(members[0], properties=dict(members[0]['properties'], count=1))
+        else:
+            feature = {
+                "type": "Feature",
+                "geometry": {
+                    "type": "Point",
+                    "coordinates": [
+                        sum(m['geometry']['coordinates'][0] for m in members) / len(members),
+                        sum(m['geometry']['coordinates'][1] for m in members) / len(members),
+                    ]
+                },
+                "properties": {
+                    "count": len(members)
+                }
+            }
+        clusters.append(feature)
+    return clusters
+
+
+# lng/lat bounding box of a web mercator tile, optionally grown on every side by
+# buffer (as a fraction of the tile size)
+def tile_bbox(zoom, x, y, buffer=0):
+    n = 2 ** zoom
+
+    def tile_lng(tx):
+        return tx / n * 360.0 - 180.0
+
+    def tile_lat(ty):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / n))))
+
+    return (max(-180.0, tile_lng(x - buffer)), max(-90.0, tile_lat(y + 1 + buffer)),
+            min(180.0, tile_lng(x + 1 + buffer)), min(90.0, tile_lat(y - buffer)))
+
+
+# mean earth radius
+EARTH_RADIUS_KM = 6371.0088
+
+# roughly how many km in a degree of latitude
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180.0
+
+
+# great circle distance between two points in km
+def haversine_km(lng1, lat1, lng2, lat2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+# Spatial index for nearest neighbour lookups - points are bucketed into a grid of
+# cell_size degree cells, and searches work outwards from the query point's cell one
+# ring of cells at a time, so only nearby points are ever compared
+class SpatialIndex:
+    def __init__(self, points, cell_size=1.0):
+        # points is an iterable of (lng, lat, item)
+        self.cell_size = cell_size
+        self.cells = {}
+        self.max_abs_lat = 0.0
+        for lng, lat, item in points:
+            self.cells.setdefault(self.cell(lng, lat), []).append((lng, lat, item))
+            self.max_abs_lat = max(self.max_abs_lat, abs(lat))
+        self.size = sum(len(members) for members in self.cells.values())
+
+        # how far the search may need to go before every cell has been visited
+        cell_xs = [x for x, _ in self.cells] or [0]
+        cell_ys = [y for _, y in self.cells] or [0]
+        self.extent = (min(cell_xs), min(cell_ys), max(cell_xs), max(cell_ys))
+
+    def __len__(self):
+        return self.size
+
+    def cell(self, lng, lat):
+        return (int(math.floor(lng / self.cell_size)), int(math.floor(lat / self.cell_size)))
+
+    def ring(self, cx, cy, r):
+        if r == 0:
+            yield (cx, cy)
+            return
+        for x in range(cx - r, cx + r + 1):
+            yield (x, cy - r)
+            yield (x, cy + r)
+        for y in range(cy - r + 1, cy + r):
+            yield (cx - r, y)
+            yield (cx + r, y)
+
+    # lower bound on the distance (km) to any point outside rings 0..r
+    def outside_distance(self, lng, lat, cx, cy, r):
+        lat_gap = min(lat - (cy - r) * self.cell_size, (cy + r + 1) * self.cell_size - lat)
+        lng_gap = min(lng - (cx - r) * self.cell_size, (cx + r + 1) * self.cell_size - lng)
+        # degrees of longitude are shortest at the most poleward point in the index
+        lng_scale = math.cos(math.radians(self.max_abs_lat))
+        return min(lat_gap, lng_gap * lng_scale) * KM_PER_DEGREE
+
+    # find the k nearest points to lng/lat, returns a list of (distance_km, item)
+    def nearest(self, lng, lat, k):
+        cx, cy = self.cell(lng, lat)
+        max_r = max(abs(cx - self.extent[0]), abs(cx - self.extent[2]),
+                    abs(cy - self.extent[1]), abs(cy - self.extent[3]))
+        found = []
+        for r in range(max_r + 1):
+            for cell in self.ring(cx, cy, r):
+                for p_lng, p_lat, item in self.cells.get(cell, ()):
+                    found.append((haversine_km(lng, lat, p_lng, p_lat), item))
+            if len(found) >= k:
+                found.sort(key=lambda result: result[0])
+                found = found[:k]
+                if found[-1][0] <= self.outside_distance(lng, lat, cx, cy, r):
+                    break
+        found.sort(key=lambda result: result[0])
+        return found[:k]
@@ -0,0 +1,324 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote
+from .docs_search import index_page
+import contextlib
+import hashlib
+import logging
+import os
+import requests
+import tempfile
+import threading
+import time
+import uuid
+
+# get instance of a logger
+logger = logging.getLogger(__name__)
+
+# Cache in front of the markdown pages the resources/foundation browser fetches from
+# GitHub. Pages are kept in the 'github' cache and served from there for
+# GITHUB_CACHE_TTL seconds. After that a stale copy is still served (for up to
+# GITHUB_CACHE_STALE seconds) while one background request refreshes it, and is also
+# served if GitHub can't be reached. Concurrent misses for the same page wait for a
+# single upstream request - a thread lock coalesces them within a process and a
+# cache.add() lock across processes.
+#
+# Pages are stored with their ETag/Last-Modified, and are refreshed with a conditional
+# request - a 304 just renews the stored copy. Pages are kept past their stale time
+# (until the cache culls them) so even old copies can be revalidated this way.
+
+RAW_URL = 'https://raw.githubusercontent.com/UKHackspaceFoundation/%s/master/'
+
+# (connect, read) timeouts
+FETCH_TIMEOUT = (3, 10)
+
+# connections kept open to github, per process
+POOL_SIZE = 10
+
+# after a failed refresh, keep serving the stale copy this long before trying again
+ERROR_RETRY_DELAY = 60
+
+# files (pdfs, images, ...) proxied for the browser are kept on disk this long before
+# they're downloaded again
+FILE_CACHE_TTL = 60 * 60 * 24
+
+# don't proxy anything bigger than this
+MAX_FILE_BYTES = 50 * 1024 * 1024
+
+# how much space the proxied files may take up, by default
+FILE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# how long a process waits for another process to fetch a page before fetching it itself
+LOCK_WAIT = 10
+LOCK_POLL_INTERVAL = 0.1
+
+
+class GithubUnavailable(Exception):
+    pass
+
+
+# one session per process, so connections to github are reused
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE))
+
+
+# default fetcher - makes a conditional request for a url given the validators of the
+# copy we have, returns (status code, text, etag, last modified). raises on network errors
+def fetch_page(url, etag='', last_modified=''):
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    r = session.get(url, headers=headers, timeout=FETCH_TIMEOUT)
+    return r.status_code, r.text, r.headers.get('ETag', ''), r.headers.get('Last-Modified', '')
+
+
+# default file fetcher - downloads a url into the file f, returns the status code
+def fetch_file(url, f):
+    with session.get(url, timeout=FETCH_TIMEOUT, stream=True) as r:
+        if r.status_code == 200:
+            size = 0
+            for block in r.iter_content(64 * 1024):
+                size += len(block)
+                if size > MAX_FILE_BYTES:
+                    raise GithubUnavailable("{} is too big to proxy".format(url))
+                f.write(block)
+        return r.status_code
+
+
+# get the fetcher named by the GITHUB_FETCHER setting, so tests can avoid the network
+def get_fetcher():
+    return import_string(getattr(settings, "GITHUB_FETCHER", "main.github.fetch_page"))
+
+
+def get_file_fetcher():
+    return import_string(getattr(settings, "GITHUB_FILE_FETCHER", "main.github.fetch_file"))
+
+
+# is path a plain path within a repo? empty, . and .. segments are refused, as in a url
+# they could lead out of the repo (a trailing / is fine, for a directory)
+def is_repo_path(path):
+    return not path or all(segment not in ('', '.', '..') for segment in path.rstrip('/').split('/'))
+
+
+# the url of a file in a repo. the path is quoted, so ? and # are part of the file name
+def raw_url(repo, path):
+    return (RAW_URL % repo) + quote(path)
+
+
+def cache_key(url):
+    return 'github:' + hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+# locks so threads in this process make one request at a time for each page - urls are
+# spread over a fixed number of them, so made up paths can't grow this without limit
+url_locks = [threading.Lock() for _ in range(64)]
+
+
+def url_lock(url):
+    return url_locks[hash(url) % len(url_locks)]
+
+
+def ttl():
+    return getattr(settings, "GITHUB_CACHE_TTL", 300)
+
+
+def stale_ttl():
+    return getattr(settings, "GITHUB_CACHE_STALE", 60 * 60 * 24 * 7)
+
+
+def page_cache():
+    return caches['github']
+
+
+# fetch a page from github and cache it, revalidating the previous copy if there is one.
+# if that fails, the previous copy is returned if it isn't too stale to serve, otherwise
+# GithubUnavailable is raised
+def refresh(repo, path, previous=None):
+    cache = page_cache()
+    url = raw_url(repo, path)
+    key = cache_key(url)
+    lock_key = key + ':lock'
+    now = time.time()
+    stale = previous if previous is not None and now < previous['stale_until'] else None
+    # the lock holds a token, so only the process that took it releases it
+    token = uuid.uuid4().hex
+    # another process is already fetching this page - wait for it
+    if not cache.add(lock_key, token, LOCK_WAIT):
+        if stale is not None:
+            return stale
+        deadline = time.monotonic() + LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+            entry = cache.get(key)
+            if entry is not None and time.time() < entry['stale_until']:
+                return entry
+            if cache.get(lock_key) is None:
+                break
+        # take the lock if it's free now, otherwise fetch without it
+        cache.add(lock_key, token, LOCK_WAIT)
+
+    try:
+        entry = fetch(url, previous)
+    except (requests.RequestException, GithubUnavailable) as e:
+        logger.warning("Unable to fetch %s: %s", url, e)
+        if stale is None:
+            raise GithubUnavailable(str(e))
+        entry = dict(stale, expires=time.time() + ERROR_RETRY_DELAY)
+    else:
+        # keep the search index up to date with pages fetched from github
+        if entry['status'] == 200 and path.endswith('.md') and (previous or {}).get('text') != entry['text']:
+            index_page(repo, path, entry['text'])
+    finally:
+        # the lock may have expired during a slow fetch and been taken by another process,
+        # whose lock mustn't be released
+        if cache.get(lock_key) == token:
+            cache.delete(lock_key)
+
+    cache.set(key, entry)
+    return entry
+
+
+# make the request for refresh(), returns the new entry
+def fetch(url, previous):
+    validators = (previous['etag'], previous['last_modified']) if previous else ('', '')
+    status, text, etag, last_modified = get_fetcher()(url, *validators)
+    now = time.time()
+    times = {'expires': now + ttl(), 'stale_until': now + ttl() + stale_ttl()}
+    if status == 304 and previous is not None:
+        return dict(previous, **times)
+    if status not in (200, 404):
+        raise GithubUnavailable("GitHub returned {}".format(status))
+    return dict(times, status=status, text=text, etag=etag, last_modified=last_modified)
+
+
+def refresh_in_background(repo, path, stale):
+    url = raw_url(repo, path)
+    lock = url_lock(url)
+    # someone in this process is already refreshing it
+    if not lock.acquire(blocking=False):
+        return
+
+    def run():
+        try:
+            refresh(repo, path, stale)
+        except Exception:
+            logger.exception("Error refreshing %s", url)
+        finally:
+            lock.release()
+    threading.Thread(target=run, daemon=True).start()
+
+
+# get a page from one of the foundation's repos, returns (status code, text) where the
+# status is 200 or 404. raises GithubUnavailable if it can't be fetched and isn't cached
+def get_page(repo, path):
+    # anything else isn't a page in the repo, and mustn't be fetched or indexed
+    if not is_repo_path(path):
+        return 404, ''
+    url = raw_url(repo, path)
+    entry = page_cache().get(cache_key(url))
+    now = time.time()
+    if entry is not None and now < entry['stale_until']:
+        if now >= entry['expires']:
+            refresh_in_background(repo, path, entry)
+        return entry['status'], entry['text']
+
+    with url_lock(url):
+        # another thread may have fetched it while we waited for the lock
+        latest = page_cache().get(cache_key(url))
+        if latest is not None and time.time() < latest['stale_until']:
+            entry = latest
+        else:
+            entry = refresh(repo, path, latest)
+    return entry['status'], entry['text']
+
+
+# download a url to local_path, replacing it atomically. the download isn't made under the
+# url's lock - only the rename is - so a slow download never holds up other requests.
+# returns False if there's no such file, raises if it can't be downloaded
+def download_file(url, local_path):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(local_path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            status = get_file_fetcher()(url, f)
+        if status not in (200, 404):
+            raise GithubUnavailable("GitHub returned {}".format(status))
+        if status == 200:
+            os.chmod(tmp_path, 0o644)
+            with url_lock(url):
+                os.replace(tmp_path, local_path)
+        return status == 200
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def file_cache_max_bytes():
+    return getattr(settings, "DOCS_FILE_CACHE_MAX_BYTES", FILE_CACHE_MAX_BYTES)
+
+
+# remove the least recently downloaded files from the file cache until it's no bigger than
+# DOCS_FILE_CACHE_MAX_BYTES, keeping the file at keep (just downloaded)
+def prune_file_cache(root, keep):
+    files = []
+    total = 0
+    for entry in os.scandir(root):
+        # temporary files are downloads in progress
+        if not entry.is_file() or entry.name.startswith('tmp'):
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        total += stat.st_size
+        if entry.path != keep:
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    for mtime, size, path in sorted(files):
+        if total <= file_cache_max_bytes():
+            break
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        total -= size
+
+
+# get a local copy of a file from one of the foundation's repos, downloading it into
+# DOCS_FILE_CACHE_ROOT if there isn't a recent one. returns its path, or None if there's no
+# such file. raises GithubUnavailable if it can't be fetched and there's no copy to serve
+def get_file(repo, path):
+    if not is_repo_path(path):
+        return None
+    url = raw_url(repo, path)
+    root = settings.DOCS_FILE_CACHE_ROOT
+    # keep the extension, so the content type can be worked out from the name
+    local_path = os.path.join(root, hashlib.sha256(url.encode('utf-8')).hexdigest()[:32] +
+                              os.path.splitext(path)[1].lower())
+
+    try:
+        age = time.time() - os.stat(local_path).st_mtime
+    except FileNotFoundError:
+        age = None
+    if age is not None and age < FILE_CACHE_TTL:
+        return local_path
+
+    os.makedirs(root, exist_ok=True)
+    try:
+        if not download_file(url, local_path):
+            if age is not None:
+                with url_lock(url), contextlib.suppress(FileNotFoundError):
+                    os.remove(local_path)
+            return None
+    except (OSError, requests.RequestException, GithubUnavailable) as e:
+        logger.warning("Unable to fetch %s: %s", url, e)
+        if age is None:
+            raise GithubUnavailable(str(e))
+        # serve the old copy, and don't try again for a while
+        retry = time.time() - FILE_CACHE_TTL + ERROR_RETRY_DELAY
+        with url_lock(url), contextlib.suppress(FileNotFoundError):
+            os.utime(local_path, (retry, retry))
+    else:
+        with contextlib.suppress(OSError):
+            prune_file_cache(root, local_path)
+    return local_path
@@ -0,0 +1,98 @@
+from django.conf import settings
+from django.urls import reverse
+from django.utils.module_loading import import_string
+from io import BytesIO
+from PIL import Image
+import hashlib
+import logging
+import os
+import requests
+import tempfile
+
+# get instance of a logger
+logger = logging.getLogger(__name__)
+
+# Space logos are fetched once by `manage.py fetch_logos`, shrunk to thumbnails and
+# stored under LOGO_ROOT with a name taken from a hash of their content, so they can
+# be served with immutable cache headers.
+
+# largest width/height of a thumbnail, in pixels
+THUMBNAIL_SIZE = 128
+
+# don't download anything bigger than this
+MAX_LOGO_BYTES = 5 * 1024 * 1024
+
+FETCH_TIMEOUT = (5, 20)
+
+EXTENSIONS = {
+    'image/png': '.png',
+    'image/jpeg': '.jpg',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+    'image/svg+xml': '.svg',
+}
+
+CONTENT_TYPES = {extension: content_type for content_type, extension in EXTENSIONS.items()}
+
+
+# default fetcher - returns (content, content type) for a logo url, or raises
+def fetch_logo(url):
+    with requests.get(url, timeout=FETCH_TIMEOUT, stream=True) as r:
+        r.raise_for_status()
+        content = r.raw.read(MAX_LOGO_BYTES + 1, decode_content=True)
+        if len(content) > MAX_LOGO_BYTES:
+            raise ValueError("Logo is too big")
+        return content, r.headers.get('Content-Type', '')
+
+
+# get the fetcher named by the LOGO_FETCHER setting (a dotted path to a function
+# like fetch_logo), so tests can swap in something that doesn't hit the network
+def get_fetcher():
+    return import_string(getattr(settings, "LOGO_FETCHER", "main.logos.fetch_logo"))
+
+
+# shrink an image to fit within THUMBNAIL_SIZE, returns (content, extension)
+def make_thumbnail(content, content_type):
+    extension = EXTENSIONS.get(content_type.split(';')[0].strip().lower())
+    # svgs are small, and scale themselves
+    if extension == '.svg':
+        return content, extension
+
+    image = Image.open(BytesIO(content))
+    if image.width <= THUMBNAIL_SIZE and image.height <= THUMBNAIL_SIZE and extension is not None:
+        return content, extension
+    image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    if image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+        image = image.convert('RGBA')
+    output = BytesIO()
+    image.save(output, 'PNG', optimize=True)
+    return output.getvalue(), '.png'
+
+
+# write a thumbnail to LOGO_ROOT, named by its content hash, and return the name
+def store_thumbnail(content, extension):
+    filename = hashlib.sha256(content).hexdigest()[:32] + extension
+    path = os.path.join(settings.LOGO_ROOT, filename)
+    if not os.path.exists(path):
+        os.makedirs(settings.LOGO_ROOT, exist_ok=True)
+        # write to a temporary file first, so a half written logo is never served
+        fd, tmp_path = tempfile.mkstemp(dir=settings.LOGO_ROOT)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    return filename
+
+
+# fetch a logo and store a thumbnail of it, returning the thumbnail name
+def create_thumbnail(url, fetcher=None):
+    content, content_type = (fetcher or get_fetcher())(url)
+    return store_thumbnail(*make_thumbnail(content, content_type))
+
+
+# the url to show for a space logo - the thumbnail if there's an up to date one,
+# otherwise the original
+def logo_url(logo_image_url, logo_thumbnail='', logo_thumbnail_source=''):
+    if logo_thumbnail and logo_thumbnail_source == logo_image_url:
+        return reverse('logo', kwargs={'filename': logo_thumbnail})
+    return logo_image_url
@@ -0,0 +1,146 @@
+from datetime import datetime, timedelta, timezone
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import override_settings
+from main.fake_gocardless import FakeGocardless, api_time, mandate_resource, sign_webhook, webhook_event
+from main.models import GocardlessMandate, GocardlessWebhookEvent
+from main.utils import QueryCounter
+import random
+import requests
+import threading
+import time
+import uuid
+
+ACTIONS = ('submitted', 'active', 'cancelled', 'failed')
+
+
+class Rollback(Exception):
+    pass
+
+
+# the value below which a fraction q of (sorted) values fall
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Command(BaseCommand):
+    help = ("Replay signed GoCardless webhooks against /gocardless-webhook, and report throughput, "
+            "latency and database queries per event. Runs in a transaction that's rolled back "
+            "afterwards, unless --keep or --url is given")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=5000)
+        parser.add_argument('--batch-size', type=int, default=50, help="events per webhook")
+        parser.add_argument('--resources', type=int, default=500,
+                            help="distinct mandates the events are about")
+        parser.add_argument('--resend', type=float, default=0,
+                            help="fraction of webhooks sent twice, as GoCardless does when one fails")
+        parser.add_argument('--process', action='store_true',
+                            help="then process the events, against a fake GoCardless API")
+        parser.add_argument('--latency', type=float, default=0,
+                            help="seconds the fake API takes per request")
+        parser.add_argument('--url', help="post to a running site at this url instead of in process")
+        parser.add_argument('--secret', help="webhook secret (default: GOCARDLESS_WEBHOOK_SECRET)")
+        parser.add_argument('--keep', action='store_true', help="keep the events and mandates created")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        secret = options['secret'] or getattr(settings, "GOCARDLESS_WEBHOOK_SECRET", "") or ""
+        rng = random.Random(options['seed'])
+        run = uuid.uuid4().hex[:8]
+        mandate_ids = ['MDB{}{:06d}'.format(run, i) for i in range(options['resources'])]
+        start = datetime.now(timezone.utc)
+        events = [webhook_event('EVB{}{:07d}'.format(run, i), 'mandates', rng.choice(ACTIONS),
+                                rng.choice(mandate_ids), api_time(start + timedelta(seconds=i)))
+                  for i in range(options['events'])]
+        webhooks = [sign_webhook(events[i:i + options['batch_size']], secret)
+                    for i in range(0, len(events), options['batch_size'])]
+        webhooks += rng.sample(webhooks, int(len(webhooks) * options['resend']))
+
+        if options['url']:
+            self.report("Received", len(events), *self.post_http(options['url'], webhooks))
+            return
+        try:
+            with transaction.atomic():
+                queries = QueryCounter()
+                with connection.execute_wrapper(queries):
+                    elapsed, latencies = self.post(webhooks)
+                self.report("Received", len(events), elapsed, latencies, queries.count)
+                if options['process']:
+                    self.process(mandate_ids, options['batch_size'], options['latency'])
+                if not options['keep']:
+                    raise Rollback()
+        except Rollback:
+            pass
+
+    def post(self, webhooks):
+        hosts = [host for host in settings.ALLOWED_HOSTS if host != '*' and not host.startswith('.')]
+        client = Client(HTTP_HOST=hosts[0] if hosts else 'localhost')
+        latencies = []
+        start = time.perf_counter()
+        for body, signature in webhooks:
+            sent = time.perf_counter()
+            response = client.post('/gocardless-webhook', body, content_type='application/json',
+                                   HTTP_WEBHOOK_SIGNATURE=signature)
+            latencies.append(time.perf_counter() - sent)
+            if response.status_code != 200:
+                self.stderr.write("Webhook rejected with {}".format(response.status_code))
+        return time.perf_counter() - start, latencies
+
+    def post_http(self, url, webhooks):
+        session = requests.Session()
+        latencies = []
+        start = time.perf_counter()
+        for body, signature in webhooks:
+            sent = time.perf_counter()
+            response = session.post(url.rstrip('/') + '/gocardless-webhook', data=body, headers={
+                'Content-Type': 'application/json', 'Webhook-Signature': signature})
+            latencies.append(time.perf_counter() - sent)
+            if response.status_code != 200:
+                self.stderr.write("Webhook rejected with {}".format(response.status_code))
+        # the site's queries can't be counted from here
+        return time.perf_counter() - start, latencies, None
+
+    # process the stored events, with the mandates they're about served by a fake api
+    def process(self, mandate_ids, batch_size, latency):
+        GocardlessMandate.objects.bulk_create([
+            GocardlessMandate(id=mandate_id, status='pending_submission') for mandate_id in mandate_ids])
+        now = api_time(datetime.now(timezone.utc))
+        server = FakeGocardless(('127.0.0.1', 0), {
+            'mandates': [mandate_resource(mandate_id, 'active', now) for mandate_id in mandate_ids]}, latency)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with override_settings(GOCARDLESS_BASE_URL=server.url, GOCARDLESS_ACCESS_TOKEN='benchmark',
+                                   GOCARDLESS_ENVIRONMENT='sandbox'):
+                processed = 0
+                latencies = []
+                queries = QueryCounter()
+                start = time.perf_counter()
+                with connection.execute_wrapper(queries):
+                    while True:
+                        batch_start = time.perf_counter()
+                        count = GocardlessWebhookEvent.objects.process_due(batch_size)
+                        if not count:
+                            break
+                        processed += count
+                        latencies.append(time.perf_counter() - batch_start)
+                self.report("Processed", processed, time.perf_counter() - start, latencies,
+                            queries.count, server.request_count)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def report(self, what, events, elapsed, latencies, queries, api_requests=None):
+        line = "{} {} events in {} batches in {:.2f}s: {:.0f} events/s".format(
+            what, events, len(latencies), elapsed, events / elapsed if elapsed else 0)
+        if latencies:
+            latencies = sorted(latencies)
+            line += ", p50 {:.1f}ms, p99 {:.1f}ms per batch".format(
+                percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000)
+        if queries is not None and events:
+            line += ", {:.2f} queries per event".format(queries / events)
+        if api_requests is not None and events:
+            line += ", {:.2f} api requests per event".format(api_requests / events)
+        self.stdout.write(line)
@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from main.postcodes import PostcodeIndex
+
+
+class Command(BaseCommand):
+    help = "Compile a postcode directory csv (e.g. the ONS Postcode Directory) into the postcode index"
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv', help="postcode directory csv, with pcds/lat/long columns")
+        parser.add_argument('--output', default=getattr(settings, "POSTCODE_INDEX_PATH", None),
+                            help="where to write the index (defaults to POSTCODE_INDEX_PATH)")
+
+    def handle(self, *args, **options):
+        if not options['output']:
+            raise CommandError("No --output given and POSTCODE_INDEX_PATH is not set")
+
+        try:
+            index = PostcodeIndex.from_csv(options['csv'])
+        except (OSError, StopIteration) as e:
+            raise CommandError("Unable to read postcodes from {}: {}".format(options['csv'], e))
+
+        index.save(options['output'])
+        self.stdout.write("Wrote {} postcodes to {}".format(len(index), options['output']))
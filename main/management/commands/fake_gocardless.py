@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from main.fake_gocardless import FakeGocardless, database_resources, generate_resources
+
+
+class Command(BaseCommand):
+    help = "Serve a fake GoCardless API, for trying out and benchmarking the GoCardless jobs offline"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--generate', type=int, metavar='MANDATES',
+                            help="serve this many made up mandates (and their payments) instead of "
+                                 "the ones in the database")
+        parser.add_argument('--payments-per-mandate', type=int, default=1)
+        parser.add_argument('--change-rate', type=float, default=0.1,
+                            help="fraction of the database's mandates and payments given a new status")
+        parser.add_argument('--latency', type=float, default=0, help="seconds added to every response")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options['generate'] is not None:
+            resources = generate_resources(options['generate'], options['payments_per_mandate'],
+                                           options['seed'])
+        else:
+            resources = database_resources(options['change_rate'], options['seed'])
+        server = FakeGocardless((options['host'], options['port']), resources, options['latency'])
+        self.stdout.write("Serving {} mandates and {} payments at {} - set GOCARDLESS_BASE_URL to "
+                          "use it".format(len(resources['mandates']), len(resources['payments']), server.url))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
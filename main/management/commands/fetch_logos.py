@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from main.logos import create_thumbnail, get_fetcher
+from main.models import Space
+import logging
+
+# get instance of a logger
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = "Fetch space logos and store local thumbnails of them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help="refetch every logo, not just new or changed ones")
+
+    def handle(self, *args, **options):
+        spaces = Space.objects.exclude(logo_image_url='').only('id', 'name', 'logo_image_url')
+        if not options['all']:
+            spaces = spaces.exclude(logo_thumbnail_source=F('logo_image_url'))
+
+        fetcher = get_fetcher()
+        thumbnails = {}
+        updated = []
+        for space in spaces:
+            # lots of spaces can share a logo, only fetch each one once
+            url = space.logo_image_url
+            if url not in thumbnails:
+                try:
+                    thumbnails[url] = create_thumbnail(url, fetcher)
+                except Exception as e:
+                    logger.warning("Unable to fetch logo %s: %s", url, e)
+                    self.stdout.write("! {}: {}".format(space.name, e))
+                    thumbnails[url] = None
+            if thumbnails[url] is not None:
+                space.logo_thumbnail = thumbnails[url]
+                space.logo_thumbnail_source = url
+                updated.append(space)
+
+        # the thumbnails are synced, so the spaces are marked as changed (just before they're
+        # saved, as fetching the logos can take a while)
+        now = timezone.now()
+        for space in updated:
+            space.changed_date = now
+        with transaction.atomic():
+            Space.objects.bulk_update(updated, ['logo_thumbnail', 'logo_thumbnail_source', 'changed_date'],
+                                      batch_size=BATCH_SIZE)
+            Space.objects.data_changed()
+
+        self.stdout.write("Stored thumbnails for {} spaces".format(len(updated)))
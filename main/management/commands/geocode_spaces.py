@@ -0,0 +1,47 @@
+from decimal import Decimal
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from main.models import Space
+from main.postcodes import get_postcode_index
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = "Set the location of spaces from their postcodes, using the offline postcode index"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--overwrite', action='store_true',
+                            help="also relocate spaces that already have a location")
+
+    def handle(self, *args, **options):
+        index = get_postcode_index()
+        if index is None:
+            raise CommandError("No postcode index installed - see build_postcode_index")
+
+        spaces = Space.objects.exclude(postcode='')
+        if not options['overwrite']:
+            spaces = spaces.filter(Q(lat=0) | Q(lng=0))
+
+        located, missing = [], []
+        for space in spaces.only('id', 'name', 'postcode', 'lat', 'lng'):
+            location = index.lookup(space.postcode)
+            if location is None:
+                missing.append(space)
+                continue
+            space.lat, space.lng = (Decimal(str(value)) for value in location)
+            located.append(space)
+
+        # stamped just before they're saved, as looking up the postcodes can take a while
+        now = timezone.now()
+        for space in located:
+            space.changed_date = now
+        with transaction.atomic():
+            Space.objects.bulk_update(located, ['lat', 'lng', 'changed_date'], batch_size=BATCH_SIZE)
+            Space.objects.data_changed()
+
+        for space in missing:
+            self.stdout.write("Unknown postcode for {}: {}".format(space.name, space.postcode))
+        self.stdout.write("Located {} spaces, {} postcodes not found".format(len(located), len(missing)))
@@ -0,0 +1,151 @@
+from decimal import Decimal
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models, transaction
+from django.utils import timezone
+from main.models import Space
+import json
+import os
+import re
+
+# fields set from the import data, as space field -> (json key, default)
+FIELD_MAP = {
+    'name': ('name', ''),
+    'town': ('town', ''),
+    'country': ('country', ''),
+    'region': ('region', ''),
+    'have_premises': ('havePremises', 'No'),
+    'address_first_line': ('addressFirstLine', ''),
+    'postcode': ('postcode', ''),
+    'lat': ('lat', 0.0),
+    'lng': ('lng', 0.0),
+    'main_website_url': ('mainWebsiteUrl', ''),
+    'logo_image_url': ('logoImageUrl', ''),
+    'status': ('status', ''),
+    'email': ('contactEmail', ''),
+}
+
+DEFAULT_PATH = os.path.join(settings.BASE_DIR, 'static', 'data.json')
+
+READ_SIZE = 64 * 1024
+
+WHITESPACE = re.compile(r'\s*')
+SEPARATOR = re.compile(r'[\s,]*')
+
+
+# yield the items of a top level json array one at a time, reading the file in
+# chunks so the whole document never needs to be held in memory
+def iter_json_array(f, read_size=READ_SIZE):
+    decoder = json.JSONDecoder()
+    buffer = f.read(read_size)
+    pos = WHITESPACE.match(buffer).end()
+    if buffer[pos:pos + 1] != '[':
+        raise ValueError("Expected a json array")
+    pos += 1
+    eof = False
+    while True:
+        # keep at least a chunk's worth of unparsed data in the buffer
+        if not eof and len(buffer) - pos < read_size:
+            more = f.read(read_size)
+            eof = not more
+            buffer = buffer[pos:] + more
+            pos = 0
+
+        pos = SEPARATOR.match(buffer, pos).end()
+        if buffer[pos:pos + 1] == ']':
+            return
+        try:
+            item, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # an item bigger than a chunk - read some more and retry
+            more = f.read(read_size)
+            eof = not more
+            buffer += more
+            continue
+        yield item
+
+
+# convert an import record into space field values, cleaned the same way the model
+# would clean them so they can be compared with what's in the database
+def record_values(record):
+    values = {}
+    for field_name, (key, default) in FIELD_MAP.items():
+        value = record.get(key, default)
+        if field_name == 'have_premises':
+            value = value == 'Yes'
+        field = Space._meta.get_field(field_name)
+        value = field.to_python(value)
+        if isinstance(field, models.DecimalField):
+            value = value.quantize(Decimal(1).scaleb(-field.decimal_places))
+        values[field_name] = value
+    return values
+
+
+class Command(BaseCommand):
+    help = "Import spaces from a json file (e.g. static/data.json), creating any that don't exist"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default=DEFAULT_PATH)
+        parser.add_argument('--update', action='store_true',
+                            help="also update existing spaces (matched by name) that differ from the file")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="report what would change without saving anything")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        # load every existing space in one query
+        existing = {}
+        for space in Space.objects.only('id', *FIELD_MAP):
+            existing.setdefault(space.name, space)
+
+        created, updated, seen = [], [], set()
+        try:
+            with open(options['path'], encoding='utf-8') as f:
+                for record in iter_json_array(f):
+                    values = record_values(record)
+                    if values['name'] in seen:
+                        continue
+                    seen.add(values['name'])
+
+                    space = existing.get(values['name'])
+                    if space is None:
+                        created.append(self.new_space(values))
+                    elif options['update'] and self.update_space(space, values):
+                        updated.append(space)
+        except (OSError, ValueError, ValidationError) as e:
+            raise CommandError("Unable to import {}: {}".format(options['path'], e))
+
+        if not options['dry_run'] and (created or updated):
+            # stamped just before they're saved (not when the file was read), so the changes
+            # aren't older than the sync settle window by the time they're visible
+            now = timezone.now()
+            for space in created + updated:
+                space.changed_date = now
+            with transaction.atomic():
+                Space.objects.bulk_create(created, batch_size=options['batch_size'])
+                Space.objects.bulk_update(updated, list(FIELD_MAP) + ['changed_date'],
+                                          batch_size=options['batch_size'])
+                Space.objects.data_changed()
+
+        self.stdout.write("{}{} created, {} updated, {} unchanged".format(
+            "Dry run: " if options['dry_run'] else "",
+            len(created), len(updated), len(seen) - len(created) - len(updated)))
+
+    def new_space(self, values):
+        space = Space(**values)
+        if not space.valid_location():
+            space.locate_from_postcode()
+        self.stdout.write("+ {}".format(space.name))
+        return space
+
+    # apply values to an existing space, returns True if anything changed
+    def update_space(self, space, values):
+        changes = {k: v for k, v in values.items() if getattr(space, k) != v}
+        for field_name, value in changes.items():
+            self.stdout.write("~ {}: {} {!r} -> {!r}".format(
+                space.name, field_name, getattr(space, field_name), value))
+            setattr(space, field_name, value)
+        return bool(changes)
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from main.models import GocardlessWebhookEvent
+import time
+
+
+class Command(BaseCommand):
+    help = "Process GoCardless webhook events waiting in the inbox"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=20)
+        parser.add_argument('--watch', action='store_true',
+                            help="keep running, checking for new events every --interval seconds")
+        parser.add_argument('--interval', type=int, default=5)
+
+    def handle(self, *args, **options):
+        while True:
+            processed = 0
+            # keep going until everything that's due has been tried
+            while True:
+                count = GocardlessWebhookEvent.objects.process_due(options['batch_size'])
+                processed += count
+                if count < options['batch_size']:
+                    break
+            if processed:
+                self.stdout.write("Processed {} events".format(processed))
+            if not options['watch']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from main.models import GocardlessMandate, GocardlessPayment
+from main.models.gocardless import get_gocardless_client
+from main.utils import QueryCounter
+import time
+
+
+class Command(BaseCommand):
+    help = "Bring mandates and payments in line with the GoCardless API, e.g. after missed webhooks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help="check every mandate and payment, not just those that could still change")
+        parser.add_argument('--page-size', type=int, help="records per list request (default 500)")
+
+    def handle(self, *args, **options):
+        client = get_gocardless_client()
+        managers = (('mandates', GocardlessMandate.objects), ('payments', GocardlessPayment.objects))
+        for name, manager in managers:
+            start = time.monotonic()
+            queries = QueryCounter()
+            with connection.execute_wrapper(queries):
+                checked, updated = manager.reconcile(client, options['all'], options['page_size'])
+            self.stdout.write("{}: {} checked, {} updated in {:.2f}s ({} queries)".format(
+                name, checked, updated, time.monotonic() - start, queries.count))
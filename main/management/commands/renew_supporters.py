@@ -0,0 +1,50 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from main.models import SupporterRenewal
+import json
+import time
+
+
+class Command(BaseCommand):
+    help = "Create the yearly payments for supporter memberships that are about to expire"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--notice-days', type=int, default=14,
+                            help="renew memberships expiring within this many days")
+        parser.add_argument('--workers', type=int, default=8, help="payments to create at once")
+        parser.add_argument('--limit', type=int, help="renew at most this many memberships")
+        parser.add_argument('--report', metavar='PATH', help="write a JSON report of the run to this file")
+
+    def handle(self, *args, **options):
+        started_at = timezone.now()
+        start = time.monotonic()
+        notice = timedelta(days=options['notice_days'])
+        due = SupporterRenewal.objects.schedule(notice=notice)
+        renewals = SupporterRenewal.objects.run(options['workers'], options['limit'], notice)
+
+        counts = {status: 0 for status, name in SupporterRenewal.STATUS_CHOICES}
+        for renewal in renewals:
+            counts[renewal.status] += 1
+        self.stdout.write("{} memberships due, {} renewals tried in {:.1f}s: {}".format(
+            due, len(renewals), time.monotonic() - start,
+            ", ".join("{} {}".format(count, status) for status, count in counts.items())))
+
+        if options['report']:
+            report = {
+                'started_at': started_at.isoformat(),
+                'finished_at': timezone.now().isoformat(),
+                'due': due,
+                'counts': counts,
+                'renewals': [{
+                    'membership': renewal.membership_id,
+                    'period': renewal.period.isoformat(),
+                    'amount': str(renewal.amount),
+                    'status': renewal.status,
+                    'payment': renewal.payment_id,
+                    'attempts': renewal.attempts,
+                    'error': renewal.last_error,
+                } for renewal in renewals],
+            }
+            with open(options['report'], 'w') as f:
+                json.dump(report, f, indent=2)
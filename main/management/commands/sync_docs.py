@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+from main.docs import DOCS_REPOSITORIES, SyncError, current_path, mirror_root, sync_repo
+from main.docs_search import index_repo
+import logging
+import time
+
+# get instance of a logger
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Mirror the resources and foundation repositories into DOCS_MIRROR_ROOT"
+
+    def add_arguments(self, parser):
+        parser.add_argument('repos', nargs='*', default=DOCS_REPOSITORIES)
+        parser.add_argument('--upstream',
+                            help="tarball url or path, git repository or directory to copy from, "
+                                 "with {repo} for the repo name (default: DOCS_UPSTREAM)")
+        parser.add_argument('--watch', action='store_true',
+                            help="keep running, syncing every --interval seconds")
+        parser.add_argument('--interval', type=int, default=300)
+
+    def handle(self, *args, **options):
+        if not mirror_root():
+            raise CommandError("DOCS_MIRROR_ROOT isn't set")
+
+        while True:
+            failed = self.sync(options['repos'], options['upstream'])
+            if not options['watch']:
+                break
+            time.sleep(options['interval'])
+
+        if failed:
+            raise CommandError("Unable to sync {}".format(", ".join(failed)))
+
+    def sync(self, repos, source):
+        failed = []
+        for repo in repos:
+            try:
+                changed = sync_repo(repo, source.format(repo=repo) if source else None)
+            except SyncError as e:
+                # keep serving the existing mirror, and try again next time
+                logger.warning("%s", e)
+                self.stderr.write(str(e))
+                failed.append(repo)
+                continue
+            self.stdout.write("{}: {}".format(repo, "updated" if changed else "unchanged"))
+            # only pages that have changed are indexed again, so this is cheap when nothing has
+            indexed, removed = index_repo(repo, current_path(repo))
+            if indexed or removed:
+                self.stdout.write("{}: {} pages indexed, {} removed".format(repo, indexed, removed))
+        return failed
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-18 17:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0041_alter_user_first_name'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='space',
+            name='status',
+            field=models.CharField(choices=[('Active', 'Active'), ('Starting', 'Starting'), ('Suspended', 'Suspended'), ('Defunct', 'DEFUNCT')], db_index=True, default='ACTIVE', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='space',
+            index=models.Index(fields=['lat', 'lng'], name='space_location_idx'),
+        ),
+    ]
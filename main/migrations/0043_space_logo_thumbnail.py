@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 17:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0042_space_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='space',
+            name='logo_thumbnail',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='space',
+            name='logo_thumbnail_source',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-18 17:59
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0043_space_logo_thumbnail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpaceTombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('space_id', models.IntegerField()),
+                ('deleted_date', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'db_table': 'spacetombstone',
+            },
+        ),
+        migrations.AlterField(
+            model_name='space',
+            name='changed_date',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+    ]
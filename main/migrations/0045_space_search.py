@@ -0,0 +1,63 @@
+from django.db import migrations
+
+# Full text index over space name, town, region and postcode, maintained by the database
+# (see main/search.py). Postcodes are also indexed without their space, so "ls11ex" finds
+# "LS1 1EX".
+
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE space_search USING fts5(name, town, region, postcode, tokenize='unicode61')",
+    """CREATE TRIGGER space_search_insert AFTER INSERT ON space BEGIN
+        INSERT INTO space_search (rowid, name, town, region, postcode)
+        VALUES (new.id, new.name, new.town, new.region, new.postcode || ' ' || replace(new.postcode, ' ', ''));
+    END""",
+    """CREATE TRIGGER space_search_update AFTER UPDATE OF name, town, region, postcode ON space BEGIN
+        DELETE FROM space_search WHERE rowid = old.id;
+        INSERT INTO space_search (rowid, name, town, region, postcode)
+        VALUES (new.id, new.name, new.town, new.region, new.postcode || ' ' || replace(new.postcode, ' ', ''));
+    END""",
+    """CREATE TRIGGER space_search_delete AFTER DELETE ON space BEGIN
+        DELETE FROM space_search WHERE rowid = old.id;
+    END""",
+    """INSERT INTO space_search (rowid, name, town, region, postcode)
+        SELECT id, name, town, region, postcode || ' ' || replace(postcode, ' ', '') FROM space""",
+]
+
+SQLITE_REVERSE = [
+    "DROP TRIGGER IF EXISTS space_search_insert",
+    "DROP TRIGGER IF EXISTS space_search_update",
+    "DROP TRIGGER IF EXISTS space_search_delete",
+    "DROP TABLE IF EXISTS space_search",
+]
+
+# must match POSTGRES_VECTOR in main/search.py
+POSTGRES_FORWARD = ["""CREATE INDEX space_search_idx ON space USING GIN ((
+    setweight(to_tsvector('simple', coalesce(name, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(town, '') || ' ' || coalesce(region, '')), 'B') ||
+    setweight(to_tsvector('simple', coalesce(postcode, '') || ' ' ||
+                                    replace(coalesce(postcode, ''), ' ', '')), 'A')
+))"""]
+
+POSTGRES_REVERSE = ["DROP INDEX IF EXISTS space_search_idx"]
+
+STATEMENTS = {
+    'sqlite': (SQLITE_FORWARD, SQLITE_REVERSE),
+    'postgresql': (POSTGRES_FORWARD, POSTGRES_REVERSE),
+}
+
+
+def run_statements(direction):
+    def run(apps, schema_editor):
+        for statement in STATEMENTS.get(schema_editor.connection.vendor, ([], []))[direction]:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0044_space_sync'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_statements(0), run_statements(1)),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-18 18:12
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0045_space_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GocardlessWebhookEvent',
+            fields=[
+                ('id', models.TextField(primary_key=True, serialize=False)),
+                ('resource_type', models.TextField(blank=True)),
+                ('action', models.TextField(blank=True)),
+                ('payload', models.JSONField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processed', 'Processed'), ('failed', 'Failed')], default='pending', max_length=9)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True)),
+                ('received_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'gocardlesswebhookevent',
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='webhook_event_due_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-18 18:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0046_gocardless_webhook_event'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GocardlessWebhookWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource_type', models.TextField()),
+                ('resource_id', models.TextField()),
+                ('last_event_created_at', models.DateTimeField()),
+                ('last_event_id', models.TextField()),
+            ],
+            options={
+                'db_table': 'gocardlesswebhookwatermark',
+            },
+        ),
+        migrations.AddField(
+            model_name='gocardlesswebhookevent',
+            name='created_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='gocardlesswebhookevent',
+            name='resource_id',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AlterField(
+            model_name='gocardlesswebhookevent',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processed', 'Processed'), ('skipped', 'Skipped'), ('failed', 'Failed')], default='pending', max_length=9),
+        ),
+        migrations.AddConstraint(
+            model_name='gocardlesswebhookwatermark',
+            constraint=models.UniqueConstraint(fields=('resource_type', 'resource_id'), name='webhook_watermark_resource'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.2.30 on 2026-10-18 18:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0047_gocardless_webhook_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SupporterRenewal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=8)),
+                ('idempotency_key', models.TextField(unique=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('created', 'Created'), ('skipped', 'Skipped'), ('failed', 'Failed')], default='pending', max_length=7)),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'supporterrenewal',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='supportermembership',
+            index=models.Index(fields=['status', 'expired_at'], name='supporter_expiry_idx'),
+        ),
+        migrations.AddField(
+            model_name='supporterrenewal',
+            name='membership',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='renewals', to='main.supportermembership'),
+        ),
+        migrations.AddField(
+            model_name='supporterrenewal',
+            name='payment',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='main.gocardlesspayment'),
+        ),
+        migrations.AddConstraint(
+            model_name='supporterrenewal',
+            constraint=models.UniqueConstraint(fields=('membership', 'period'), name='supporter_renewal_period'),
+        ),
+    ]
@@ -1,13 +1,19 @@
 from .user import User, SpaceUserManager
-from .space import Space, SpaceManager
+from .space import Space, SpaceManager, SpaceTombstone
 from .supporter_membership import SupporterMembership, SupporterMembershipManager
 from .gocardless_mandate import GocardlessMandate, GocardlessMandateManager
 from .gocardless_payment import GocardlessPayment, GocardlessPaymentManager
+from .gocardless_webhook_event import GocardlessWebhookEvent, GocardlessWebhookEventManager
+from .gocardless_webhook_event import GocardlessWebhookWatermark, GocardlessWebhookWatermarkManager
+from .supporter_renewal import SupporterRenewal, SupporterRenewalManager
 
 __all__ = [
     'User', 'SpaceUserManager',
-    'Space', 'SpaceManager',
+    'Space', 'SpaceManager', 'SpaceTombstone',
     'SupporterMembership', 'SupporterMembershipManager',
     'GocardlessMandate', 'GocardlessMandateManager',
-    'GocardlessPayment', 'GocardlessPaymentManager'
+    'GocardlessPayment', 'GocardlessPaymentManager',
+    'GocardlessWebhookEvent', 'GocardlessWebhookEventManager',
+    'GocardlessWebhookWatermark', 'GocardlessWebhookWatermarkManager',
+    'SupporterRenewal', 'SupporterRenewalManager'
 ]
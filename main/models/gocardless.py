@@ -1,14 +1,255 @@
 from django.conf import settings
+from django.db import models, transaction
+from gocardless_pro.api_client import ApiClient
+from gocardless_pro.rate_limit import update_rate_limit
+from datetime import timedelta
+from requests.adapters import HTTPAdapter
 import gocardless_pro
+import json
+import logging
+import random
+import requests
+import threading
+import time
+
+# get instance of a logger
+logger = logging.getLogger(__name__)
+
+# One GoCardless client is shared by the whole process (it's created on first use), so
+# connections to the API are kept open and reused. Every request has a timeout, and
+# idempotent ones - fetches, updates and creates (which carry an Idempotency-Key) - are
+# retried with jittered backoff if they fail with a network error or a server error.
+# If the API keeps failing, a circuit breaker fails requests straight away for a while
+# instead of leaving every worker waiting on timeouts.
+#
+# gocardless_pro's own ApiClient makes each request with a bare requests.get/post, so it's
+# swapped for one that does the above. The services' own retries (on ConnectionError,
+# Timeout and MalformedResponseError) are avoided by raising GocardlessUnavailable instead.
+
+# (connect, read) timeouts
+TIMEOUT = (3.05, 20)
+
+# connections kept open to the api, per process
+POOL_SIZE = 10
+
+# tries for an idempotent request, waiting up to RETRY_DELAY before the first retry and
+# doubling after that
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 0.5
+
+# open the circuit after this many failures in a row, then let a trial request through
+# after BREAKER_RESET seconds
+BREAKER_THRESHOLD = 5
+BREAKER_RESET = 30
+
+# the most the list endpoints return at once
+LIST_PAGE_SIZE = 500
+
+# rows per query when bulk updating
+BULK_UPDATE_BATCH = 500
+
+# our created_at is when we stored a row (in local time), not when GoCardless created it, so
+# reconciling starts a little before it
+RECONCILE_MARGIN = timedelta(days=1)
+
+
+class GocardlessUnavailable(Exception):
+    pass
+
+
+class CircuitOpen(GocardlessUnavailable):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    # may a request be made? once the circuit has been open for reset_timeout, one trial
+    # request at a time is let through
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or time.monotonic() < self.opened_at + self.reset_timeout:
+                return False
+            self.trial = True
+            return True
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    # the trial request (if this was one) is over, however it ended
+    def finished(self):
+        with self.lock:
+            self.trial = False
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning("GoCardless failed %s times in a row, failing fast for %ss",
+                                   self.failures, self.reset_timeout)
+                self.opened_at = time.monotonic()
+
+
+# can a request safely be sent twice? actions (cancel, complete, ...) can't
+def is_idempotent(method, path, headers):
+    if method in ('GET', 'PUT'):
+        return True
+    return method == 'POST' and 'Idempotency-Key' in headers and '/actions/' not in path
+
+
+class PooledApiClient(ApiClient):
+    def __init__(self, base_url, access_token):
+        super(PooledApiClient, self).__init__(base_url, access_token)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_RESET)
+
+    @update_rate_limit
+    def get(self, path, params=None, headers=None):
+        return self.request('GET', path, headers, params=params)
+
+    @update_rate_limit
+    def post(self, path, body, headers=None):
+        return self.request('POST', path, headers, data=json.dumps(body))
+
+    @update_rate_limit
+    def put(self, path, body, headers=None):
+        return self.request('PUT', path, headers, data=json.dumps(body))
+
+    @update_rate_limit
+    def delete(self, path, body, headers=None):
+        return self.request('DELETE', path, headers, data=json.dumps(body))
+
+    # make a request, retrying idempotent ones. raises GocardlessUnavailable if the api
+    # can't be reached, or the api's error for a 4xx
+    def request(self, method, path, headers, **kwargs):
+        headers = self._headers(headers)
+        attempts = MAX_ATTEMPTS if is_idempotent(method, path, headers) else 1
+        for attempt in range(1, attempts + 1):
+            if attempt > 1:
+                time.sleep(random.uniform(0, RETRY_DELAY * 2 ** (attempt - 2)))
+            try:
+                response = self.send(method, path, headers, **kwargs)
+            except CircuitOpen:
+                raise
+            except GocardlessUnavailable:
+                if attempt == attempts:
+                    raise
+            else:
+                self._handle_errors(response)
+                return response
+
+    # make one request, raises GocardlessUnavailable if it fails with a network error or a
+    # server error, or if the circuit is open
+    def send(self, method, path, headers, **kwargs):
+        if not self.breaker.allow():
+            raise CircuitOpen("GoCardless is unavailable, not trying again yet")
+        try:
+            try:
+                response = self.session.request(method, self._url_for(path), headers=headers,
+                                                timeout=TIMEOUT, **kwargs)
+            except requests.RequestException as e:
+                self.breaker.failed()
+                raise GocardlessUnavailable("Unable to reach GoCardless: {}".format(e)) from e
+            if response.status_code >= 500:
+                self.breaker.failed()
+                raise GocardlessUnavailable("GoCardless returned {}".format(response.status_code))
+            self.breaker.succeeded()
+            return response
+        finally:
+            # an unexpected error mustn't leave the circuit half open for good
+            self.breaker.finished()
+
+
+class GocardlessClient(gocardless_pro.Client):
+    def __init__(self, access_token, environment, base_url=None):
+        super(GocardlessClient, self).__init__(access_token=access_token, environment=environment,
+                                               base_url=base_url)
+        self._api_client = PooledApiClient(self._api_client.base_url, access_token)
+        self.config = (access_token, environment, base_url)
+
+
+# the client shared by this process
+client = None
+client_lock = threading.Lock()
 
 
 # utility functions:
 def get_gocardless_client():
+    global client
     if not getattr(settings, "GOCARDLESS_ACCESS_TOKEN", None) or not getattr(
         settings, "GOCARDLESS_ENVIRONMENT", None
     ):
         raise Exception("No GoCardless credentials configured")
-    return gocardless_pro.Client(
-        access_token=settings.GOCARDLESS_ACCESS_TOKEN,
-        environment=settings.GOCARDLESS_ENVIRONMENT,
-    )
+    # GOCARDLESS_BASE_URL overrides the environment's url, e.g. to use the fake server
+    config = (settings.GOCARDLESS_ACCESS_TOKEN, settings.GOCARDLESS_ENVIRONMENT,
+              getattr(settings, "GOCARDLESS_BASE_URL", None) or None)
+    with client_lock:
+        if client is None or client.config != config:
+            client = GocardlessClient(*config)
+        return client
+
+
+# yield the pages of records from a list endpoint (e.g. client.mandates), following the
+# cursors from one page to the next
+def list_pages(service, params=None, page_size=None):
+    params = dict(params or {}, limit=page_size or LIST_PAGE_SIZE)
+    while True:
+        page = service.list(params=params)
+        yield page.records
+        if not page.after:
+            return
+        params['after'] = page.after
+
+
+# list params for the records created since the oldest row in a queryset, or None if it's
+# empty
+def created_since(queryset):
+    oldest = queryset.aggregate(oldest=models.Min('created_at'))['oldest']
+    if oldest is None:
+        return None
+    return {'created_at[gte]': (oldest - RECONCILE_MARGIN).strftime('%Y-%m-%dT%H:%M:%SZ')}
+
+
+# bring the rows of a model in line with pages of api records, matched on id. update(obj,
+# record) copies a record onto its row and returns the names of the fields it changed. rows
+# with a new status are saved one at a time, so their status change handling happens, the
+# rest are bulk updated. api records without a row are ignored. returns (checked, updated)
+def reconcile_pages(model, pages, update):
+    checked = updated = 0
+    for records in pages:
+        with transaction.atomic():
+            rows = model.objects.in_bulk([record.id for record in records])
+            bulk, fields = [], set()
+            for record in records:
+                obj = rows.get(record.id)
+                if obj is None:
+                    continue
+                checked += 1
+                changed = update(obj, record)
+                if not changed:
+                    continue
+                updated += 1
+                if 'status' in changed:
+                    obj.save()
+                else:
+                    bulk.append(obj)
+                    fields |= changed
+            if bulk:
+                model.objects.bulk_update(bulk, sorted(fields), batch_size=BULK_UPDATE_BATCH)
+    return checked, updated
@@ -1,13 +1,17 @@
 from django.db import models
 from django.utils import timezone
+from gocardless_pro.errors import IdempotentCreationConflictError
 import logging
 import uuid
 from .gocardless_payment import GocardlessPayment
-from .gocardless import get_gocardless_client
+from .gocardless import get_gocardless_client, created_since, list_pages, reconcile_pages
 
 # get instance of a logger
 logger = logging.getLogger(__name__)
 
+# mandates in these states won't change again, so needn't be reconciled
+FINAL_MANDATE_STATUSES = ('cancelled', 'expired', 'failed', 'consumed', 'blocked')
+
 
 class GocardlessMandateManager(models.Manager):
 
@@ -55,37 +59,57 @@ class GocardlessMandateManager(models.Manager):
             logger.exception("Exception creating payment", extra={'payload': payload})
             return None
 
-    def process_mandate_from_webhook(self, event, response):
+    # get latest mandate info from api
+    def fetch_mandate(self, client, mandate_id):
+        return client.mandates.get(mandate_id)
+
+    # called (via the webhook inbox) for each mandate event, with the mandate info if it has
+    # already been fetched. API errors are raised, so the event is retried later
+    def process_mandate_from_webhook(self, event, info=None):
         # best to ignore the event itself and just fetch latest status via the api
         # this is in case the webhook event is received out of order
 
         logger.info("Processing mandate id:{}".format(event['links']['mandate']))
 
-        client = get_gocardless_client()
+        if info is None:
+            info = self.fetch_mandate(get_gocardless_client(), event['links']['mandate'])
 
-        # get latest mandate info from api
+        # get matching mandate object from DB
         try:
-            info = client.mandates.get(event['links']['mandate'])
-
-            # get matching mandate object from DB
-            try:
-                mandate = super(GocardlessMandateManager, self).get_queryset().get(
-                    id=event['links']['mandate'])
-
-                # save changes to object - this will also trigger internal handling
-                mandate.status = info.status
-                mandate.save()
-
-            except GocardlessMandate.DoesNotExist:
-                # shouldn't happen - just flag the error for now
-                # TODO: perhaps send an email to admin?
-                logger.exception("Mandate object not found", extra={'event': event})
-
-        except Exception:
-            # odd - this should always be possible, perhaps there was a connection error
-            logger.error("Exception fetching mandate info", extra={'event': event})
-
-        return response
+            mandate = super(GocardlessMandateManager, self).get_queryset().get(
+                id=event['links']['mandate'])
+
+            # save changes to object - this will also trigger internal handling
+            mandate.status = info.status
+            mandate.save()
+
+        except GocardlessMandate.DoesNotExist:
+            # shouldn't happen - just flag the error for now
+            # TODO: perhaps send an email to admin?
+            logger.exception("Mandate object not found", extra={'event': event})
+
+    # copy mandate info from the api onto a mandate, returns the names of the fields changed
+    def update_from_api(self, mandate, info):
+        changed = set()
+        for field in ('status', 'reference'):
+            value = getattr(info, field) or ''
+            if getattr(mandate, field) != value:
+                setattr(mandate, field, value)
+                changed.add(field)
+        return changed
+
+    # bring mandates in line with the api, e.g. after missed webhooks. only mandates created
+    # since the oldest one that could still change are listed, unless everything is asked for.
+    # returns (mandates checked, mandates updated)
+    def reconcile(self, client, everything=False, page_size=None):
+        params = {}
+        if not everything:
+            params = created_since(super(GocardlessMandateManager, self).get_queryset().exclude(
+                status__in=FINAL_MANDATE_STATUSES))
+            if params is None:
+                return 0, 0
+        pages = list_pages(client.mandates, params, page_size)
+        return reconcile_pages(GocardlessMandate, pages, self.update_from_api)
 
 
 class GocardlessMandate(models.Model):
@@ -115,7 +139,7 @@ class GocardlessMandate(models.Model):
         super(GocardlessMandate, self).__init__(*args, **kwargs)
         self.old_status = self.status
 
-    def save(self, force_insert=False, force_update=False):
+    def save(self, force_insert=False, force_update=False, using=None):
         if self.status != self.old_status:
             # status has changed...  so need to act on it:
             # TODO: something useful
@@ -124,7 +148,7 @@ class GocardlessMandate(models.Model):
             if self.supporter_membership is not None:
                 self.supporter_membership.handle_mandate_updated(self)
 
-        super(GocardlessMandate, self).save(force_insert, force_update)
+        super(GocardlessMandate, self).save(force_insert, force_update, using)
         self.old_status = self.status
 
     # is_supporter_mandate
@@ -163,35 +187,47 @@ class GocardlessMandate(models.Model):
     def payment(self):
         return self.payments().latest('created_at')
 
-    def create_payment(self, amount):
+    # the api request for a payment against this mandate
+    def payment_params(self, amount):
+        return {
+            "amount": int(amount * 100),  # convert to pence
+            "currency": "GBP",
+            "links": {
+                "mandate": self.id
+            },
+            "metadata": {
+                "type": "SupporterSubscription"
+                # TODO: decide if we want to add metadata to the payment
+            }
+        }
+
+    # create a payment via the api (without touching the database, so it's safe to call from
+    # other threads). sending the same idempotency key again returns the payment it created
+    # the first time. will throw GoCardless exceptions
+    def send_payment(self, client, amount, key):
+        try:
+            payment = client.payments.create(params=self.payment_params(amount),
+                                             headers={'Idempotency-Key': key})
+        except IdempotentCreationConflictError as e:
+            payment = client.payments.get(e.conflicting_resource_id)
+        payment.idempotency_key = key
+        return payment
+
+    def create_payment(self, amount, idempotency_key=None):
         if not self.is_active():
             raise RuntimeError("Request to create_payment for an inactive mandate")
 
         # get gocardless client object
         client = get_gocardless_client()
 
-        # generate idempotency key
-        key = uuid.uuid4().hex
+        # generate idempotency key, unless the caller has one to reuse
+        key = idempotency_key or uuid.uuid4().hex
 
         try:
             # create payment
-            payment = client.payments.create(
-                params={
-                    "amount": int(amount * 100),  # convert to pence
-                    "currency": "GBP",
-                    "links": {
-                        "mandate": self.id
-                    },
-                    "metadata": {
-                        "type": "SupporterSubscription"
-                        # TODO: decide if we want to add metadata to the payment
-                    }
-                }, headers={
-                    'Idempotency-Key': key
-                })
+            payment = self.send_payment(client, amount, key)
 
             # Store payment object
-            payment.idempotency_key = key
             obj = GocardlessPayment.objects.get_or_create_from_payload(payment, self)
 
             return obj
@@ -1,13 +1,21 @@
 from django.db import models
 from django.utils import timezone
+from datetime import date, timedelta
 import logging
 
-from .gocardless import get_gocardless_client
+from .gocardless import get_gocardless_client, created_since, list_pages, reconcile_pages
 
 # get instance of a logger
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# payments in these states won't change again, so needn't be reconciled
+FINAL_PAYMENT_STATUSES = ('cancelled', 'failed', 'charged_back', 'customer_approval_denied')
+
+# a paid out payment can still be charged back, but after this long it's treated as final
+# too - otherwise every reconcile would list all the payments back to the oldest one
+CHARGE_BACK_WINDOW = timedelta(weeks=8)
+
 
 class GocardlessPaymentManager(models.Manager):
     # get_or_create that populates fields from json
@@ -43,39 +51,65 @@ class GocardlessPaymentManager(models.Manager):
             logger.exception("Exception creating payment", extra={'payload': payload})
             return None
 
-    def process_payment_from_webhook(self, event, response):
+    # get latest payment info from api
+    def fetch_payment(self, client, payment_id):
+        return client.payments.get(payment_id)
+
+    # called (via the webhook inbox) for each payment event, with the payment info if it has
+    # already been fetched. API errors are raised, so the event is retried later
+    def process_payment_from_webhook(self, event, info=None):
         # best to ignore the event itself and just fetch latest status via the api
         # this is in case the webhook event is received out of order
 
         logger.info("Processing payment id:{}".format(event['links']['payment']))
 
-        client = get_gocardless_client()
+        if info is None:
+            info = self.fetch_payment(get_gocardless_client(), event['links']['payment'])
 
-        # get latest payment info from api
+        # get matching payment object from DB
         try:
-            info = client.payments.get(event['links']['payment'])
-
-            # get matching payment object from DB
-            try:
-                payment = super(GocardlessPaymentManager, self).get_queryset().get(
-                    id=event['links']['payment'])
-
-                # save changes to object - this will also trigger internal handling
-                payment.status = info.status
-                payment.charge_date = info.charge_date
-                payment.description = event['details']['description']
-                payment.save()
-
-            except GocardlessPayment.DoesNotExist:
-                # odd...  log error
-                # TODO: perhaps email admin to flag issue
-                logger.exception("Payment object not found", extra={'event': event})
-
-        except Exception:
-            # odd - this should always be possible, perhaps there was a connection error
-            logger.exception("Exception fetching payment info", extra={'event': event})
-
-        return response
+            payment = super(GocardlessPaymentManager, self).get_queryset().get(
+                id=event['links']['payment'])
+
+            # save changes to object - this will also trigger internal handling
+            payment.status = info.status
+            payment.charge_date = info.charge_date
+            payment.description = event['details']['description']
+            payment.save()
+
+        except GocardlessPayment.DoesNotExist:
+            # odd...  log error
+            # TODO: perhaps email admin to flag issue
+            logger.exception("Payment object not found", extra={'event': event})
+
+    # copy payment info from the api onto a payment, returns the names of the fields changed
+    def update_from_api(self, payment, info):
+        values = {
+            'status': info.status,
+            'amount_refunded': info.amount_refunded or 0,
+            'charge_date': date.fromisoformat(info.charge_date) if info.charge_date else payment.charge_date,
+        }
+        changed = set()
+        for field, value in values.items():
+            if getattr(payment, field) != value:
+                setattr(payment, field, value)
+                changed.add(field)
+        return changed
+
+    # bring payments in line with the api, e.g. after missed webhooks. only payments created
+    # since the oldest one that could still change (ignoring paid out payments older than
+    # CHARGE_BACK_WINDOW) are listed, unless everything is asked for.
+    # returns (payments checked, payments updated)
+    def reconcile(self, client, everything=False, page_size=None):
+        params = {}
+        if not everything:
+            params = created_since(super(GocardlessPaymentManager, self).get_queryset().exclude(
+                status__in=FINAL_PAYMENT_STATUSES).exclude(
+                status='paid_out', created_at__lt=timezone.now() - CHARGE_BACK_WINDOW))
+            if params is None:
+                return 0, 0
+        pages = list_pages(client.payments, params, page_size)
+        return reconcile_pages(GocardlessPayment, pages, self.update_from_api)
 
 
 class GocardlessPayment(models.Model):
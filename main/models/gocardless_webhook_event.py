@@ -0,0 +1,265 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from datetime import timedelta, timezone as dt_timezone
+import logging
+from .gocardless_mandate import GocardlessMandate
+from .gocardless_payment import GocardlessPayment
+from .gocardless import get_gocardless_client
+
+# get instance of a logger
+logger = logging.getLogger(__name__)
+
+# give up on an event after this many attempts
+MAX_ATTEMPTS = 8
+
+# wait this long before the first retry, doubling for each attempt after that
+RETRY_DELAY = timedelta(minutes=1)
+MAX_RETRY_DELAY = timedelta(hours=6)
+
+# how long a worker has to process the events it claims, before they can be claimed again
+CLAIM_LEASE = timedelta(minutes=5)
+
+# how to fetch each type of resource from the api, given a client and the resource id
+RESOURCE_FETCHERS = {
+    'mandates': GocardlessMandate.objects.fetch_mandate,
+    'payments': GocardlessPayment.objects.fetch_payment,
+}
+
+
+# when an event was created, as a naive utc datetime, or None
+def event_created_at(event):
+    try:
+        created_at = parse_datetime(event.get('created_at') or '')
+    except ValueError:
+        return None
+    if created_at is not None and timezone.is_aware(created_at):
+        created_at = timezone.make_naive(created_at, dt_timezone.utc)
+    return created_at
+
+
+# the id of the resource an event is about, e.g. the mandate id for a mandates event
+def event_resource_id(event):
+    return (event.get('links') or {}).get(event.get('resource_type', '').rstrip('s'), '')
+
+
+# how many api requests to make at once when processing a batch of events
+def fetch_threads():
+    return getattr(settings, "GOCARDLESS_FETCH_THREADS", 8)
+
+
+# fetch the latest state of resources, given (resource_type, resource_id) pairs, several
+# at a time over one client. returns a dict of each pair to its info, or to the exception
+# raised fetching it
+def fetch_resources(keys):
+    if not keys:
+        return {}
+    try:
+        client = get_gocardless_client()
+    except Exception as e:
+        return {key: e for key in keys}
+
+    def fetch(key):
+        try:
+            return RESOURCE_FETCHERS[key[0]](client, key[1])
+        except Exception as e:
+            return e
+    with ThreadPoolExecutor(max_workers=min(fetch_threads(), len(keys))) as pool:
+        return dict(zip(keys, pool.map(fetch, keys)))
+
+
+class GocardlessWebhookEventManager(models.Manager):
+
+    # store the events from a webhook to be processed later. GoCardless resends webhooks
+    # that fail, so events we already have are ignored
+    def receive(self, events):
+        now = timezone.now()
+        super(GocardlessWebhookEventManager, self).bulk_create([
+            GocardlessWebhookEvent(id=event['id'], resource_type=event.get('resource_type', ''),
+                                   resource_id=event_resource_id(event), action=event.get('action', ''),
+                                   created_at=event_created_at(event), payload=event,
+                                   received_at=now, next_attempt_at=now)
+            for event in events], ignore_conflicts=True)
+
+    # events waiting to be processed, oldest first
+    def due(self):
+        return super(GocardlessWebhookEventManager, self).get_queryset().filter(
+            status=GocardlessWebhookEvent.PENDING, next_attempt_at__lte=timezone.now()
+        ).order_by('next_attempt_at', 'received_at')
+
+    # claim up to limit due events, by moving them out of the due queue for CLAIM_LEASE. the
+    # rows are only locked while they're claimed, and locked rows are skipped, so several
+    # workers can claim events at once. if a worker dies its events are retried once their
+    # lease is up
+    def claim(self, limit=100):
+        with transaction.atomic():
+            events = list(self.due().select_for_update(skip_locked=True)[:limit])
+            lease_until = timezone.now() + CLAIM_LEASE
+            super(GocardlessWebhookEventManager, self).get_queryset().filter(
+                id__in=[event.id for event in events]).update(next_attempt_at=lease_until)
+        for event in events:
+            event.next_attempt_at = lease_until
+        return events
+
+    # process up to limit due events, returns how many were claimed. the events' resources
+    # are fetched outside of any transaction, so no locks are held while waiting on the api,
+    # then each event is applied in its own transaction
+    def process_due(self, limit=100):
+        events = self.claim(limit)
+        # newest first, so older events for the same resource are skipped as stale
+        events.sort(key=lambda event: event.created_at or event.received_at, reverse=True)
+        # fetch each resource once, all at once, then apply the events one at a time
+        fetched = fetch_resources(self.resources_to_fetch(events))
+        for event in events:
+            with transaction.atomic():
+                if event.is_claimed():
+                    event.process(fetched.get((event.resource_type, event.resource_id)))
+        return len(events)
+
+    # the (resource_type, resource_id) pairs a batch of events (newest first) needs to fetch -
+    # those whose newest event isn't stale
+    def resources_to_fetch(self, events):
+        newest = {}
+        for event in events:
+            if event.resource_type in RESOURCE_FETCHERS and event.resource_id:
+                newest.setdefault((event.resource_type, event.resource_id), event)
+        watermarks = {
+            (watermark.resource_type, watermark.resource_id): watermark.last_event_created_at
+            for watermark in GocardlessWebhookWatermark.objects.filter(
+                resource_id__in={resource_id for resource_type, resource_id in newest})
+        }
+        return [key for key, event in newest.items()
+                if event.created_at is None or key not in watermarks or event.created_at > watermarks[key]]
+
+
+class GocardlessWebhookWatermarkManager(models.Manager):
+
+    # record that a resource is up to date as of an event, unless a later one was already
+    # recorded
+    def advance(self, resource_type, resource_id, created_at, event_id):
+        queryset = super(GocardlessWebhookWatermarkManager, self).get_queryset()
+        updated = queryset.filter(resource_type=resource_type, resource_id=resource_id,
+                                  last_event_created_at__lt=created_at).update(
+            last_event_created_at=created_at, last_event_id=event_id)
+        if not updated:
+            queryset.bulk_create([GocardlessWebhookWatermark(
+                resource_type=resource_type, resource_id=resource_id,
+                last_event_created_at=created_at, last_event_id=event_id)], ignore_conflicts=True)
+
+
+class GocardlessWebhookEvent(models.Model):
+    PENDING = 'pending'
+    PROCESSED = 'processed'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (PROCESSED, 'Processed'),
+        (SKIPPED, 'Skipped'),  # a later event for the same resource was already processed
+        (FAILED, 'Failed'),  # gave up after MAX_ATTEMPTS
+    )
+
+    # the event id from GoCardless, e.g. EV123
+    id = models.TextField(primary_key=True)
+    resource_type = models.TextField(blank=True)
+    # e.g. the mandate id for a mandates event
+    resource_id = models.TextField(blank=True)
+    action = models.TextField(blank=True)
+    # when GoCardless created the event (utc)
+    created_at = models.DateTimeField(blank=True, null=True)
+    payload = models.JSONField()
+    status = models.CharField(max_length=9, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    received_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    objects = GocardlessWebhookEventManager()
+
+    class Meta:
+        db_table = 'gocardlesswebhookevent'
+        app_label = 'main'
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='webhook_event_due_idx'),
+        ]
+
+    def __str__(self):
+        return '{} - {} {} - {}'.format(self.id, self.resource_type, self.action, self.status)
+
+    # is the event still claimed by this worker? locks it if it is. if the claim's lease ran
+    # out another worker may have claimed (or even processed) it since
+    def is_claimed(self):
+        return GocardlessWebhookEvent.objects.select_for_update().filter(
+            id=self.id, status=self.PENDING, next_attempt_at=self.next_attempt_at).exists()
+
+    # is a later event for the same resource already processed? the handlers fetch the
+    # resource's latest state, so this event wouldn't tell us anything new
+    def is_stale(self):
+        if not self.resource_id or self.created_at is None:
+            return False
+        watermark = GocardlessWebhookWatermark.objects.select_for_update().filter(
+            resource_type=self.resource_type, resource_id=self.resource_id).first()
+        return watermark is not None and self.created_at <= watermark.last_event_created_at
+
+    # apply the event, given the latest info for its resource if it has been fetched (or the
+    # exception fetching it raised), retrying later (with backoff) if it fails
+    def process(self, info=None):
+        self.attempts += 1
+        try:
+            # savepoint, so a failure only rolls back this event's changes
+            with transaction.atomic():
+                if self.is_stale():
+                    self.status = self.SKIPPED
+                    self.processed_at = timezone.now()
+                    self.save()
+                    return
+                if isinstance(info, Exception):
+                    raise info
+                if self.resource_type == 'mandates':
+                    GocardlessMandate.objects.process_mandate_from_webhook(self.payload, info)
+                elif self.resource_type == 'payments':
+                    GocardlessPayment.objects.process_payment_from_webhook(self.payload, info)
+                else:
+                    logger.info("Don't know how to process an event with resource_type %s",
+                                self.resource_type)
+                if self.resource_id and self.created_at is not None:
+                    GocardlessWebhookWatermark.objects.advance(self.resource_type, self.resource_id,
+                                                               self.created_at, self.id)
+        except Exception as e:
+            logger.exception("Error processing webhook event %s", self.id)
+            self.last_error = '{}: {}'.format(type(e).__name__, e)
+            if self.attempts >= MAX_ATTEMPTS:
+                self.status = self.FAILED
+            else:
+                self.next_attempt_at = timezone.now() + min(RETRY_DELAY * 2 ** (self.attempts - 1),
+                                                            MAX_RETRY_DELAY)
+        else:
+            self.status = self.PROCESSED
+            self.processed_at = timezone.now()
+            self.last_error = ''
+        self.save()
+
+
+# the latest event processed for each resource, so older and repeated events can be
+# skipped without asking GoCardless about them
+class GocardlessWebhookWatermark(models.Model):
+    resource_type = models.TextField()
+    resource_id = models.TextField()
+    last_event_created_at = models.DateTimeField()
+    last_event_id = models.TextField()
+
+    objects = GocardlessWebhookWatermarkManager()
+
+    class Meta:
+        db_table = 'gocardlesswebhookwatermark'
+        app_label = 'main'
+        constraints = [
+            models.UniqueConstraint(fields=['resource_type', 'resource_id'],
+                                    name='webhook_watermark_resource'),
+        ]
+
+    def __str__(self):
+        return '{} {} - {}'.format(self.resource_type, self.resource_id, self.last_event_id)
@@ -1,10 +1,119 @@
-from django.db import models
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.db import models, transaction
+from django.db.models import Max, Q
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils import timezone
+from datetime import datetime, timedelta
+from decimal import Decimal
+from itertools import groupby
+import base64
+import hashlib
+import json
 import logging
+import uuid
+from ..geo import cluster_features, lng_lat_to_pixel, tile_bbox, TILE_SIZE, SpatialIndex
+from .. import mvt
+from ..postcodes import geocode
+from ..logos import logo_url
+from ..search import search_space_ids, PrefixIndex
 
 # get instance of a logger
 logger = logging.getLogger(__name__)
 
+# cache key holding the current version of the space data - anything cached from
+# the space table should be keyed on this so it is invalidated when a Space changes
+DATA_VERSION_KEY = 'spaces:version'
+
+# how long to hold on to cached space documents (they are keyed on the data version,
+# so this only controls how long orphaned versions linger)
+DOCUMENT_CACHE_TIMEOUT = 60 * 60 * 24
+
+# the columns needed to work out which logo url to show, in logo_url() argument order
+LOGO_FIELDS = ('logo_image_url', 'logo_thumbnail', 'logo_thumbnail_source')
+
+# columns needed to build a geojson feature, in geojson_feature() argument order
+GEOJSON_FIELDS = ('lng', 'lat', 'name', 'main_website_url', 'status') + LOGO_FIELDS
+
+# how many features to serialise per chunk when streaming geojson
+GEOJSON_CHUNK_SIZE = 200
+
+# statuses of the spaces shown on the homepage map
+MAP_STATUSES = ('Active', 'Starting')
+
+# statuses of the spaces listed in each section of the homepage directory
+DIRECTORY_STATUSES = {
+    'active': ('Active', 'Starting'),
+    'inactive': ('Defunct', 'Suspended'),
+}
+
+# space fields needed to list a space in the homepage directory
+DIRECTORY_FIELDS = ('name', 'country', 'region', 'main_website_url', 'status') + LOGO_FIELDS
+
+# space fields included in spaces.json
+JSON_FIELDS = ('name', 'lat', 'lng', 'main_website_url', 'status') + LOGO_FIELDS
+
+# space fields included in the change feed
+SYNC_FIELDS = ('id', 'name', 'town', 'country', 'region', 'postcode', 'have_premises', 'lat', 'lng',
+               'main_website_url', 'status', 'changed_date') + LOGO_FIELDS
+
+# space fields included in search results
+SEARCH_FIELDS = ('id', 'name', 'town', 'country', 'region', 'postcode', 'lat', 'lng',
+                 'main_website_url', 'status') + LOGO_FIELDS
+
+# space fields included in autocomplete suggestions
+AUTOCOMPLETE_FIELDS = ('id', 'name', 'town', 'status')
+
+# the kinds of change in the change feed - at the same timestamp updates sort first
+SYNC_UPDATE = 0
+SYNC_DELETE = 1
+
+# how far outside each vector tile (as a fraction of the tile size) to include spaces,
+# so markers straddling a tile edge are drawn in both tiles
+VECTOR_TILE_BUFFER = 0.1
+
+# in-process structures built from the space data, as name -> (data version, value)
+in_process_cache = {}
+
+
+def geojson_feature(lng, lat, name, url, status, *logo):
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "Point",
+            "coordinates": [float(lng), float(lat)]
+        },
+        "properties": {
+            "name": name,
+            "url": url,
+            "status": status,
+            "logo": logo_url(*logo)
+        }
+    }
+
+
+# cursors are opaque to clients, but are really the (timestamp, kind, id) of the last
+# change they have seen
+def encode_sync_cursor(timestamp, kind, id):
+    value = json.dumps([timestamp.isoformat(), kind, id]).encode('utf-8')
+    return base64.urlsafe_b64encode(value).decode('ascii').rstrip('=')
+
+
+# raises ValueError for a cursor we didn't make
+def decode_sync_cursor(cursor):
+    try:
+        value = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return (datetime.fromisoformat(value[0]), int(value[1]), int(value[2]))
+    except (TypeError, IndexError, ValueError) as e:
+        raise ValueError("Invalid cursor: {}".format(e))
+
+
+# replace the logo fields of a space values() dict with the logo url to show
+def with_logo_url(space):
+    space['logo_image_url'] = logo_url(*(space.pop(field) for field in LOGO_FIELDS))
+    return space
+
 
 class SpaceManager(models.Manager):
     def active_spaces(self):
@@ -15,22 +124,210 @@ class SpaceManager(models.Manager):
         return super(SpaceManager, self).get_queryset().filter(status="Defunct") | \
             super(SpaceManager, self).get_queryset().filter(status="Suspended")
 
+    # get the current space data version (an opaque token)
+    def data_version(self):
+        return cache.get_or_set(DATA_VERSION_KEY, lambda: uuid.uuid4().hex, None)
+
+    # move to a new data version, orphaning everything cached against the old one
+    def bump_data_version(self):
+        cache.set(DATA_VERSION_KEY, uuid.uuid4().hex, None)
+
+    # called whenever space data changes - bump the version now, and again once the
+    # transaction commits so that nothing cached from uncommitted data outlives it
+    def data_changed(self):
+        self.bump_data_version()
+        transaction.on_commit(self.bump_data_version)
+
+    # when was any space last changed (or None if there are no spaces)
+    # (deletions count too, so a deletion moves this forwards)
+    def last_changed(self):
+        changed = super(SpaceManager, self).get_queryset().aggregate(Max('changed_date'))['changed_date__max']
+        deleted = SpaceTombstone.objects.aggregate(Max('deleted_date'))['deleted_date__max']
+        return max(filter(None, (changed, deleted)), default=None)
+
+    # get a value derived from the space data, calling build() to create it if there
+    # isn't one cached (in store, the default cache unless given) for the current data
+    # version
+    def cached(self, name, build, store=None):
+        store = store or cache
+        key = 'spaces:{}:{}'.format(name, self.data_version())
+        value = store.get(key)
+        if value is None:
+            value = build()
+            store.set(key, value, DOCUMENT_CACHE_TIMEOUT)
+        return value
+
+    # like cached(), but held in this process - for structures that are too expensive
+    # to unpickle from the cache on every request (e.g. search indexes)
+    def in_process(self, name, build):
+        version = self.data_version()
+        cached_version, value = in_process_cache.get(name, (None, None))
+        if cached_version != version:
+            value = build()
+            in_process_cache[name] = (version, value)
+        return value
+
+    # get a serialised document (e.g. spaces.json) for the current data version,
+    # building its body with build() on a cache miss. returns a dict of the body
+    # bytes, a strong etag and the last modified date
+    def cached_document(self, name, build):
+        def build_document():
+            body = build()
+            return {
+                'body': body,
+                'etag': hashlib.sha1(body).hexdigest(),
+                'last_modified': self.last_changed(),
+            }
+        return self.cached(name, build_document)
+
     def as_json(self):
-        return {'spaces': list(
-            super(SpaceManager, self).get_queryset().values('name', 'lat', 'lng',
-                                                            'main_website_url', 'logo_image_url', 'status')
-        )}
-
-    def as_geojson(self):
-        results = self.all()
-        geo = {
+        return {'spaces': [with_logo_url(space) for space in
+                           super(SpaceManager, self).get_queryset().values(*JSON_FIELDS)]}
+
+    # spaces with a usable location - lots of records are still stuck at 0,0
+    def located(self, statuses=None, bbox=None):
+        qs = super(SpaceManager, self).get_queryset().exclude(lat=0).exclude(lng=0)
+        if statuses:
+            qs = qs.filter(status__in=statuses)
+        if bbox:
+            # bbox is (min_lng, min_lat, max_lng, max_lat), as used by geojson
+            qs = qs.filter(lng__gte=bbox[0], lat__gte=bbox[1], lng__lte=bbox[2], lat__lte=bbox[3])
+        return qs
+
+    # yield geojson features straight from database rows, without creating models
+    def geojson_features(self, statuses=None, bbox=None):
+        rows = self.located(statuses, bbox).values_list(*GEOJSON_FIELDS)
+        for row in rows.iterator(chunk_size=GEOJSON_CHUNK_SIZE):
+            yield geojson_feature(*row)
+
+    # stream a geojson FeatureCollection as a series of text chunks
+    def iter_geojson(self, statuses=None, bbox=None):
+        yield '{"type": "FeatureCollection", "features": ['
+        chunk = []
+        separator = ''
+        for feature in self.geojson_features(statuses, bbox):
+            chunk.append(json.dumps(feature))
+            if len(chunk) == GEOJSON_CHUNK_SIZE:
+                yield separator + ', '.join(chunk)
+                separator = ', '
+                chunk = []
+        if chunk:
+            yield separator + ', '.join(chunk)
+        yield ']}'
+
+    def as_geojson(self, statuses=None, bbox=None):
+        return {
             "type": "FeatureCollection",
-            "features": []
+            "features": list(self.geojson_features(statuses, bbox))
         }
-        for space in results:
-            if space.valid_location():
-                geo['features'].append(space.as_geojson_feature())
-        return geo
+
+    # map spaces clustered for a zoom level, cached per zoom level
+    def clusters(self, zoom):
+        return self.cached('clusters:{}'.format(zoom),
+                           lambda: cluster_features(self.geojson_features(MAP_STATUSES), zoom))
+
+    # the homepage directory of spaces, grouped by country and then region, e.g.
+    # {'active': {'count': 1, 'countries': [{'name': 'England', 'regions': [
+    #     {'name': 'London', 'spaces': [{'name': ..., ...}]}]}]}, 'inactive': {...}}
+    def directory(self):
+        return self.cached('directory', self.build_directory)
+
+    def build_directory(self):
+        directory = {}
+        for section, statuses in DIRECTORY_STATUSES.items():
+            spaces = super(SpaceManager, self).get_queryset().filter(status__in=statuses)
+            spaces = sorted((with_logo_url(space) for space in spaces.values(*DIRECTORY_FIELDS)),
+                            key=lambda space: (space['country'], space['region'], space['name']))
+            countries = []
+            for country, in_country in groupby(spaces, key=lambda space: space['country']):
+                regions = [{'name': region, 'spaces': list(in_region)}
+                           for region, in_region in groupby(in_country, key=lambda space: space['region'])]
+                countries.append({'name': country, 'regions': regions})
+            directory[section] = {'count': len(spaces), 'countries': countries}
+        return directory
+
+    # get up to limit changes (updates and deletions) made after the cursor, oldest first
+    # returns (changes, cursor for the next call, whether there are more changes)
+    def changes_since(self, cursor=None, limit=100):
+        updates = super(SpaceManager, self).get_queryset().values(*SYNC_FIELDS)
+        deletes = SpaceTombstone.objects.values('id', 'space_id', 'deleted_date')
+        # changes are only published once they've settled, so that a transaction which commits a
+        # little after it stamped changed_date can't slip in behind a cursor already handed out
+        settled = timezone.now() - timedelta(seconds=getattr(settings, "SPACE_SYNC_SETTLE_SECONDS", 5))
+        updates = updates.filter(changed_date__lte=settled).order_by('changed_date', 'id')
+        deletes = deletes.filter(deleted_date__lte=settled).order_by('deleted_date', 'id')
+
+        if cursor is not None:
+            timestamp, kind, last_id = decode_sync_cursor(cursor)
+            if kind == SYNC_UPDATE:
+                updates = updates.filter(Q(changed_date__gt=timestamp) |
+                                         Q(changed_date=timestamp, id__gt=last_id))
+                deletes = deletes.filter(deleted_date__gte=timestamp)
+            else:
+                updates = updates.filter(changed_date__gt=timestamp)
+                deletes = deletes.filter(Q(deleted_date__gt=timestamp) |
+                                         Q(deleted_date=timestamp, id__gt=last_id))
+
+        # fetch one more than needed of each, so we know if there are more to come
+        merged = sorted(
+            [(space['changed_date'], SYNC_UPDATE, space['id'], space) for space in updates[:limit + 1]] +
+            [(tombstone['deleted_date'], SYNC_DELETE, tombstone['id'], tombstone)
+             for tombstone in deletes[:limit + 1]],
+            key=lambda change: change[:3])
+
+        changes = []
+        for timestamp, kind, change_id, row in merged[:limit]:
+            if kind == SYNC_UPDATE:
+                changes.append({'type': 'update', 'id': row['id'], 'changed_date': timestamp,
+                                'space': with_logo_url(row)})
+            else:
+                changes.append({'type': 'delete', 'id': row['space_id'], 'changed_date': timestamp})
+            cursor = encode_sync_cursor(timestamp, kind, change_id)
+        return changes, cursor, len(merged) > limit
+
+    # search spaces by name, town, region and postcode, returns (a page of spaces best
+    # match first, whether there are more pages)
+    def search(self, query, page=1, per_page=20):
+        ids = search_space_ids(query, per_page + 1, (page - 1) * per_page)
+        page_ids = ids[:per_page]
+        rows = super(SpaceManager, self).get_queryset().filter(id__in=page_ids).values(*SEARCH_FIELDS)
+        spaces = {space['id']: space for space in rows}
+        results = [with_logo_url(spaces[space_id]) for space_id in page_ids if space_id in spaces]
+        return results, len(ids) > per_page
+
+    # suggest spaces whose name (or a word in it) starts with prefix, for typeahead
+    def autocomplete(self, prefix, limit=10):
+        return self.in_process('autocomplete', self.build_prefix_index).lookup(prefix, limit)
+
+    def build_prefix_index(self):
+        return PrefixIndex((space['id'], space['name'], space) for space in
+                           super(SpaceManager, self).get_queryset().values(*AUTOCOMPLETE_FIELDS))
+
+    # find the k nearest map spaces to a point, as (distance in km, geojson feature)
+    def nearest(self, lng, lat, k):
+        return self.in_process('nearest', self.build_spatial_index).nearest(lng, lat, k)
+
+    def build_spatial_index(self):
+        rows = self.located(MAP_STATUSES).values_list('id', *GEOJSON_FIELDS)
+        return SpatialIndex((float(row[1]), float(row[2]), dict(geojson_feature(*row[1:]), id=row[0]))
+                            for row in rows)
+
+    # get a mapbox vector tile of located spaces, encoded once per data version. tiles
+    # are cached on their own, so however many are requested they can only evict each other
+    def vector_tile(self, zoom, x, y):
+        return self.cached('tile:{}/{}/{}'.format(zoom, x, y), lambda: self.encode_vector_tile(zoom, x, y),
+                           caches['tiles'])
+
+    def encode_vector_tile(self, zoom, x, y):
+        scale = mvt.EXTENT / TILE_SIZE
+        rows = self.located(bbox=tile_bbox(zoom, x, y, VECTOR_TILE_BUFFER)).values_list('id', *GEOJSON_FIELDS)
+        features = []
+        for row in rows:
+            feature = geojson_feature(*row[1:])
+            px, py = lng_lat_to_pixel(*feature['geometry']['coordinates'], zoom)
+            features.append((row[0], (px - x * TILE_SIZE) * scale, (py - y * TILE_SIZE) * scale,
+                             feature['properties']))
+        return mvt.encode_tile({'spaces': features})
 
 
 class Space(models.Model):
@@ -61,8 +358,11 @@ class Space(models.Model):
     lng = models.DecimalField('longitude', max_digits=10, decimal_places=7)
     main_website_url = models.URLField(blank=True)
     logo_image_url = models.URLField(blank=True)
-    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='ACTIVE')
-    changed_date = models.DateTimeField(default=timezone.now)
+    # locally stored thumbnail of the logo (see main.logos), and the logo url it was made from
+    logo_thumbnail = models.TextField(blank=True)
+    logo_thumbnail_source = models.TextField(blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='ACTIVE', db_index=True)
+    changed_date = models.DateTimeField(default=timezone.now, db_index=True)
     email = models.CharField(max_length=200, blank=True)
 
     objects = SpaceManager()
@@ -71,9 +371,19 @@ class Space(models.Model):
         ordering = ["name"]
         db_table = 'space'
         app_label = 'main'
+        indexes = [
+            models.Index(fields=['lat', 'lng'], name='space_location_idx'),
+        ]
 
-    def publish(self):
+    def save(self, *args, **kwargs):
+        # fill in a missing location from the postcode, if we can
+        if not self.valid_location():
+            self.locate_from_postcode()
         self.changed_date = timezone.now()
+        super(Space, self).save(*args, **kwargs)
+        Space.objects.data_changed()
+
+    def publish(self):
         self.save()
 
     def __str__(self):
@@ -82,17 +392,37 @@ class Space(models.Model):
     def valid_location(self):
         return (self.lng != 0 and self.lat != 0)
 
+    # the logo url to show - the local thumbnail if it is up to date
+    def logo_url(self):
+        return logo_url(*(getattr(self, field) for field in LOGO_FIELDS))
+
+    # set lat/lng from the postcode, returns False if the postcode can't be geocoded
+    def locate_from_postcode(self):
+        location = geocode(self.postcode)
+        if location is None:
+            return False
+        self.lat, self.lng = (Decimal(str(value)) for value in location)
+        return True
+
     def as_geojson_feature(self):
-        return {
-            "type": "Feature",
-            "geometry": {
-                "type": "Point",
-                "coordinates": [float(self.lng), float(self.lat)]
-            },
-            "properties": {
-                "name": self.name,
-                "url": self.main_website_url,
-                "status": self.status,
-                "logo": self.logo_image_url
-            }
-        }
+        return geojson_feature(*[getattr(self, field) for field in GEOJSON_FIELDS])
+
+
+# record of a deleted space, so the change feed can tell mirrors about it
+class SpaceTombstone(models.Model):
+    space_id = models.IntegerField()
+    deleted_date = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        db_table = 'spacetombstone'
+        app_label = 'main'
+
+    def __str__(self):
+        return '{} - {}'.format(self.space_id, self.deleted_date.strftime('%Y-%m-%d'))
+
+
+# catch queryset deletes (e.g. from the admin) as well as Space.delete()
+@receiver(post_delete, sender=Space)
+def space_deleted(sender, instance, **kwargs):
+    SpaceTombstone.objects.create(space_id=instance.id)
+    Space.objects.data_changed()
@@ -67,6 +67,10 @@ class SupporterMembership(models.Model):
         ordering = ["created_at"]
         db_table = 'supportermembership'
         app_label = 'main'
+        indexes = [
+            # for finding memberships due a renewal
+            models.Index(fields=['status', 'expired_at'], name='supporter_expiry_idx'),
+        ]
 
     def __str__(self):
         return '{} - {} - {}'.format(self.user.name(), self.status, self.created_at.strftime('%Y-%m-%d'))
@@ -260,10 +264,16 @@ class SupporterMembership(models.Model):
 
         return True
 
-    # request new payment for this membership (e.g. start of a new year)
+    # request new payment for this membership (e.g. start of a new year). this is the same
+    # renewal the renew_supporters command would make, so the period is only paid for once.
+    # raises RenewalNotCreated if the payment couldn't be created
     def request_payment(self):
-        if self.has_active_mandate():
-            return self.mandate().create_payment(self.fee)
+        # imported here, as supporter_renewal imports this module
+        from .supporter_renewal import SupporterRenewal, RenewalNotCreated
+        renewal = SupporterRenewal.objects.renew(self)
+        if renewal.status != SupporterRenewal.CREATED:
+            raise RenewalNotCreated(renewal.last_error or "Unable to create payment")
+        return renewal
 
     def handle_payment_received(self, payment):
         if payment.payout_date is not None:
@@ -0,0 +1,213 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.db import models
+from django.utils import timezone
+from datetime import datetime, timedelta
+import logging
+import uuid
+from .gocardless import get_gocardless_client, GocardlessUnavailable
+from .gocardless_mandate import GocardlessMandate
+from .gocardless_payment import GocardlessPayment
+from .supporter_membership import SupporterMembership
+
+# get instance of a logger
+logger = logging.getLogger(__name__)
+
+# renew memberships this long before they expire
+RENEWAL_NOTICE = timedelta(days=14)
+
+# memberships that expired longer ago than this have lapsed, and aren't renewed
+LAPSED_AFTER = timedelta(days=30)
+
+# give up on a renewal after this many failed attempts
+MAX_ATTEMPTS = 3
+
+# payments in these states won't collect anything, so don't stop a membership being renewed
+UNCOLLECTED_PAYMENT_STATUSES = ('cancelled', 'failed', 'charged_back', 'customer_approval_denied')
+
+
+class RenewalNotCreated(Exception):
+    pass
+
+
+class SupporterRenewalManager(models.Manager):
+
+    # approved memberships expiring soon (or recently)
+    def due_memberships(self, today, notice=RENEWAL_NOTICE):
+        return SupporterMembership.objects.filter(
+            status='Approved', expired_at__range=(today - LAPSED_AFTER, today + notice))
+
+    # create a renewal, with its idempotency key, for each membership that's due one. a
+    # membership is only renewed once per period (until its payment is paid out and moves
+    # expired_at on), so this can safely be run any number of times. returns how many
+    # memberships are due
+    def schedule(self, today=None, notice=RENEWAL_NOTICE):
+        memberships = self.due_memberships(today or timezone.now().date(), notice).values_list(
+            'id', 'expired_at', 'fee')
+        renewals = [SupporterRenewal(membership_id=membership_id, period=expired_at, amount=fee,
+                                     idempotency_key=uuid.uuid4().hex)
+                    for membership_id, expired_at, fee in memberships]
+        super(SupporterRenewalManager, self).bulk_create(renewals, ignore_conflicts=True)
+        return len(renewals)
+
+    def pending(self):
+        return super(SupporterRenewalManager, self).get_queryset().filter(
+            status=SupporterRenewal.PENDING).order_by('period', 'id')
+
+    # create the payments for pending renewals. returns the renewals tried
+    def run(self, workers=8, limit=None, notice=RENEWAL_NOTICE):
+        renewals = list(self.pending()[:limit])
+        self.send(renewals, workers, notice)
+        return renewals
+
+    # renew a membership now, e.g. when it's approved or its supporter asks to pay. this goes
+    # through the same renewal (and idempotency key) as the scheduled run, so however often
+    # it's asked for, the period is only paid for once - unless its payment has failed or been
+    # cancelled, when a new one is made. returns the renewal
+    def renew(self, membership):
+        renewal, created = super(SupporterRenewalManager, self).get_or_create(
+            membership=membership, period=renewal_period(membership),
+            defaults={'amount': membership.fee, 'idempotency_key': uuid.uuid4().hex})
+        # the supporter asked, so a renewal given up on as lapsed is tried again
+        if renewal.status == SupporterRenewal.SKIPPED:
+            renewal.status = SupporterRenewal.PENDING
+            renewal.completed_at = None
+        # the old key would only get the uncollected payment back
+        elif renewal.status == SupporterRenewal.CREATED and renewal.payment is not None and \
+                renewal.payment.status in UNCOLLECTED_PAYMENT_STATUSES:
+            renewal.status = SupporterRenewal.PENDING
+            renewal.idempotency_key = uuid.uuid4().hex
+            renewal.attempts = 0
+            renewal.payment = None
+            renewal.completed_at = None
+        if renewal.status == SupporterRenewal.PENDING:
+            self.send([renewal], workers=1, lapse=False)
+        return renewal
+
+    # create the payments for renewals, making up to `workers` api requests at once. only the
+    # api requests are made in other threads - everything else happens here, one renewal at a
+    # time, so a crash leaves every renewal either done or pending with the idempotency key it
+    # was sent with. renewals without an active mandate, or whose mandate already has a
+    # payment in progress for the period, are left pending to be tried again next time (or
+    # skipped if they've lapsed, unless lapse is False)
+    def send(self, renewals, workers=8, notice=RENEWAL_NOTICE, lapse=True):
+        mandates = latest_mandates([renewal.membership_id for renewal in renewals])
+        payments = latest_payments([mandate.id for mandate in mandates.values()])
+        to_send = []
+        for renewal in renewals:
+            mandate = mandates.get(renewal.membership_id)
+            if mandate is None or not mandate.is_active():
+                renewal.wait("No active mandate", lapse)
+            elif payments.get(mandate.id, datetime.min).date() >= renewal.period - notice:
+                renewal.wait("A payment is already in progress", lapse)
+            else:
+                to_send.append((renewal, mandate))
+        if not to_send:
+            return
+
+        client = get_gocardless_client()
+
+        def send(item):
+            renewal, mandate = item
+            try:
+                return mandate.send_payment(client, renewal.amount, renewal.idempotency_key)
+            except Exception as e:
+                return e
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for (renewal, mandate), result in zip(to_send, pool.map(send, to_send)):
+                renewal.record(mandate, result)
+
+
+# the period a membership's next payment is for - when it expires, or when it was created if
+# it hasn't been paid for yet
+def renewal_period(membership):
+    return membership.expired_at or membership.created_at.date()
+
+
+# the latest mandate for each of a list of memberships
+def latest_mandates(membership_ids):
+    mandates = {}
+    for mandate in GocardlessMandate.objects.filter(supporter_membership_id__in=membership_ids).order_by(
+            'created_at'):
+        mandates[mandate.supporter_membership_id] = mandate
+    return mandates
+
+
+# when the latest payment that may still be collected was created, for each of a list of
+# mandates
+def latest_payments(mandate_ids):
+    return dict(GocardlessPayment.objects.filter(mandate_id__in=mandate_ids).exclude(
+        status__in=UNCOLLECTED_PAYMENT_STATUSES).values('mandate_id').annotate(
+        latest=models.Max('created_at')).values_list('mandate_id', 'latest'))
+
+
+# a yearly payment for a supporter membership
+class SupporterRenewal(models.Model):
+    PENDING = 'pending'
+    CREATED = 'created'
+    SKIPPED = 'skipped'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (CREATED, 'Created'),  # the payment has been created
+        (SKIPPED, 'Skipped'),  # the membership lapsed before it could be paid for
+        (FAILED, 'Failed'),  # gave up after MAX_ATTEMPTS
+    )
+
+    membership = models.ForeignKey('SupporterMembership', models.CASCADE, related_name='renewals')
+    # the expired_at date being renewed
+    period = models.DateField()
+    amount = models.DecimalField(max_digits=8, decimal_places=2)
+    # sent with every attempt, so GoCardless only ever creates one payment for the renewal
+    idempotency_key = models.TextField(unique=True)
+    status = models.CharField(max_length=7, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    payment = models.ForeignKey('GocardlessPayment', models.SET_NULL, blank=True, null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    completed_at = models.DateTimeField(blank=True, null=True)
+
+    objects = SupporterRenewalManager()
+
+    class Meta:
+        db_table = 'supporterrenewal'
+        app_label = 'main'
+        constraints = [
+            models.UniqueConstraint(fields=['membership', 'period'], name='supporter_renewal_period'),
+        ]
+
+    def __str__(self):
+        return '{} - {} - {}'.format(self.membership_id, self.period, self.status)
+
+    # leave the renewal pending, to be tried again on the next run - unless the membership
+    # has lapsed, when it's given up on
+    def wait(self, reason, lapse=True):
+        self.last_error = reason
+        if lapse and self.period < timezone.now().date() - LAPSED_AFTER:
+            self.status = self.SKIPPED
+            self.completed_at = timezone.now()
+        self.save()
+
+    # record the result of sending the payment - the payment from the api, or the exception
+    # sending it raised
+    def record(self, mandate, result):
+        if isinstance(result, Exception):
+            logger.warning("Unable to create renewal payment for membership %s: %s",
+                           self.membership_id, result)
+            self.last_error = '{}: {}'.format(type(result).__name__, result)
+            # an outage isn't this renewal's fault, so doesn't count towards giving up on it
+            if not isinstance(result, GocardlessUnavailable):
+                self.attempts += 1
+            if self.attempts >= MAX_ATTEMPTS:
+                self.status = self.FAILED
+                self.completed_at = timezone.now()
+        else:
+            payment = GocardlessPayment.objects.get_or_create_from_payload(result, mandate)
+            if payment is None:
+                # left pending - sending it again gets the same payment back
+                self.last_error = "Unable to store payment {}".format(result.id)
+            else:
+                self.payment = payment
+                self.status = self.CREATED
+                self.last_error = ''
+                self.completed_at = timezone.now()
+        self.save()
@@ -0,0 +1,85 @@
+import struct
+
+# Minimal Mapbox Vector Tile (https://github.com/mapbox/vector-tile-spec) encoder for
+# point layers. Writes the protobuf wire format directly, so there's no dependency on
+# protobuf or a vector tile library.
+
+# tile coordinate extent, as per the spec default
+EXTENT = 4096
+
+# protobuf wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+
+# geometry types and commands
+POINT = 1
+MOVE_TO = 1
+
+
+def varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def field(number, wire_type, payload):
+    key = varint((number << 3) | wire_type)
+    if wire_type == LENGTH_DELIMITED:
+        return key + varint(len(payload)) + payload
+    return key + payload
+
+
+def value_message(value):
+    if isinstance(value, bool):
+        return field(7, VARINT, varint(int(value)))
+    if isinstance(value, int):
+        return field(6, VARINT, varint(zigzag(value)))
+    if isinstance(value, float):
+        return field(3, FIXED64, struct.pack('<d', value))
+    return field(1, LENGTH_DELIMITED, str(value).encode('utf-8'))
+
+
+# encode a layer of point features, given as (id, x, y, properties) tuples where x and
+# y are tile coordinates (0..EXTENT, or a little outside for buffered points)
+def encode_layer(name, features, extent=EXTENT):
+    keys, values = {}, {}
+    encoded_features = []
+    for feature_id, x, y, properties in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None or value == '':
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault((type(value), value), len(values)))
+        geometry = [(1 << 3) | MOVE_TO, zigzag(int(round(x))), zigzag(int(round(y)))]
+        encoded_features.append(
+            field(1, VARINT, varint(feature_id)) +
+            field(2, LENGTH_DELIMITED, b''.join(varint(tag) for tag in tags)) +
+            field(3, VARINT, varint(POINT)) +
+            field(4, LENGTH_DELIMITED, b''.join(varint(command) for command in geometry))
+        )
+
+    layer = field(15, VARINT, varint(2)) + field(1, LENGTH_DELIMITED, name.encode('utf-8'))
+    layer += b''.join(field(2, LENGTH_DELIMITED, feature) for feature in encoded_features)
+    layer += b''.join(field(3, LENGTH_DELIMITED, key.encode('utf-8')) for key in keys)
+    layer += b''.join(field(4, LENGTH_DELIMITED, value_message(value)) for _, value in values)
+    layer += field(5, VARINT, varint(extent))
+    return layer
+
+
+# encode a tile from a dict of layer name -> features (see encode_layer). layers with
+# no features are left out, so a tile with nothing in it encodes as b''
+def encode_tile(layers, extent=EXTENT):
+    return b''.join(field(3, LENGTH_DELIMITED, encode_layer(name, features, extent))
+                    for name, features in layers.items() if features)
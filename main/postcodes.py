@@ -0,0 +1,167 @@
+from array import array
+from django.conf import settings
+import csv
+import logging
+import os
+import re
+import sys
+import threading
+
+# get instance of a logger
+logger = logging.getLogger(__name__)
+
+# Offline UK postcode geocoder. A postcode directory (e.g. the ONS Postcode Directory)
+# is compiled by `manage.py build_postcode_index` into a compact binary index: one
+# sorted blob of fixed width postcodes plus parallel float32 arrays of lat/lng, which
+# loads in a fraction of a second and is searched with a binary search. float32 is
+# good to about a metre, so locations are rounded to 5 decimal places.
+
+# normalised postcodes are at most 7 characters (e.g. SW1A1AA), shorter ones are
+# padded with spaces so every key is the same width
+KEY_WIDTH = 7
+
+POSTCODE_RE = re.compile(r'^[A-Z]{1,2}[0-9][A-Z0-9]?[0-9][A-Z]{2}$')
+
+INDEX_MAGIC = b'HSFPOSTCODES1\n'
+
+# the ONS Postcode Directory uses this latitude for postcodes without a location
+NO_LOCATION_LAT = 99.999999
+
+
+# uppercase and strip whitespace, e.g. "sw1a 1aa" -> "SW1A1AA"
+# returns None if it doesn't look like a full UK postcode
+def normalise_postcode(postcode):
+    postcode = re.sub(r'\s+', '', postcode or '').upper()
+    if not POSTCODE_RE.match(postcode):
+        return None
+    return postcode
+
+
+class PostcodeIndex:
+    def __init__(self, keys, lats, lngs):
+        self.keys = keys
+        self.lats = lats
+        self.lngs = lngs
+        self.count = len(lats)
+
+    def __len__(self):
+        return self.count
+
+    # build an index from an iterable of (postcode, lat, lng)
+    @classmethod
+    def build(cls, rows):
+        entries = []
+        for postcode, lat, lng in rows:
+            postcode = normalise_postcode(postcode)
+            if postcode is not None:
+                entries.append((postcode.ljust(KEY_WIDTH).encode('ascii'), lat, lng))
+        entries.sort()
+
+        keys = bytearray()
+        lats, lngs = array('f'), array('f')
+        previous = None
+        for key, lat, lng in entries:
+            if key == previous:
+                continue
+            keys += key
+            lats.append(lat)
+            lngs.append(lng)
+            previous = key
+        return cls(bytes(keys), lats, lngs)
+
+    # build an index from a postcode directory csv - the ONS Postcode Directory column
+    # names (pcds, lat, long) are recognised, as are postcode/latitude/longitude
+    @classmethod
+    def from_csv(cls, path):
+        def rows():
+            with open(path, newline='', encoding='utf-8-sig') as f:
+                reader = csv.DictReader(f)
+                fields = {name.lower(): name for name in reader.fieldnames or []}
+                postcode_field = next(fields[n] for n in ('pcds', 'pcd', 'postcode') if n in fields)
+                lat_field = next(fields[n] for n in ('lat', 'latitude') if n in fields)
+                lng_field = next(fields[n] for n in ('long', 'lng', 'longitude') if n in fields)
+                for row in reader:
+                    try:
+                        lat, lng = float(row[lat_field]), float(row[lng_field])
+                    except ValueError:
+                        continue
+                    if lat != NO_LOCATION_LAT:
+                        yield row[postcode_field], lat, lng
+        return cls.build(rows())
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(INDEX_MAGIC)
+            f.write(self.count.to_bytes(4, 'little'))
+            f.write(self.keys)
+            for values in (self.lats, self.lngs):
+                values = array('f', values)
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                f.write(values.tobytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError("{} is not a postcode index".format(path))
+            count = int.from_bytes(f.read(4), 'little')
+            keys = f.read(count * KEY_WIDTH)
+            arrays = []
+            for _ in range(2):
+                values = array('f')
+                values.frombytes(f.read(count * values.itemsize))
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                arrays.append(values)
+        return cls(keys, *arrays)
+
+    # get (lat, lng) for a postcode, or None if it isn't in the index
+    def lookup(self, postcode):
+        postcode = normalise_postcode(postcode)
+        if postcode is None:
+            return None
+        key = postcode.ljust(KEY_WIDTH).encode('ascii')
+
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.keys[mid * KEY_WIDTH:(mid + 1) * KEY_WIDTH] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.keys[lo * KEY_WIDTH:(lo + 1) * KEY_WIDTH] == key:
+            return (round(self.lats[lo], 5), round(self.lngs[lo], 5))
+        return None
+
+
+# the loaded index, as ((path, mtime), index)
+loaded_index = (None, None)
+load_lock = threading.Lock()
+
+
+# get the configured postcode index, or None if there isn't one installed. the index
+# is reloaded if the file changes (e.g. after build_postcode_index is rerun)
+def get_postcode_index():
+    global loaded_index
+    path = getattr(settings, "POSTCODE_INDEX_PATH", None)
+    if not path:
+        return None
+    try:
+        version = (path, os.stat(path).st_mtime_ns)
+    except FileNotFoundError:
+        return None
+    if loaded_index[0] != version:
+        with load_lock:
+            if loaded_index[0] != version:
+                loaded_index = (version, PostcodeIndex.load(path))
+                logger.info("Loaded %d postcodes from %s", len(loaded_index[1]), path)
+    return loaded_index[1]
+
+
+# get (lat, lng) for a postcode, or None if it can't be geocoded
+def geocode(postcode):
+    index = get_postcode_index()
+    if index is None:
+        return None
+    return index.lookup(postcode)
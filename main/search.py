@@ -0,0 +1,124 @@
+from bisect import bisect_left
+from django.db import connection
+from django.db.models import Q
+import re
+import unicodedata
+
+# Space search. Name, town, region and postcode are indexed by the database itself -
+# an FTS5 table kept up to date by triggers on SQLite, a GIN index over a tsvector
+# expression on Postgres (see migration 0045_space_search) - so inserts, updates and
+# bulk imports are all picked up without any help from the application. Every search
+# word is matched as a prefix, so results can be shown as you type. Other databases
+# fall back to a (slow) substring match.
+
+# ignore anything past this many words
+MAX_SEARCH_TERMS = 10
+
+TERM_RE = re.compile(r'\w+')
+
+# the indexed document - this must stay identical to the expression in the migration,
+# otherwise postgres won't use the index
+POSTGRES_VECTOR = """(
+    setweight(to_tsvector('simple', coalesce(name, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(town, '') || ' ' || coalesce(region, '')), 'B') ||
+    setweight(to_tsvector('simple', coalesce(postcode, '') || ' ' ||
+                                    replace(coalesce(postcode, ''), ' ', '')), 'A')
+)"""
+
+# column weights for bm25 - name, town, region, postcode
+SQLITE_WEIGHTS = (10.0, 2.0, 2.0, 5.0)
+
+
+# split a search into lowercase words
+def search_terms(query):
+    return TERM_RE.findall((query or '').lower())[:MAX_SEARCH_TERMS]
+
+
+def sqlite_search(terms, limit, offset):
+    match = ' '.join('"{}"*'.format(term) for term in terms)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT rowid FROM space_search WHERE space_search MATCH %s "
+            "ORDER BY bm25(space_search, {}, {}, {}, {}), rowid LIMIT %s OFFSET %s".format(*SQLITE_WEIGHTS),
+            [match, limit, offset])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def postgres_search(terms, limit, offset):
+    query = ' & '.join('{}:*'.format(term) for term in terms)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT id FROM space, to_tsquery('simple', %s) query WHERE {vector} @@ query "
+            "ORDER BY ts_rank({vector}, query) DESC, name, id "
+            "LIMIT %s OFFSET %s".format(vector=POSTGRES_VECTOR),
+            [query, limit, offset])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def fallback_search(terms, limit, offset):
+    from .models import Space
+    spaces = Space.objects.all()
+    for term in terms:
+        spaces = spaces.filter(Q(name__icontains=term) | Q(town__icontains=term) |
+                               Q(region__icontains=term) | Q(postcode__icontains=term))
+    return list(spaces.order_by('name', 'id').values_list('id', flat=True)[offset:offset + limit])
+
+
+SEARCH_BACKENDS = {
+    'sqlite': sqlite_search,
+    'postgresql': postgres_search,
+}
+
+
+# get the ids of spaces matching a search, best match first
+def search_space_ids(query, limit, offset=0):
+    terms = search_terms(query)
+    if not terms:
+        return []
+    return SEARCH_BACKENDS.get(connection.vendor, fallback_search)(terms, limit, offset)
+
+
+# fold case and accents and collapse punctuation, e.g. "Hack  Manchester!" -> "hack manchester"
+def normalise_name(name):
+    name = unicodedata.normalize('NFKD', name or '')
+    name = ''.join(c for c in name if not unicodedata.combining(c)).casefold()
+    return ' '.join(TERM_RE.findall(name))
+
+
+class PrefixIndex:
+    """In-memory typeahead index over names - sorted lists of whole names and of the
+    rest of each name from every later word (so "manc" finds "Hackspace Manchester"),
+    searched with a binary search."""
+
+    def __init__(self, items):
+        # items are (id, name, data) - data is what lookups return for that id
+        self.data = {}
+        names, words = [], []
+        for item_id, name, data in items:
+            self.data[item_id] = data
+            name = normalise_name(name)
+            names.append((name, item_id))
+            start = name.find(' ') + 1
+            while start:
+                words.append((name[start:], item_id))
+                start = name.find(' ', start) + 1
+        self.names = sorted(names)
+        self.words = sorted(words)
+
+    def __len__(self):
+        return len(self.data)
+
+    # get the data of up to limit items with a word starting with prefix - names that
+    # start with the prefix come first
+    def lookup(self, prefix, limit):
+        prefix = normalise_name(prefix)
+        found = []
+        if not prefix:
+            return found
+        for keys in (self.names, self.words):
+            i = bisect_left(keys, (prefix,))
+            while i < len(keys) and len(found) < limit and keys[i][0].startswith(prefix):
+                if keys[i][1] not in found:
+                    found.append(keys[i][1])
+                i += 1
+        return [self.data[item_id] for item_id in found]
@@ -0,0 +1,115 @@
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, Client, override_settings
+from io import StringIO
+from main import docs
+from main.docs import mirror_file, mirror_version, render_page
+from main.docs_search import search_docs
+from main.views import MAX_SEARCH_PAGE
+from unittest import mock
+import os
+import tarfile
+import tempfile
+
+
+def github_unavailable(url, etag='', last_modified=''):
+    raise AssertionError("Mirrored pages shouldn't be fetched from GitHub")
+
+
+class DocsMirrorTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.upstream = os.path.join(self.tmpdir.name, 'upstream')
+        self.write_page('resources', 'README.md', "# Resources")
+        self.write_page('resources', 'guides/README.md', "# Guides\n\n## Getting started\n\nHello")
+        self.write_page('foundation', 'README.md', "# Foundation")
+        self.settings = override_settings(DOCS_MIRROR_ROOT=os.path.join(self.tmpdir.name, 'mirror'),
+                                          DOCS_UPSTREAM=os.path.join(self.upstream, '{repo}'),
+                                          DOCS_SEARCH_INDEX=os.path.join(self.tmpdir.name, 'search.sqlite3'),
+                                          GITHUB_FETCHER='main.tests.test_docs.github_unavailable')
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.tmpdir.cleanup()
+
+    def write_page(self, repo, path, text):
+        path = os.path.join(self.upstream, repo, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def test_serves_from_mirror(self):
+        call_command('sync_docs', stdout=StringIO())
+        c = Client()
+        content = c.get("/resources/guides/README.md").content
+        assert b'<h1 id="guides">Guides</h1>' in content
+        assert b'<li class="toc-h2"><a href="#getting-started">Getting started</a></li>' in content
+        assert b">Foundation</h1>" in c.get("/foundation/README.md").content
+        assert c.get("/resources/missing.md").status_code == 404
+        assert mirror_file('resources', '../foundation/current/README.md') is None
+
+        # a resync switches over to the new content
+        self.write_page('resources', 'README.md', "# Updated")
+        call_command('sync_docs', 'resources', stdout=StringIO())
+        assert b">Updated</h1>" in c.get("/resources/README.md").content
+
+    def test_search(self):
+        call_command('sync_docs', stdout=StringIO())
+        response = Client().get("/resources/search", {'q': "start"})
+        assert response.context['results'] == [{
+            'repo': 'resources', 'path': 'guides/README.md', 'title': "Guides",
+            'snippet': "Guides\nGetting <mark>started</mark>\nHello"}]
+        # a huge page doesn't overflow the offset
+        response = Client().get("/resources/search", {'q': "start", 'page': 10 ** 20})
+        assert response.context['results'] == [] and response.context['page'] == MAX_SEARCH_PAGE
+        assert Client().get("/resources/search", {'q': "start", 'page': "x"}).status_code == 400
+
+        # only changed pages are indexed again, and deleted ones are dropped
+        self.write_page('resources', 'guides/README.md', "# Guides\n\nWoodwork & metalwork < 5mm")
+        os.remove(os.path.join(self.upstream, 'resources', 'README.md'))
+        out = StringIO()
+        call_command('sync_docs', 'resources', stdout=out)
+        assert "resources: 1 pages indexed, 1 removed" in out.getvalue()
+        results, more = search_docs("metal")
+        assert results[0]['snippet'] == "Guides\nWoodwork &amp; <mark>metalwork</mark> &lt; 5mm"
+        assert search_docs("resources") == ([], False)
+        assert search_docs("guides", repo='foundation') == ([], False)
+
+    def test_tarball_upstream(self):
+        tarball = os.path.join(self.tmpdir.name, 'resources.tar.gz')
+        with tarfile.open(tarball, 'w:gz') as tar:
+            tar.add(os.path.join(self.upstream, 'resources'), arcname='resources-master')
+
+        out = StringIO()
+        call_command('sync_docs', 'resources', upstream=tarball, stdout=out)
+        assert "resources: updated" in out.getvalue()
+        version = mirror_version('resources')
+        assert b">Resources</h1>" in Client().get("/resources/README.md").content
+
+        # an unchanged tarball isn't extracted again
+        out = StringIO()
+        call_command('sync_docs', 'resources', upstream=tarball, stdout=out)
+        assert "resources: unchanged" in out.getvalue()
+        assert mirror_version('resources') == version
+
+
+class RenderPageTestCase(TestCase):
+    def test_render_page(self):
+        page = render_page('guides/README.md', "# Tools & Safety\n\n### Lathes")
+        assert page['toc'] == [{'level': 1, 'id': 'tools-safety', 'name': "Tools & Safety"},
+                               {'level': 3, 'id': 'lathes', 'name': "Lathes"}]
+        assert page['breadcrumbs'] == [{'slug': 'guides', 'url': '/guides'},
+                                       {'slug': 'README.md', 'url': '/guides/README.md'}]
+        # the same source isn't rendered again
+        assert render_page('guides/README.md', "# Tools & Safety\n\n### Lathes") is page
+
+    def test_least_recently_used_are_evicted(self):
+        with mock.patch.object(docs, 'RENDER_CACHE_SIZE', 2):
+            first = render_page('a.md', "# A")
+            render_page('b.md', "# B")
+            assert render_page('a.md', "# A") is first
+            render_page('c.md', "# C")
+            assert render_page('a.md', "# A") is first
+            assert len(docs.rendered_pages) == 2
@@ -0,0 +1,203 @@
+from django.core.cache import cache, caches
+from django.test import TestCase, Client, override_settings
+from main.github import cache_key, get_file, get_page, raw_url, url_lock
+from unittest import mock
+import os
+import requests
+import tempfile
+import threading
+import time
+
+fetched = []
+github_down = False
+page_changes = True
+
+
+def fake_fetcher(url, etag='', last_modified=''):
+    fetched.append((url, etag))
+    time.sleep(0.05)
+    if github_down:
+        raise requests.ConnectionError("GitHub is down")
+    if url.endswith('missing.md'):
+        return 404, "404: Not Found", '', ''
+    if etag and not page_changes:
+        return 304, '', etag, ''
+    return 200, "# Page {}".format(len(fetched)), '"page-{}"'.format(len(fetched)), ''
+
+
+@override_settings(GITHUB_FETCHER='main.tests.test_github.fake_fetcher', DOCS_SEARCH_INDEX=None)
+class GithubCacheTestCase(TestCase):
+    def setUp(self):
+        global github_down, page_changes
+        cache.clear()
+        caches['github'].clear()
+        fetched.clear()
+        github_down = False
+        page_changes = True
+
+    def test_pages_are_cached(self):
+        c = Client()
+        response = c.get("/resources/README.md")
+        assert b">Page 1</h1>" in response.content
+        assert b">Page 1</h1>" in c.get("/resources/README.md").content
+        assert len(fetched) == 1
+
+        assert c.get("/resources/missing.md").status_code == 404
+        assert c.get("/resources/missing.md").status_code == 404
+        assert len(fetched) == 2
+
+    def test_concurrent_misses_are_coalesced(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(get_page('resources', 'README.md')))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [(200, "# Page 1")] * 8
+        assert len(fetched) == 1
+
+    def test_outside_repo(self):
+        with mock.patch('main.github.index_page') as index_page:
+            assert get_page('resources', '../../../someone/else/master/README.md') == (404, '')
+            response = Client().get("/resources/%2e%2e/%2e%2e/%2e%2e/someone/else/master/README.md")
+            assert response.status_code == 404
+        assert fetched == []
+        assert not index_page.called
+
+    @override_settings(GITHUB_CACHE_TTL=0)
+    def test_stale_while_revalidate_and_if_error(self):
+        global github_down
+        assert get_page('resources', 'README.md') == (200, "# Page 1")
+
+        # the expired copy is served while it is refreshed in the background
+        assert get_page('resources', 'README.md') == (200, "# Page 1")
+        with url_lock(raw_url('resources', 'README.md')):
+            pass
+        assert len(fetched) == 2
+
+        # and still served if github can't be reached
+        github_down = True
+        assert get_page('resources', 'README.md') == (200, "# Page 2")
+        with url_lock(raw_url('resources', 'README.md')):
+            pass
+        assert len(fetched) == 3
+        assert b">Page 2</h1>" in Client().get("/resources/README.md").content
+
+    @override_settings(GITHUB_CACHE_TTL=0, GITHUB_CACHE_STALE=0)
+    def test_conditional_revalidation(self):
+        global page_changes
+        page_changes = False
+        assert get_page('resources', 'README.md') == (200, "# Page 1")
+        # the stored copy is revalidated with its etag, and kept when github says it's unchanged
+        assert get_page('resources', 'README.md') == (200, "# Page 1")
+        assert fetched[1] == (raw_url('resources', 'README.md'), '"page-1"')
+
+        page_changes = True
+        assert get_page('resources', 'README.md') == (200, "# Page 3")
+
+    def test_lock_is_only_released_by_its_owner(self):
+        lock_key = cache_key(raw_url('resources', 'README.md')) + ':lock'
+
+        # the lock expires during the fetch and another process takes it
+        def slow_fetcher(*args):
+            caches['github'].set(lock_key, 'another process')
+            return fake_fetcher(*args)
+        with mock.patch('main.github.get_fetcher', return_value=slow_fetcher):
+            assert get_page('resources', 'README.md') == (200, "# Page 1")
+        assert caches['github'].get(lock_key) == 'another process'
+
+        caches['github'].delete(lock_key)
+        with override_settings(GITHUB_CACHE_TTL=0, GITHUB_CACHE_STALE=0):
+            get_page('resources', 'README.md')
+        assert caches['github'].get(lock_key) is None
+
+    def test_unavailable(self):
+        global github_down
+        github_down = True
+        assert Client().get("/resources/README.md").status_code == 503
+
+
+def fake_file_fetcher(url, f):
+    fetched.append((url, ''))
+    if url.endswith('missing.pdf'):
+        return 404
+    f.write(b"%PDF-" + b"x" * 95)
+    return 200
+
+
+class ResourceFileTestCase(TestCase):
+    def setUp(self):
+        fetched.clear()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.settings = override_settings(DOCS_PROXY_FILES=True, DOCS_FILE_CACHE_ROOT=self.tmpdir.name,
+                                          DOCS_MIRROR_ROOT=None,
+                                          GITHUB_FILE_FETCHER='main.tests.test_github.fake_file_fetcher')
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.tmpdir.cleanup()
+
+    def test_proxy(self):
+        c = Client()
+        response = c.get("/resources/guides/lathe.pdf")
+        assert response.status_code == 200
+        assert response['Content-Type'] == "application/pdf"
+        assert b"".join(response.streaming_content) == b"%PDF-" + b"x" * 95
+        assert "max-age" in response['Cache-Control']
+
+        response = c.get("/resources/guides/lathe.pdf", HTTP_RANGE="bytes=0-4")
+        assert response.status_code == 206
+        assert response['Content-Range'] == "bytes 0-4/100"
+        assert b"".join(response.streaming_content) == b"%PDF-"
+
+        response = c.get("/resources/guides/lathe.pdf", HTTP_RANGE="bytes=-10")
+        assert response['Content-Range'] == "bytes 90-99/100"
+
+        response = c.get("/resources/guides/lathe.pdf", HTTP_RANGE="bytes=100-")
+        assert response.status_code == 416
+        assert response['Content-Range'] == "bytes */100"
+
+        # an invalid range is ignored
+        response = c.get("/resources/guides/lathe.pdf", HTTP_RANGE="bytes=50-10")
+        assert response.status_code == 200
+        assert len(b"".join(response.streaming_content)) == 100
+
+        # it was only downloaded once
+        assert len(fetched) == 1
+
+        assert c.get("/resources/guides/missing.pdf").status_code == 404
+
+    def test_redirect_without_proxy(self):
+        with override_settings(DOCS_PROXY_FILES=False):
+            response = Client().get("/resources/guides/lathe.pdf")
+        assert response.status_code == 302
+        assert response['Location'] == raw_url('resources', 'guides/lathe.pdf')
+
+    def test_download_outside_lock(self):
+        # other requests for the url aren't held up while it downloads
+        def fetcher(url, f):
+            assert not url_lock(url).locked()
+            return fake_file_fetcher(url, f)
+        with mock.patch('main.github.get_file_fetcher', return_value=fetcher):
+            assert Client().get("/resources/guides/lathe.pdf").status_code == 200
+        assert len(fetched) == 1
+
+    def test_outside_repo(self):
+        # .. would otherwise reach any file on github
+        c = Client()
+        assert c.get("/resources/%2e%2e/%2e%2e/%2e%2e/someone/else/master/big.pdf").status_code == 404
+        assert c.get("/resources/guides/./lathe.pdf").status_code == 404
+        assert c.get("/resources/guides//lathe.pdf").status_code == 404
+        assert fetched == []
+
+    def test_cache_size(self):
+        with override_settings(DOCS_FILE_CACHE_MAX_BYTES=150):
+            path = get_file('resources', 'guides/lathe.pdf')
+            old = time.time() - 60
+            os.utime(path, (old, old))
+            assert Client().get("/resources/guides/mill.pdf").status_code == 200
+        # the older file made way for the new one
+        assert not os.path.exists(path)
+        assert len(os.listdir(self.tmpdir.name)) == 1
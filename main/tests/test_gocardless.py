@@ -0,0 +1,443 @@
+from django.core.management import call_command
+from django.test import TestCase, Client, override_settings
+from django.utils import timezone
+from io import StringIO
+from main.models import GocardlessMandate, GocardlessWebhookEvent, GocardlessWebhookWatermark
+from main.models import GocardlessPayment, SupporterMembership, SupporterRenewal, User, gocardless
+from main.models.supporter_renewal import RenewalNotCreated
+from main.fake_gocardless import FakeGocardless, mandate_resource, payment_resource, sign_webhook
+from gocardless_pro import errors as gocardless_errors
+from types import SimpleNamespace
+from unittest import mock
+import json
+import requests
+import datetime
+import os
+import tempfile
+import threading
+
+SECRET = "webhook-secret"
+
+
+def mandate_event(event_id, mandate_id, action='active', created_at=None):
+    event = {'id': event_id, 'resource_type': 'mandates', 'action': action, 'links': {'mandate': mandate_id}}
+    if created_at:
+        event['created_at'] = created_at
+    return event
+
+
+class FakeMandates:
+    def __init__(self, statuses, barrier=None):
+        self.statuses = statuses
+        self.fetched = []
+        self.barrier = barrier
+
+    def get(self, mandate_id):
+        self.fetched.append(mandate_id)
+        if self.barrier is not None:
+            # wait for the other fetches, so this only passes if they're made at once
+            self.barrier.wait(timeout=5)
+        status = self.statuses[mandate_id]
+        if isinstance(status, Exception):
+            raise status
+        return SimpleNamespace(id=mandate_id, status=status)
+
+
+@override_settings(GOCARDLESS_WEBHOOK_SECRET=SECRET)
+class WebhookTestCase(TestCase):
+    def post(self, events, secret=SECRET):
+        body, signature = sign_webhook(events, secret)
+        return Client().post("/gocardless-webhook", body, content_type="application/json",
+                             HTTP_WEBHOOK_SIGNATURE=signature)
+
+    def process(self, statuses, barrier=None):
+        mandates = FakeMandates(statuses, barrier)
+        with mock.patch('main.models.gocardless_webhook_event.get_gocardless_client',
+                        return_value=SimpleNamespace(mandates=mandates)):
+            call_command('process_webhooks', stdout=StringIO())
+        return mandates
+
+    def test_events_are_stored_then_processed(self):
+        GocardlessMandate.objects.create(id="MD1", status="pending_submission")
+
+        events = [mandate_event("EV1", "MD1"), mandate_event("EV2", "MD1")]
+        assert self.post(events).status_code == 200
+        # a resent webhook doesn't store the events twice
+        assert self.post(events[:1]).status_code == 200
+        assert GocardlessWebhookEvent.objects.filter(status=GocardlessWebhookEvent.PENDING).count() == 2
+
+        self.process({"MD1": "active"})
+        assert GocardlessMandate.objects.get(id="MD1").status == "active"
+        assert GocardlessWebhookEvent.objects.filter(status=GocardlessWebhookEvent.PROCESSED).count() == 2
+
+    def test_failed_events_are_retried(self):
+        GocardlessMandate.objects.create(id="MD1", status="pending_submission")
+        self.post([mandate_event("EV1", "MD1")])
+
+        self.process({"MD1": ConnectionError("GoCardless is down")})
+        event = GocardlessWebhookEvent.objects.get(id="EV1")
+        assert event.status == GocardlessWebhookEvent.PENDING
+        assert event.attempts == 1 and "GoCardless is down" in event.last_error
+        assert event.next_attempt_at > timezone.now()
+
+        # not retried until its backoff is up
+        assert self.process({"MD1": "active"}).fetched == []
+        GocardlessWebhookEvent.objects.update(next_attempt_at=timezone.now())
+        self.process({"MD1": "active"})
+        assert GocardlessWebhookEvent.objects.get(id="EV1").status == GocardlessWebhookEvent.PROCESSED
+        assert GocardlessMandate.objects.get(id="MD1").status == "active"
+
+    def test_stale_events_are_skipped(self):
+        GocardlessMandate.objects.create(id="MD1", status="pending_submission")
+        GocardlessMandate.objects.create(id="MD2", status="pending_submission")
+        self.post([mandate_event("EV1", "MD1", 'submitted', "2024-01-01T10:00:00.000Z"),
+                   mandate_event("EV2", "MD1", 'active', "2024-01-01T11:00:00.000Z"),
+                   mandate_event("EV3", "MD2", 'active', "2024-01-01T09:00:00.000Z")])
+        event = GocardlessWebhookEvent.objects.get(id="EV1")
+        assert event.resource_id == "MD1" and event.created_at.hour == 10
+
+        # only the newest event for each mandate needs the mandate fetching
+        assert sorted(self.process({"MD1": "active", "MD2": "active"}).fetched) == ["MD1", "MD2"]
+        assert GocardlessWebhookEvent.objects.get(id="EV1").status == GocardlessWebhookEvent.SKIPPED
+        assert GocardlessWebhookEvent.objects.get(id="EV2").status == GocardlessWebhookEvent.PROCESSED
+        watermark = GocardlessWebhookWatermark.objects.get(resource_type="mandates", resource_id="MD1")
+        assert watermark.last_event_id == "EV2"
+
+        # an older event arriving late is skipped too, a newer one isn't
+        self.post([mandate_event("EV4", "MD1", 'submitted', "2024-01-01T10:30:00.000Z"),
+                   mandate_event("EV5", "MD2", 'cancelled', "2024-01-01T12:00:00.000Z")])
+        assert self.process({"MD1": "active", "MD2": "cancelled"}).fetched == ["MD2"]
+        assert GocardlessWebhookEvent.objects.get(id="EV4").status == GocardlessWebhookEvent.SKIPPED
+        assert GocardlessMandate.objects.get(id="MD2").status == "cancelled"
+        assert GocardlessWebhookWatermark.objects.get(resource_id="MD2").last_event_id == "EV5"
+
+    def test_claimed_events_are_leased(self):
+        GocardlessMandate.objects.create(id="MD1", status="pending_submission")
+        self.post([mandate_event("EV1", "MD1")])
+        events = GocardlessWebhookEvent.objects.claim()
+        assert [event.id for event in events] == ["EV1"]
+
+        # a claimed event isn't due again until its lease is up
+        assert not GocardlessWebhookEvent.objects.claim()
+        assert self.process({"MD1": "active"}).fetched == []
+
+        # then another worker can claim it, and the first one leaves it alone
+        GocardlessWebhookEvent.objects.update(next_attempt_at=timezone.now())
+        self.process({"MD1": "active"})
+        assert GocardlessWebhookEvent.objects.get(id="EV1").status == GocardlessWebhookEvent.PROCESSED
+        assert not events[0].is_claimed()
+
+    @override_settings(GOCARDLESS_FETCH_THREADS=3)
+    def test_batch_fetches_each_resource_once_in_parallel(self):
+        for mandate_id in ("MD1", "MD2", "MD3"):
+            GocardlessMandate.objects.create(id=mandate_id, status="pending_submission")
+        self.post([mandate_event("EV{}".format(i), "MD{}".format(i % 3 + 1)) for i in range(12)])
+
+        mandates = self.process({"MD1": "active", "MD2": "active", "MD3": "cancelled"}, threading.Barrier(3))
+        assert sorted(mandates.fetched) == ["MD1", "MD2", "MD3"]
+        assert GocardlessWebhookEvent.objects.filter(status=GocardlessWebhookEvent.PROCESSED).count() == 12
+        assert GocardlessMandate.objects.get(id="MD3").status == "cancelled"
+
+    def test_bad_signature(self):
+        assert self.post([mandate_event("EV1", "MD1")], secret="wrong").status_code == 498
+        assert Client().post("/gocardless-webhook", "{}", content_type="application/json").status_code == 498
+        assert not GocardlessWebhookEvent.objects.exists()
+
+
+def api_response(status, body):
+    response = requests.Response()
+    response.status_code = status
+    response._content = json.dumps(body).encode('utf-8')
+    return response
+
+
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+@override_settings(GOCARDLESS_ACCESS_TOKEN="token", GOCARDLESS_ENVIRONMENT="sandbox")
+class GocardlessClientTestCase(TestCase):
+    def setUp(self):
+        gocardless.client = None
+        self.api = gocardless.get_gocardless_client()
+        self.sleep = mock.patch('main.models.gocardless.time.sleep').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def respond(self, *responses):
+        self.api._api_client.session = FakeSession(responses)
+        return self.api._api_client.session
+
+    def test_client_is_shared(self):
+        assert gocardless.get_gocardless_client() is self.api
+        with self.settings(GOCARDLESS_ACCESS_TOKEN="other"):
+            assert gocardless.get_gocardless_client() is not self.api
+
+    def test_idempotent_requests_are_retried(self):
+        session = self.respond(requests.ConnectionError("reset"), api_response(503, {}),
+                               api_response(200, {'mandates': {'id': 'MD1', 'status': 'active'}}))
+        assert self.api.mandates.get("MD1").status == "active"
+        assert len(session.requests) == 3 and self.sleep.call_count == 2
+
+        # actions aren't safe to send twice
+        session = self.respond(requests.ConnectionError("reset"))
+        with self.assertRaises(gocardless.GocardlessUnavailable):
+            self.api.mandates.cancel("MD1")
+        assert len(session.requests) == 1
+
+    def test_circuit_breaker(self):
+        session = self.respond(*[requests.Timeout("timed out")] * gocardless.BREAKER_THRESHOLD)
+        for i in range(gocardless.BREAKER_THRESHOLD):
+            with self.assertRaises(gocardless.GocardlessUnavailable):
+                self.api.mandates.cancel("MD1")
+
+        # open - fails without making a request
+        with self.assertRaises(gocardless.CircuitOpen):
+            self.api.mandates.get("MD1")
+        assert len(session.requests) == gocardless.BREAKER_THRESHOLD
+
+        # after a while a trial request is let through. one that fails unexpectedly doesn't
+        # leave the circuit stuck half open
+        self.api._api_client.breaker.opened_at -= gocardless.BREAKER_RESET
+        self.respond(ValueError("malformed"))
+        with self.assertRaises(ValueError):
+            self.api.mandates.get("MD1")
+
+        # and a successful one closes it again
+        self.respond(api_response(200, {'mandates': {'id': 'MD1', 'status': 'active'}}),
+                     api_response(200, {'mandates': {'id': 'MD1', 'status': 'active'}}))
+        self.api.mandates.get("MD1")
+        assert self.api.mandates.get("MD1").status == "active"
+
+
+@override_settings(GOCARDLESS_ACCESS_TOKEN="token", GOCARDLESS_ENVIRONMENT="sandbox")
+class ReconcileTestCase(TestCase):
+    def serve(self, resources):
+        server = FakeGocardless(('127.0.0.1', 0), resources)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_reconcile(self):
+        GocardlessMandate.objects.create(id="MD1", status="pending_submission")
+        GocardlessMandate.objects.create(id="MD2", status="active")
+        mandate = GocardlessMandate.objects.get(id="MD1")
+        GocardlessPayment.objects.create(id="PM1", mandate=mandate, amount=1000, currency="GBP",
+                                         status="submitted", charge_date=datetime.date(2024, 1, 1))
+        GocardlessPayment.objects.create(id="PM2", mandate=mandate, amount=1000, currency="GBP",
+                                         status="submitted", charge_date=datetime.date(2024, 1, 1))
+        # paid out too long ago to be charged back, so it doesn't hold the watermark back
+        GocardlessPayment.objects.create(id="PM0", mandate=mandate, amount=1000, currency="GBP",
+                                         status="paid_out", created_at=datetime.datetime(2020, 1, 1))
+
+        now = timezone.now().strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        server = self.serve({
+            'mandates': [mandate_resource("MD1", "active", now), mandate_resource("MD2", "active", now),
+                         # not one of ours
+                         mandate_resource("MD3", "active", now)],
+            'payments': [payment_resource("PM1", "MD1", "paid_out", now, 1000, "2024-01-01"),
+                         payment_resource("PM2", "MD1", "submitted", now, 1000, "2024-01-05"),
+                         # created too long ago to have changed
+                         payment_resource("PM0", "MD1", "paid_out", "2020-01-01T00:00:00.000Z", 1000,
+                                          "2020-01-05")],
+        })
+        out = StringIO()
+        with self.settings(GOCARDLESS_BASE_URL=server.url):
+            call_command('reconcile_gocardless', page_size=1, stdout=out)
+        assert "mandates: 2 checked, 1 updated" in out.getvalue()
+        assert "payments: 2 checked, 2 updated" in out.getvalue()
+
+        assert GocardlessMandate.objects.get(id="MD1").status == "active"
+        payment = GocardlessPayment.objects.get(id="PM1")
+        # the status change was handled as usual
+        assert payment.status == "paid_out" and payment.payout_date is not None
+        assert GocardlessPayment.objects.get(id="PM2").charge_date == datetime.date(2024, 1, 5)
+        # one request per page, as the pages were one record each
+        assert server.request_count == 3 + 2
+
+    def test_fake_server_payment_path(self):
+        server = self.serve({'mandates': [mandate_resource("MD1", "active", "2024-01-01T00:00:00.000Z")]})
+        with self.settings(GOCARDLESS_BASE_URL=server.url):
+            api = gocardless.get_gocardless_client()
+            flow = api.redirect_flows.create(params={
+                "description": "Membership", "session_token": "token",
+                "success_redirect_url": "http://testserver/join/step3"})
+            # the fake "payment page" sends the customer straight back
+            response = requests.get(flow.redirect_url, allow_redirects=False)
+            assert response.headers['Location'] == "http://testserver/join/step3?redirect_flow_id=" + flow.id
+            flow = api.redirect_flows.complete(flow.id, params={'session_token': "token"})
+            assert api.mandates.get(flow.links.mandate).status == "pending_submission"
+
+            # creating a payment again with the same idempotency key gets the same payment
+            mandate = GocardlessMandate(id="MD1", status="active")
+            payment = mandate.send_payment(api, 10, "key1")
+            assert payment.amount == 1000
+            assert mandate.send_payment(api, 10, "key1").id == payment.id
+            assert mandate.send_payment(api, 10, "key2").id != payment.id
+
+            assert api.mandates.cancel("MD1").status == "cancelled"
+            with self.assertRaises(gocardless_errors.InvalidStateError):
+                mandate.send_payment(api, 10, "key3")
+
+    def test_benchmark_webhooks(self):
+        out = StringIO()
+        with self.settings(GOCARDLESS_WEBHOOK_SECRET=SECRET):
+            call_command('benchmark_webhooks', events=100, batch_size=10, resources=10, resend=0.2,
+                         process=True, stdout=out, stderr=out)
+        assert "Received 100 events in 12 batches" in out.getvalue()
+        assert "Processed 100 events" in out.getvalue()
+        assert "rejected" not in out.getvalue()
+        # everything was rolled back
+        assert not GocardlessWebhookEvent.objects.exists() and not GocardlessMandate.objects.exists()
+
+    def test_fake_server(self):
+        server = self.serve({'mandates': [mandate_resource("MD1", "active", "2024-01-01T00:00:00.000Z"),
+                                          mandate_resource("MD2", "active", "2024-02-01T00:00:00.000Z")],
+                             'payments': []})
+        with self.settings(GOCARDLESS_BASE_URL=server.url):
+            api = gocardless.get_gocardless_client()
+            assert api.mandates.get("MD2").status == "active"
+            pages = gocardless.list_pages(api.mandates, {'created_at[gte]': "2024-01-15T00:00:00Z"})
+            assert [[mandate.id for mandate in page] for page in pages] == [["MD2"]]
+
+
+class FakePayments:
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.created = {}
+
+    def create(self, params, headers):
+        mandate_id = params['links']['mandate']
+        if mandate_id in self.fail:
+            self.fail.remove(mandate_id)
+            raise ValueError("mandate_is_inactive")
+        # the same idempotency key gets the same payment
+        key = headers['Idempotency-Key']
+        self.created.setdefault(key, "PM{}".format(len(self.created) + 1))
+        return SimpleNamespace(id=self.created[key], amount=params['amount'],
+                               currency=params['currency'], status='pending_submission',
+                               links=SimpleNamespace(creditor=None, payout=None))
+
+
+class RenewSupportersTestCase(TestCase):
+    def membership(self, email, expires_in_days, mandate_status=None):
+        user = User.objects.create_user(email)
+        membership = SupporterMembership.objects.create(
+            user=user, status='Approved', fee=15,
+            expired_at=timezone.now().date() + datetime.timedelta(days=expires_in_days))
+        if mandate_status:
+            GocardlessMandate.objects.create(id="MD" + email[0], status=mandate_status,
+                                             supporter_membership=membership)
+        return membership
+
+    def renew(self, payments, **options):
+        with mock.patch('main.models.supporter_renewal.get_gocardless_client',
+                        return_value=SimpleNamespace(payments=payments)):
+            call_command('renew_supporters', stdout=StringIO(), **options)
+
+    def test_renew_supporters(self):
+        due = self.membership("a@example.com", 5, 'active')
+        retried = self.membership("b@example.com", 5, 'active')
+        no_mandate = self.membership("c@example.com", -5)
+        self.membership("d@example.com", 60, 'active')  # not due yet
+        self.membership("e@example.com", -60, 'active')  # lapsed
+
+        payments = FakePayments(fail=["MDb"])
+        report_path = os.path.join(tempfile.mkdtemp(), 'report.json')
+        self.renew(payments, report=report_path)
+        assert SupporterRenewal.objects.count() == 3
+        renewal = SupporterRenewal.objects.get(membership=due)
+        assert renewal.status == SupporterRenewal.CREATED
+        assert renewal.payment.amount == 1500 and renewal.payment.idempotency_key == renewal.idempotency_key
+        waiting = SupporterRenewal.objects.get(membership=no_mandate)
+        assert waiting.status == SupporterRenewal.PENDING and waiting.last_error == "No active mandate"
+        failed = SupporterRenewal.objects.get(membership=retried)
+        assert failed.status == SupporterRenewal.PENDING and failed.attempts == 1
+
+        with open(report_path) as f:
+            report = json.load(f)
+        assert report['due'] == 3
+        assert report['counts'] == {'pending': 2, 'created': 1, 'skipped': 0, 'failed': 0}
+
+        # running again only retries the pending renewals, with the same idempotency keys
+        self.renew(payments)
+        assert SupporterRenewal.objects.get(membership=retried).status == SupporterRenewal.CREATED
+        assert list(payments.created) == [renewal.idempotency_key, failed.idempotency_key]
+        assert SupporterRenewal.objects.count() == 3
+        assert GocardlessPayment.objects.count() == 2
+
+        # once a mandate is set up the waiting renewal is paid
+        GocardlessMandate.objects.create(id="MDc", status='active', supporter_membership=no_mandate)
+        self.renew(payments)
+        assert SupporterRenewal.objects.get(membership=no_mandate).status == SupporterRenewal.CREATED
+
+    def test_lapsed_without_mandate(self):
+        membership = self.membership("a@example.com", -5)
+        self.renew(FakePayments())
+        renewal = SupporterRenewal.objects.get(membership=membership)
+        assert renewal.status == SupporterRenewal.PENDING
+
+        # still no mandate once the membership has lapsed, so it's given up on
+        with mock.patch('django.utils.timezone.now',
+                        return_value=timezone.now() + datetime.timedelta(days=30)):
+            self.renew(FakePayments())
+        renewal.refresh_from_db()
+        assert renewal.status == SupporterRenewal.SKIPPED
+
+    def test_payment_in_progress(self):
+        membership = self.membership("a@example.com", 5, 'active')
+        GocardlessPayment.objects.create(id="PM0", amount=1500, currency='GBP', status='submitted',
+                                         mandate_id="MDa")
+        payments = FakePayments()
+        self.renew(payments)
+        renewal = SupporterRenewal.objects.get(membership=membership)
+        assert renewal.status == SupporterRenewal.PENDING and not payments.created
+
+        # if that payment fails, the renewal goes ahead
+        GocardlessPayment.objects.filter(id="PM0").update(status='failed')
+        self.renew(payments)
+        renewal.refresh_from_db()
+        assert renewal.status == SupporterRenewal.CREATED
+        assert list(payments.created) == [renewal.idempotency_key]
+
+    def test_request_payment(self):
+        membership = self.membership("a@example.com", 5, 'active')
+        payments = FakePayments()
+        with mock.patch('main.models.supporter_renewal.get_gocardless_client',
+                        return_value=SimpleNamespace(payments=payments)):
+            renewal = membership.request_payment()
+            assert membership.request_payment() == renewal
+        assert renewal.status == SupporterRenewal.CREATED and renewal.period == membership.expired_at
+
+        # the scheduled run finds the membership already renewed
+        self.renew(payments)
+        assert SupporterRenewal.objects.count() == 1
+        assert list(payments.created) == [renewal.idempotency_key]
+        assert GocardlessPayment.objects.count() == 1
+
+    def test_request_payment_again(self):
+        membership = self.membership("a@example.com", 5, 'active')
+        payments = FakePayments(fail=["MDa"])
+        with mock.patch('main.models.supporter_renewal.get_gocardless_client',
+                        return_value=SimpleNamespace(payments=payments)):
+            # the supporter is told it didn't work
+            with self.assertRaises(RenewalNotCreated):
+                membership.request_payment()
+            renewal = membership.request_payment()
+            assert renewal.payment.id == "PM1"
+
+            # once the payment has failed, asking again makes a new one
+            GocardlessPayment.objects.filter(id="PM1").update(status='failed')
+            retried = membership.request_payment()
+        assert retried.id == renewal.id and retried.idempotency_key != renewal.idempotency_key
+        assert retried.status == SupporterRenewal.CREATED and retried.payment.id == "PM2"
+        assert GocardlessPayment.objects.count() == 2
@@ -0,0 +1,50 @@
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+from io import StringIO
+from main.models import Space
+import json
+import os
+import tempfile
+
+
+class ImportSpacesTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'spaces.json')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, records):
+        with open(self.path, 'w') as f:
+            json.dump(records, f, indent=4)
+
+    def test_import(self):
+        # the bundled data imports cleanly
+        call_command('import_spaces', stdout=StringIO())
+        count = Space.objects.count()
+        assert count > 0
+
+        # and importing it again changes nothing
+        out = StringIO()
+        call_command('import_spaces', update=True, stdout=out)
+        assert out.getvalue().splitlines()[-1] == "0 created, 0 updated, {} unchanged".format(count)
+
+    def test_upsert_and_dry_run(self):
+        Space.objects.create(name="Existing Space", town="Oldtown", lat=51, lng=0)
+        self.write([
+            {"name": "Existing Space", "town": "Newtown", "lat": 51, "lng": 0},
+            {"name": "New Space", "town": "Somewhere", "havePremises": "Yes", "lat": 52.1234567, "lng": -1},
+        ])
+
+        call_command('import_spaces', self.path, update=True, dry_run=True, stdout=StringIO())
+        assert Space.objects.count() == 1
+
+        call_command('import_spaces', self.path, stdout=StringIO())
+        assert Space.objects.get(name="Existing Space").town == "Oldtown"
+        assert Space.objects.get(name="New Space").have_premises
+
+        call_command('import_spaces', self.path, update=True, stdout=StringIO())
+        assert Space.objects.get(name="Existing Space").town == "Newtown"
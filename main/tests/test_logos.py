@@ -0,0 +1,87 @@
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, Client, override_settings
+from io import BytesIO, StringIO
+from main.logos import make_thumbnail, THUMBNAIL_SIZE
+from main.models import Space
+from PIL import Image
+import base64
+import tempfile
+
+# a 1x1 transparent png
+PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==")
+
+fetched = []
+
+
+def fake_fetcher(url):
+    fetched.append(url)
+    if url.endswith('missing.png'):
+        raise IOError("404")
+    return PNG, 'image/png'
+
+
+class LogoTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        fetched.clear()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.settings = override_settings(LOGO_ROOT=self.tmpdir.name,
+                                          LOGO_FETCHER='main.tests.test_logos.fake_fetcher')
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.tmpdir.cleanup()
+
+    def test_fetch_logos(self):
+        for name in ("One", "Two"):
+            Space.objects.create(name=name, lat=51, lng=0, status="Active",
+                                 logo_image_url="https://example.com/logo.png")
+        Space.objects.create(name="Three", lat=51, lng=0, status="Active",
+                             logo_image_url="https://example.com/missing.png")
+
+        before = Space.objects.get(name="One").changed_date
+        call_command('fetch_logos', stdout=StringIO())
+        # a shared logo is only fetched once
+        assert sorted(fetched) == ["https://example.com/logo.png", "https://example.com/missing.png"]
+
+        c = Client()
+        logos = {s['name']: s['logo_image_url'] for s in c.get("/spaces.json").json()['spaces']}
+        assert logos["One"] == logos["Two"]
+        assert logos["One"].startswith("/logos/")
+        # logos that couldn't be fetched are still linked directly
+        assert logos["Three"] == "https://example.com/missing.png"
+        # the new thumbnails are picked up by syncing spaces
+        assert Space.objects.get(name="One").changed_date > before
+
+        response = c.get(logos["One"])
+        assert b''.join(response.streaming_content) == PNG
+        assert response['Content-Type'] == 'image/png'
+        assert 'immutable' in response['Cache-Control']
+
+        # only new or changed logos are fetched next time
+        fetched.clear()
+        call_command('fetch_logos', stdout=StringIO())
+        assert fetched == ["https://example.com/missing.png"]
+
+        # changing the logo url stops the old thumbnail being used
+        space = Space.objects.get(name="One")
+        space.logo_image_url = "https://example.com/new.png"
+        space.save()
+        assert space.logo_url() == "https://example.com/new.png"
+
+    def test_make_thumbnail(self):
+        # small images are kept as they are
+        assert make_thumbnail(PNG, 'image/png') == (PNG, '.png')
+
+        output = BytesIO()
+        Image.new('RGB', (512, 256)).save(output, 'JPEG')
+        content, extension = make_thumbnail(output.getvalue(), 'image/jpeg; charset=binary')
+        assert extension == '.png'
+        assert Image.open(BytesIO(content)).size == (THUMBNAIL_SIZE, THUMBNAIL_SIZE // 2)
+
+        # anything that isn't an image is rejected
+        with self.assertRaises(OSError):
+            make_thumbnail(b'<html></html>', 'text/html')
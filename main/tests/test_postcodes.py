@@ -0,0 +1,54 @@
+from decimal import Decimal
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from io import StringIO
+from main.models import Space
+from main.postcodes import PostcodeIndex, geocode
+import os
+import tempfile
+
+POSTCODES_CSV = """pcd,pcds,doterm,lat,long
+EC1V9BP ,EC1V 9BP,,51.52721,-0.09008
+EH1  1YZ,EH1 1YZ,,55.952,-3.1883
+ZZ9  9ZZ,ZZ9 9ZZ,,99.999999,0.000000
+SW1A1AA ,SW1A 1AA,,51.501009,-0.141588
+"""
+
+
+class PostcodeTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.csv_path = os.path.join(self.tmpdir.name, 'postcodes.csv')
+        self.index_path = os.path.join(self.tmpdir.name, 'postcodes.idx')
+        with open(self.csv_path, 'w') as f:
+            f.write(POSTCODES_CSV)
+        call_command('build_postcode_index', self.csv_path, output=self.index_path, stdout=StringIO())
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_lookup(self):
+        index = PostcodeIndex.load(self.index_path)
+        # postcodes without a location are left out
+        assert len(index) == 3
+        assert index.lookup("ec1v 9bp") == (51.52721, -0.09008)
+        assert index.lookup("SW1A1AA") == (51.50101, -0.14159)
+        assert index.lookup("SW1A 1AB") is None
+        assert index.lookup("ZZ9 9ZZ") is None
+        assert index.lookup("not a postcode") is None
+
+    def test_space_save_and_bulk_geocode(self):
+        with override_settings(POSTCODE_INDEX_PATH=self.index_path):
+            assert geocode("EH1 1YZ") == (55.952, -3.1883)
+
+            # a new space without a location is placed at its postcode
+            space = Space.objects.create(name="Edinburgh Hackspace", postcode="EH1 1YZ", lat=0, lng=0)
+            assert space.lat == Decimal("55.952")
+
+            # spaces already stuck at 0,0 are fixed up in bulk
+            Space.objects.bulk_create([Space(name="Old Hackspace", postcode="EC1V 9BP", lat=0, lng=0)])
+            call_command('geocode_spaces', stdout=StringIO())
+            space = Space.objects.get(name="Old Hackspace")
+            assert (space.lat, space.lng) == (Decimal("51.52721"), Decimal("-0.09008"))
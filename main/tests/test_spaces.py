@@ -0,0 +1,269 @@
+import json
+from django.core.cache import cache, caches
+from django.test import TestCase, Client, override_settings
+from main.models import Space
+from main.views import MAX_SEARCH_PAGE
+
+
+class SpaceDocumentTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.space = Space.objects.create(name="Test Hackspace", lat=51.5, lng=-0.1, status="Active")
+
+    def test_etag_and_not_modified(self):
+        c = Client()
+        response = c.get("/spaces.json")
+        assert response.status_code == 200
+        assert response.json()['spaces'][0]['name'] == "Test Hackspace"
+        assert response.has_header('Last-Modified')
+        etag = response['ETag']
+
+        response = c.get("/spaces.json", HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+
+    def test_save_invalidates(self):
+        c = Client()
+        etag = c.get("/spaces.geojson")['ETag']
+
+        self.space.name = "Renamed Hackspace"
+        self.space.save()
+
+        response = c.get("/spaces.geojson", HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        assert response.json()['features'][0]['properties']['name'] == "Renamed Hackspace"
+
+    def test_delete_invalidates(self):
+        c = Client()
+        etag = c.get("/spaces.json")['ETag']
+
+        self.space.delete()
+
+        response = c.get("/spaces.json", HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        assert response.json()['spaces'] == []
+
+
+class SpaceGeojsonTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        Space.objects.create(name="London Hackspace", lat=51.5, lng=-0.1, status="Active")
+        Space.objects.create(name="Edinburgh Hackspace", lat=55.9, lng=-3.2, status="Active")
+        Space.objects.create(name="Closed Hackspace", lat=52.5, lng=-1.9, status="Defunct")
+        Space.objects.create(name="Nowhere Hackspace", lat=0, lng=0, status="Active")
+
+    def names(self, response):
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        return [f['properties']['name'] for f in json.loads(content)['features']]
+
+    def test_excludes_unlocated(self):
+        response = Client().get("/spaces.geojson")
+        assert self.names(response) == ["Closed Hackspace", "Edinburgh Hackspace", "London Hackspace"]
+
+    def test_filters(self):
+        c = Client()
+        response = c.get("/spaces.geojson", {'status': 'Active'})
+        assert self.names(response) == ["Edinburgh Hackspace", "London Hackspace"]
+
+        response = c.get("/spaces.geojson", {'status': 'Active,Defunct', 'bbox': '-2,51,0,53'})
+        assert self.names(response) == ["Closed Hackspace", "London Hackspace"]
+
+        response = c.get("/spaces.geojson", {'bbox': 'nonsense'})
+        assert response.status_code == 400
+
+        for bbox in ('nan,nan,nan,nan', '-inf,51,0,inf', '-2,nan,0,53'):
+            response = c.get("/spaces.geojson", {'bbox': bbox})
+            assert response.status_code == 400
+            response = c.get("/spaces/clusters", {'zoom': 5, 'bbox': bbox})
+            assert response.status_code == 400
+
+    def test_clusters(self):
+        c = Client()
+        # zoomed right out the two active spaces share a cell
+        features = c.get("/spaces/clusters", {'zoom': 0}).json()['features']
+        assert [f['properties']['count'] for f in features] == [2]
+
+        # zoomed in they are separate, and the bbox only includes london
+        features = c.get("/spaces/clusters", {'zoom': 10, 'bbox': '-1,51,0,52'}).json()['features']
+        assert len(features) == 1
+        assert features[0]['properties']['name'] == "London Hackspace"
+        assert features[0]['properties']['count'] == 1
+
+        # a cluster whose cell straddles the edge of the bbox is kept, even though its point
+        # is just outside it
+        features = c.get("/spaces/clusters", {'zoom': 10, 'bbox': '-0.09,51,0,52'}).json()['features']
+        assert [f['properties']['name'] for f in features] == ["London Hackspace"]
+        assert c.get("/spaces/clusters", {'zoom': 10, 'bbox': '0,51,1,52'}).json()['features'] == []
+
+    def test_vector_tiles(self):
+        c = Client()
+        response = c.get("/spaces/tiles/0/0/0.mvt")
+        assert response.status_code == 200
+        assert response['Content-Type'] == 'application/vnd.mapbox-vector-tile'
+        assert b'London Hackspace' in response.content
+        assert b'Nowhere Hackspace' not in response.content
+        # tiles are kept out of the default cache
+        key = 'spaces:tile:0/0/0:{}'.format(Space.objects.data_version())
+        assert caches['tiles'].get(key) == response.content and cache.get(key) is None
+
+        response = c.get("/spaces/tiles/0/0/0.mvt", HTTP_IF_NONE_MATCH=response['ETag'])
+        assert response.status_code == 304
+
+        # a tile in the pacific has nothing in it
+        assert c.get("/spaces/tiles/4/0/8.mvt").content == b''
+        assert c.get("/spaces/tiles/1/2/0.mvt").status_code == 404
+
+    def test_near(self):
+        c = Client()
+        # from oxford, london is nearer than edinburgh and closed/unlocated spaces are ignored
+        features = c.get("/spaces/near", {'lat': 51.75, 'lng': -1.26, 'k': 5}).json()['features']
+        assert [f['properties']['name'] for f in features] == ["London Hackspace", "Edinburgh Hackspace"]
+        assert 80 < features[0]['properties']['distance_km'] < 90
+
+        features = c.get("/spaces/near", {'lat': 56, 'lng': -3, 'k': 1}).json()['features']
+        assert [f['properties']['name'] for f in features] == ["Edinburgh Hackspace"]
+
+        assert c.get("/spaces/near", {'lat': 'x', 'lng': 0}).status_code == 400
+
+
+class SpaceDirectoryTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        Space.objects.create(name="Leeds Hackspace", country="England", region="Yorkshire",
+                             lat=53.8, lng=-1.5, status="Active")
+        Space.objects.create(name="London Hackspace", country="England", region="London",
+                             lat=51.5, lng=-0.1, status="Active")
+        Space.objects.create(name="Closed Hackspace", country="Wales", region="Wales",
+                             lat=52.5, lng=-3.9, status="Defunct")
+
+    def test_directory(self):
+        directory = Space.objects.directory()
+        assert directory['active']['count'] == 2
+        england = directory['active']['countries'][0]
+        assert [r['name'] for r in england['regions']] == ["London", "Yorkshire"]
+        assert directory['inactive']['countries'][0]['regions'][0]['spaces'][0]['name'] == "Closed Hackspace"
+
+    def test_index_is_cached(self):
+        c = Client()
+        assert b"Leeds Hackspace" in c.get("/").content
+
+        # once rendered, the directory comes straight from the cache
+        with self.assertNumQueries(0):
+            c.get("/")
+
+        Space.objects.create(name="York Hackspace", country="England", region="Yorkshire",
+                             lat=53.9, lng=-1.1, status="Starting")
+        assert b"York Hackspace" in c.get("/").content
+
+
+@override_settings(SPACE_SYNC_SETTLE_SECONDS=0)
+class SpaceChangesTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        for name in ("First Hackspace", "Second Hackspace", "Third Hackspace"):
+            Space.objects.create(name=name, lat=51.5, lng=-0.1, status="Active")
+
+    def test_changes(self):
+        c = Client()
+        response = c.get("/api/spaces/changes", {'limit': 2}).json()
+        names = [change['space']['name'] for change in response['changes']]
+        assert names == ["First Hackspace", "Second Hackspace"]
+        assert response['more']
+
+        response = c.get("/api/spaces/changes", {'since': response['cursor']}).json()
+        assert [change['space']['name'] for change in response['changes']] == ["Third Hackspace"]
+        assert not response['more']
+        cursor = response['cursor']
+
+        # nothing new, so the same cursor comes back
+        assert c.get("/api/spaces/changes", {'since': cursor}).json() == {
+            'changes': [], 'cursor': cursor, 'more': False}
+
+        space = Space.objects.get(name="First Hackspace")
+        space_id = space.id
+        space.delete()
+        space = Space.objects.get(name="Second Hackspace")
+        space.status = "Defunct"
+        space.save()
+
+        changes = c.get("/api/spaces/changes", {'since': cursor}).json()['changes']
+        assert [(change['type'], change['id']) for change in changes] == [("delete", space_id),
+                                                                          ("update", space.id)]
+        assert changes[1]['space']['status'] == "Defunct"
+
+    def test_bad_cursor(self):
+        assert Client().get("/api/spaces/changes", {'since': "nonsense"}).status_code == 400
+
+
+class SpaceSearchTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        Space.objects.create(name="Leeds Hackspace", town="Leeds", region="Yorkshire",
+                             postcode="LS1 1EX", lat=53.8, lng=-1.5, status="Active")
+        Space.objects.create(name="Hackspace Manchester", town="Manchester", region="North West",
+                             postcode="M4 1HN", lat=53.5, lng=-2.2, status="Active")
+        Space.objects.bulk_create([Space(name="York Makerspace", town="York", region="Yorkshire",
+                                         postcode="YO1 7HH", lat=53.9, lng=-1.1, status="Starting")])
+
+    def search(self, q, **params):
+        return Client().get("/spaces/search", dict(params, q=q)).json()
+
+    def names(self, q):
+        return [space['name'] for space in self.search(q)['results']]
+
+    def test_search(self):
+        assert self.names("leeds") == ["Leeds Hackspace"]
+        # words are matched as prefixes, and all of them must match
+        assert self.names("manch hack") == ["Hackspace Manchester"]
+        assert sorted(self.names("yorks")) == ["Leeds Hackspace", "York Makerspace"]
+        # postcodes match with or without their space
+        assert self.names("ls11ex") == ["Leeds Hackspace"]
+        assert self.names("YO1 7HH") == ["York Makerspace"]
+        assert self.names("") == []
+        assert self.names("\"*'") == []
+
+    def test_index_follows_changes(self):
+        space = Space.objects.get(name="Leeds Hackspace")
+        space.name = "Leeds Makerspace"
+        space.save()
+        assert self.names("hackspace") == ["Hackspace Manchester"]
+        space.delete()
+        assert self.names("leeds") == []
+
+    def test_pages(self):
+        first, more = Space.objects.search("hackspace", page=1, per_page=1)
+        assert more
+        second, more = Space.objects.search("hackspace", page=2, per_page=1)
+        assert not more
+        assert sorted([first[0]['name'], second[0]['name']]) == ["Hackspace Manchester", "Leeds Hackspace"]
+        assert self.search("hackspace", page=2)['results'] == []
+        assert Client().get("/spaces/search", {'q': "hackspace", 'page': "x"}).status_code == 400
+        # a huge page doesn't overflow the offset
+        response = self.search("hackspace", page=10 ** 20)
+        assert response['results'] == [] and response['page'] == MAX_SEARCH_PAGE
+
+
+class SpaceAutocompleteTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        for name in ("Hackspace Manchester", "Leeds Hackspace", "Makerspace Malmö", "Manchester Makers"):
+            Space.objects.create(name=name, lat=53.5, lng=-2.2, status="Active")
+
+    def names(self, q):
+        return [space['name'] for space in Client().get("/spaces/autocomplete", {'q': q}).json()['results']]
+
+    def test_autocomplete(self):
+        # names starting with the prefix come before names with a later word starting with it
+        assert self.names("manc") == ["Manchester Makers", "Hackspace Manchester"]
+        assert self.names("HACK") == ["Hackspace Manchester", "Leeds Hackspace"]
+        assert self.names("malmo") == ["Makerspace Malmö"]
+        assert self.names("") == []
+
+        # the index is rebuilt when spaces change
+        Space.objects.create(name="Manchester Hackspace", lat=53.5, lng=-2.2, status="Active")
+        assert "Manchester Hackspace" in self.names("manc")
+
+    def test_signup_form(self):
+        response = Client().get("/signup")
+        assert response.status_code == 200
+        assert b"Leeds Hackspace" not in response.content
+        assert b'name="space"' in response.content
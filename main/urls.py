@@ -7,6 +7,7 @@ from django.urls import reverse_lazy
 
 urlpatterns = [
     re_path(r"^$", views.index, name="index"),
+    re_path(r"^api/spaces/changes$", views.space_changes, name="space_changes"),
     re_path(r"^edit-profile$", views.UserUpdate.as_view(), name="edit-profile"),
     re_path(
         r"^edit-space-profile$", views.SpaceUpdate.as_view(), name="edit-space-profile"
@@ -35,14 +36,25 @@ urlpatterns = [
         name="supporter-approval",
     ),
     re_path(r"^login$", views.Login.as_view(), name="login"),
+    re_path(r"^logos/(?P<filename>[0-9a-f]+\.[a-z]+)$", views.logo, name="logo"),
     re_path(r"^logout$", views.logout_view, name="logout"),
     re_path(r"^payment-history$", views.payment_history, name="payment-history"),
     re_path(r"^new-space$", views.new_space, name="new_space"),
+    re_path(r"^resources/search$", views.docs_search, name="docs_search"),
     re_path(r"^resources/(?P<path>.*)$", views.resources, name="resources"),
     re_path(r"^signup$", views.SignupView.as_view(), name="signup"),
     re_path(r"^supporters$", views.supporters, name="supporters"),
     re_path(r"^spaces.json$", views.spaces, name="spaces"),
     re_path(r"^spaces.geojson$", views.geojson, name="geojson"),
+    re_path(r"^spaces/clusters$", views.space_clusters, name="space_clusters"),
+    re_path(r"^spaces/near$", views.spaces_near, name="spaces_near"),
+    re_path(r"^spaces/search$", views.space_search, name="space_search"),
+    re_path(r"^spaces/autocomplete$", views.space_autocomplete, name="space_autocomplete"),
+    re_path(
+        r"^spaces/tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.mvt$",
+        views.space_tile,
+        name="space_tile",
+    ),
     re_path(r"^space_detail$", views.space_detail, name="space_detail"),
     re_path(
         r"^supporter-membership-payment$",
@@ -0,0 +1,9 @@
+# counts the queries made while it's installed with connection.execute_wrapper(). unlike
+# CaptureQueriesContext it doesn't keep the queries, so there's no limit on how many it counts
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
@@ -2,19 +2,29 @@ from django.shortcuts import render, redirect
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
 from django.views import View
-from django.http import JsonResponse, HttpResponse
+from django.http import (FileResponse, Http404, JsonResponse, HttpResponse, HttpResponseBadRequest,
+                         HttpResponseNotModified,
+                         StreamingHttpResponse)
 import json
 from django.contrib.auth.decorators import login_required
 from django.contrib.admin.views.decorators import staff_member_required
+from django.views.decorators.cache import cache_control
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
+from django.views.static import was_modified_since
+from django.utils.http import http_date
+from django.core.serializers.json import DjangoJSONEncoder
 from django.views.generic.edit import CreateView
-from .models import Space, SupporterMembership, GocardlessMandate, GocardlessPayment
+from .models import Space, SupporterMembership, GocardlessMandate, GocardlessWebhookEvent
 from .forms import CustomUserCreationForm, SupporterMembershipForm, NewSpaceForm
+from .logos import CONTENT_TYPES as LOGO_CONTENT_TYPES
+from .github import get_file, get_page, is_repo_path, raw_url, GithubUnavailable
+from .docs import is_mirrored, mirror_file, mirror_page, render_page, DOCS_REPOSITORIES
+from .docs_search import search_docs
+from .geo import parse_bbox, parse_statuses, cluster_in_bbox, MIN_ZOOM, MAX_ZOOM
 from django.contrib.auth.forms import PasswordResetForm
 from django.contrib.auth.mixins import LoginRequiredMixin, AccessMixin
 from django.utils.decorators import method_decorator
-import requests
-import markdown
 from urllib.parse import urljoin
 from main.models import User
 from dealer.git import git
@@ -23,8 +33,14 @@ from django.views.generic.edit import UpdateView
 from django.urls import reverse_lazy, reverse
 from django.core.mail import EmailMessage
 from django.template.loader import get_template
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from io import StringIO
 import logging
 import hmac
+import mimetypes
+import os
+import re
 import hashlib
 
 
@@ -38,11 +54,10 @@ def error(request):
 
 
 def index(request):
-    activeSpaces = Space.objects.active_spaces()
-    inactiveSpaces = Space.objects.inactive_spaces()
     return render(request, 'main/index.html', {
-        'activeSpaces': activeSpaces,
-        'inactiveSpaces': inactiveSpaces,
+        # the directory is only built if the cached fragment for this version is missing
+        'space_directory': Space.objects.directory,
+        'space_data_version': Space.objects.data_version(),
         'MAPBOX_ACCESS_TOKEN': getattr(settings, "MAPBOX_ACCESS_TOKEN", None)
     })
 
@@ -103,9 +118,111 @@ class SpaceUpdate(AccessMixin, UpdateView):
         return super(SpaceUpdate, self).dispatch(request, *args, **kwargs)
 
 
+# cached space documents, looked up at most once per request (the etag, last modified
+# and view functions all need the same document)
+def space_document(request, name):
+    documents = request.__dict__.setdefault('space_documents', {})
+    if name not in documents:
+        documents[name] = Space.objects.cached_document(name, SPACE_DOCUMENT_BUILDERS[name])
+    return documents[name]
+
+
+SPACE_DOCUMENT_BUILDERS = {
+    'spaces.json': lambda: json.dumps(Space.objects.as_json(), cls=DjangoJSONEncoder).encode('utf-8'),
+    'spaces.geojson': lambda: ''.join(Space.objects.iter_geojson()).encode('utf-8'),
+}
+
+
+# serve a cached space document, answering conditional requests with a 304
+def space_document_view(name):
+    @cache_control(public=True, no_cache=True)
+    @condition(etag_func=lambda request: space_document(request, name)['etag'],
+               last_modified_func=lambda request: space_document(request, name)['last_modified'])
+    def view(request):
+        return HttpResponse(space_document(request, name)['body'], content_type='application/json')
+    return view
+
+
 # return space info as json - used for rendering map on homepage
-def spaces(request):
-    return JsonResponse(Space.objects.as_json())
+spaces = space_document_view('spaces.json')
+
+
+# serve a space logo thumbnail - they're named by content hash, so never change
+def logo(request, filename):
+    path = os.path.join(settings.LOGO_ROOT, filename)
+    try:
+        content_type = LOGO_CONTENT_TYPES[os.path.splitext(filename)[1]]
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+    except (FileNotFoundError, KeyError):
+        raise Http404("No such logo")
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    # logos may be svg, so make sure nothing in them can run if opened directly
+    response['Content-Security-Policy'] = "default-src 'none'; style-src 'unsafe-inline'"
+    response['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+
+# how long browsers may cache files proxied from the resources/foundation repos
+RESOURCE_FILE_MAX_AGE = 60 * 60 * 24
+
+# a single byte range, e.g. bytes=0-1023, bytes=1024- or bytes=-500
+BYTE_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+# yield length bytes from f in chunks
+def read_range(f, length, chunk_size=64 * 1024):
+    with f:
+        while length > 0:
+            chunk = f.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+# serve a file from disk, supporting If-Modified-Since and single byte range requests
+def ranged_file_response(request, path):
+    stat = os.stat(path)
+    last_modified = http_date(stat.st_mtime)
+    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), stat.st_mtime):
+        return HttpResponseNotModified()
+
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    match = BYTE_RANGE_RE.match(request.META.get('HTTP_RANGE', '').replace(' ', ''))
+    # ignore the range if the file has changed since the client's copy
+    if request.META.get('HTTP_IF_RANGE', last_modified) != last_modified:
+        match = None
+    # a range ending before it starts is invalid, so (per RFC 7233) the header is ignored
+    if match and match.group(1) and match.group(2) and int(match.group(1)) > int(match.group(2)):
+        match = None
+
+    if match and (match.group(1) or match.group(2)):
+        size = stat.st_size
+        if match.group(1):
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        else:
+            start, end = max(0, size - int(match.group(2))), size - 1
+        if start >= size:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{}'.format(size)
+            return response
+        f = open(path, 'rb')
+        f.seek(start)
+        response = StreamingHttpResponse(read_range(f, end - start + 1), status=206,
+                                         content_type=content_type)
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+        response['Content-Length'] = end - start + 1
+    else:
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+
+    response['Accept-Ranges'] = 'bytes'
+    response['Last-Modified'] = last_modified
+    response['Cache-Control'] = 'public, max-age={}'.format(RESOURCE_FILE_MAX_AGE)
+    # files may be svg or html, so make sure nothing in them can run
+    response['Content-Security-Policy'] = "default-src 'none'; style-src 'unsafe-inline'; sandbox"
+    response['X-Content-Type-Options'] = 'nosniff'
+    return response
 
 
 def supporters(request):
@@ -120,10 +237,110 @@ def gitinfo(request):
     return render(request, 'main/gitinfo.html', context)
 
 
-# return space info as geojson
+# return space info as geojson - the full collection is cached, filtered requests
+# (?status=Active,Starting&bbox=min_lng,min_lat,max_lng,max_lat) are streamed
 def geojson(request):
-    geo = Space.objects.as_geojson()
-    return JsonResponse(geo)
+    if 'status' not in request.GET and 'bbox' not in request.GET:
+        return all_spaces_geojson(request)
+
+    try:
+        statuses = parse_statuses(request.GET.getlist('status'))
+        bbox = parse_bbox(request.GET['bbox']) if 'bbox' in request.GET else None
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    return StreamingHttpResponse(Space.objects.iter_geojson(statuses, bbox), content_type='application/json')
+
+
+all_spaces_geojson = space_document_view('spaces.geojson')
+
+
+# return map spaces clustered for a zoom level (?zoom=5&bbox=min_lng,min_lat,max_lng,max_lat)
+# as geojson - every feature has a count, single spaces also have the usual properties
+def space_clusters(request):
+    try:
+        zoom = max(MIN_ZOOM, min(MAX_ZOOM, int(request.GET.get('zoom', MIN_ZOOM))))
+        bbox = parse_bbox(request.GET['bbox']) if 'bbox' in request.GET else None
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    features = Space.objects.clusters(zoom)
+    if bbox:
+        features = [f for f in features if cluster_in_bbox(*f['geometry']['coordinates'], bbox, zoom)]
+
+    return JsonResponse({"type": "FeatureCollection", "features": features})
+
+
+MAX_NEAREST_SPACES = 50
+
+MAX_SPACE_CHANGES = 1000
+
+SEARCH_PAGE_SIZE = 20
+
+# later pages are clamped to this one, so the offset can't overflow the database
+MAX_SEARCH_PAGE = 500
+
+MAX_AUTOCOMPLETE_SPACES = 20
+
+
+# return the k nearest map spaces to a point (?lat=&lng=&k=) as geojson, with the
+# distance in km added to each feature's properties
+def spaces_near(request):
+    try:
+        lat = float(request.GET['lat'])
+        lng = float(request.GET['lng'])
+        k = max(1, min(MAX_NEAREST_SPACES, int(request.GET.get('k', 5))))
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest("lat and lng are required, and lat, lng and k must be numbers")
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return HttpResponseBadRequest("lat/lng is out of range")
+
+    features = []
+    for distance, feature in Space.objects.nearest(lng, lat, k):
+        features.append(dict(feature, properties=dict(feature['properties'], distance_km=round(distance, 2))))
+    return JsonResponse({"type": "FeatureCollection", "features": features})
+
+
+# search spaces by name, town, region or postcode (?q=leeds&page=1)
+def space_search(request):
+    try:
+        page = max(1, min(MAX_SEARCH_PAGE, int(request.GET.get('page', 1))))
+    except ValueError:
+        return HttpResponseBadRequest("page must be a number")
+    results, more = Space.objects.search(request.GET.get('q', ''), page, SEARCH_PAGE_SIZE)
+    return JsonResponse({'results': results, 'page': page, 'more': more})
+
+
+# suggest spaces for a typeahead (?q=manc&limit=10)
+def space_autocomplete(request):
+    try:
+        limit = max(1, min(MAX_AUTOCOMPLETE_SPACES, int(request.GET.get('limit', 10))))
+    except ValueError:
+        return HttpResponseBadRequest("limit must be a number")
+    return JsonResponse({'results': Space.objects.autocomplete(request.GET.get('q', ''), limit)})
+
+
+# return spaces changed or deleted since a cursor (?since=<cursor>&limit=100), so mirrors
+# can keep up to date without downloading everything. pass the returned cursor as since
+# next time - without one, every space is returned (a page at a time)
+def space_changes(request):
+    try:
+        limit = max(1, min(MAX_SPACE_CHANGES, int(request.GET.get('limit', 100))))
+        changes, cursor, more = Space.objects.changes_since(request.GET.get('since') or None, limit)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    return JsonResponse({'changes': changes, 'cursor': cursor, 'more': more})
+
+
+# return a mapbox vector tile of spaces - tiles only change with the space data,
+# so the data version makes a good etag
+@cache_control(public=True, no_cache=True)
+@condition(etag_func=lambda request, z, x, y: Space.objects.data_version())
+def space_tile(request, z, x, y):
+    z, x, y = int(z), int(x), int(y)
+    if z > MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        raise Http404("No such tile")
+    return HttpResponse(Space.objects.vector_tile(z, x, y), content_type='application/vnd.mapbox-vector-tile')
 
 
 @staff_member_required(login_url='/login')
@@ -131,41 +348,16 @@ def space_detail(request):
     return render(request, 'main/space_detail.html', {'spaces': Space.objects.all()})
 
 
-def valueOrBlank(obj, attr, d):
-    if attr in obj:
-        return obj[attr]
-    else:
-        return d
-
-
+# import any new spaces from static/data.json - for big files use the import_spaces
+# management command instead, which doesn't tie up a web worker
 @staff_member_required(login_url='/login')
 def import_spaces(request):
-    json_data = open('static/data.json')
-    data = json.load(json_data)
-
-    for s in data:
-
-        # see if record already exists
-        q = Space.objects.filter(name=s['name'])
-        if len(q) == 0:
-            srecord = Space(
-                name=valueOrBlank(s, 'name', ''),
-                town=valueOrBlank(s, 'town', ''),
-                country=valueOrBlank(s, 'country', ''),
-                region=valueOrBlank(s, 'region', ''),
-                have_premises=valueOrBlank(s, 'havePremises', 'No') == 'Yes',
-                address_first_line=valueOrBlank(s, 'addressFirstLine', ''),
-                postcode=valueOrBlank(s, 'postcode', ''),
-                lat=valueOrBlank(s, 'lat', 0.0),
-                lng=valueOrBlank(s, 'lng', 0.0),
-                main_website_url=valueOrBlank(s, 'mainWebsiteUrl', ''),
-                logo_image_url=valueOrBlank(s, 'logoImageUrl', ''),
-                status=valueOrBlank(s, 'status', ''),
-                email=valueOrBlank(s, 'contactEmail', ''),
-            )
-            srecord.save()
-        # else
-            # existing record, do nothing for now
+    output = StringIO()
+    try:
+        call_command('import_spaces', stdout=output)
+        messages.info(request, output.getvalue().splitlines()[-1], extra_tags='alert-success')
+    except CommandError as e:
+        messages.error(request, "Error importing spaces: %s" % e, extra_tags='alert-danger')
     return redirect(reverse_lazy('space_detail'))
 
 
@@ -357,6 +549,7 @@ def logout_view(request):
 
 def new_space(request):
     form_class = NewSpaceForm
+    form = form_class()
 
     try:
         if request.method == 'POST':
@@ -384,7 +577,7 @@ def new_space(request):
         logger.exception("Error in new_space - exception")
 
     return render(request, 'main/new_space.html', {
-        'form': form_class,
+        'form': form,
         'MAPBOX_ACCESS_TOKEN': getattr(settings, "MAPBOX_ACCESS_TOKEN", None)
     })
 
@@ -478,6 +671,27 @@ def resources(request, path):
     return github_browser(request, settings, path)
 
 
+# search the pages in the resources and foundation repos (?q=insurance&page=1&repo=resources)
+def docs_search(request):
+    query = request.GET.get('q', '')
+    repo = request.GET.get('repo')
+    if repo not in DOCS_REPOSITORIES:
+        repo = None
+    try:
+        page = max(1, min(MAX_SEARCH_PAGE, int(request.GET.get('page', 1))))
+    except ValueError:
+        return HttpResponseBadRequest("page must be a number")
+    results, more = search_docs(query, page, SEARCH_PAGE_SIZE, repo)
+    context = {
+        'query': query,
+        'repo': repo,
+        'results': results,
+        'page': page,
+        'more': more,
+    }
+    return render(request, 'main/docs_search.html', context)
+
+
 def foundation(request, path):
     settings = {
         'repo': 'foundation',
@@ -487,12 +701,43 @@ def foundation(request, path):
     return github_browser(request, settings, path)
 
 
+# get the text of a page from the local mirror if there is one, otherwise from github.
+# returns None if there's no such page
+def load_page(repo, path):
+    if is_mirrored(repo):
+        return mirror_page(repo, path)
+    status, text = get_page(repo, path)
+    return text if status == 200 else None
+
+
+# serve a file (e.g. a pdf or image) from a repo, from the local mirror or a copy cached
+# from github. unless DOCS_PROXY_FILES is on, or if github is unavailable, the browser is
+# sent to github instead
+def resource_file(request, repo, path):
+    if not getattr(settings, "DOCS_PROXY_FILES", False):
+        return redirect(raw_url(repo, path))
+    if is_mirrored(repo):
+        local_path = mirror_file(repo, path)
+    else:
+        try:
+            local_path = get_file(repo, path)
+        except GithubUnavailable:
+            return redirect(raw_url(repo, path))
+    if local_path is None:
+        raise Http404("No such file")
+    return ranged_file_response(request, local_path)
+
+
 def github_browser(request, settings, path):
     origpath = path
 
     slugs = path.split('/')
     repo = settings['repo']
 
+    # nothing outside the repo - e.g. .. would lead to other repos on github
+    if not is_repo_path(path):
+        raise Http404("No such page")
+
     # need to redirect folder requests to a README.md file
     if '.' not in slugs[-1]:
         if path != '' and not path.endswith('/'):
@@ -500,35 +745,33 @@ def github_browser(request, settings, path):
         path += 'README.md'
         return redirect('/%s/%s' % (repo, path))
 
-    rawurl = urljoin('https://raw.githubusercontent.com/UKHackspaceFoundation/%s/master/' % repo, path)
+    rawurl = raw_url(repo, path)
     url = urljoin('https://github.com/UKHackspaceFoundation/%s/blob/master/' % repo, path)
 
     # if this isn't a markdown file?
     if not path.endswith('.md'):
-        # redirect to raw url  (e.g. for .pdf, etc)
-        return redirect(rawurl)
+        # serve it ourselves (e.g. for .pdf, etc) - or redirect to the raw url
+        return resource_file(request, repo, path)
 
-    r = requests.get(rawurl)
-
-    # build breadcrumbs
-    breadcrumbs = []
-    slugurl = ''
-    for slug in slugs:
-        if slug != '':
-            slugurl = '%s/%s' % (slugurl, slug)
-            breadcrumb = {'slug': slug, 'url': slugurl}
-            breadcrumbs.append(breadcrumb)
-
-    # TODO: deal with not found
+    try:
+        text = load_page(repo, path)
+    except GithubUnavailable:
+        messages.error(request, "Sorry, this page can't be loaded from GitHub right now")
+        return render(request, 'main/error.html', status=503)
+    if text is None:
+        raise Http404("No such page")
+
+    page = render_page(path, text)
     context = {
         'repo': settings['repo'],
         'origpath': origpath,
-        'breadcrumbs': breadcrumbs,
+        'breadcrumbs': page['breadcrumbs'],
         'path': path.split('/'),
         'rawurl': rawurl,
         'url': url,
         'imageBase': rawurl.rsplit('/', 1)[0] + '/',
-        'md': markdown.markdown(r.text, safe_mode='escape'),
+        'md': page['html'],
+        'toc': page['toc'],
         'title': settings['title'],
         'subtitle': settings['subtitle']
     }
@@ -545,31 +788,21 @@ class GocardlessWebhook(View):
         secret = bytes(getattr(settings, "GOCARDLESS_WEBHOOK_SECRET", None), 'utf-8')
         computed_signature = hmac.new(
             secret, request.body, hashlib.sha256).hexdigest()
-        provided_signature = request.META["HTTP_WEBHOOK_SIGNATURE"]
+        provided_signature = request.META.get("HTTP_WEBHOOK_SIGNATURE", "")
         # In flask, access the webhook signature header with
         # request.headers.get('Webhook-Signature')
         return hmac.compare_digest(provided_signature, computed_signature)
 
+    # events are only stored here, and processed later by `manage.py process_webhooks`, so
+    # GoCardless gets its answer straight away however slow their api is
     def post(self, request, *args, **kwargs):
-        if self.is_valid_signature(request):
-            response = HttpResponse()
-            payload = json.loads(request.body.decode('utf-8'))
+        if not self.is_valid_signature(request):
+            return HttpResponse(status=498)
+        try:
             # Each webhook may contain multiple events to handle, batched together.
-            for event in payload['events']:
-                self.process(event, response)
-            return response
-        else:
-            return HttpResponse(498)
-
-    def process(self, event, response):
-        msg = "Processing event id:{}, resource_type:{}\n".format(event['id'], event['resource_type'])
-        response.write(msg)
-        logger.info(msg)
-        if event['resource_type'] == 'mandates':
-            return GocardlessMandate.objects.process_mandate_from_webhook(event, response)
-        elif event['resource_type'] == 'payments':
-            return GocardlessPayment.objects.process_payment_from_webhook(event, response)
-        else:
-            response.write("Don't know how to process an event with resource_type {}\n".format(
-                event['resource_type']))
-            return response
+            events = json.loads(request.body.decode('utf-8'))['events']
+            GocardlessWebhookEvent.objects.receive(events)
+        except (ValueError, KeyError, TypeError):
+            return HttpResponseBadRequest("Invalid webhook payload")
+        logger.info("Received %d GoCardless events", len(events))
+        return HttpResponse()
@@ -0,0 +1,54 @@
+// suggest spaces as you type into a SpaceAutocompleteWidget, storing the id of the
+// chosen space in its hidden input
+$(function () {
+    $('.space-autocomplete').each(function () {
+        var container = $(this);
+        var hidden = container.find('input[type=hidden]');
+        var input = container.find('input[type=text]');
+        var menu = container.find('.dropdown-menu');
+        var request = null;
+        var timer = null;
+
+        function choose(space) {
+            hidden.val(space ? space.id : '');
+            input.val(space ? space.name : '');
+            container.removeClass('open');
+        }
+
+        function suggest() {
+            var q = input.val();
+            if (request) {
+                request.abort();
+            }
+            if (!$.trim(q)) {
+                container.removeClass('open');
+                return;
+            }
+            request = $.getJSON(container.data('url'), {q: q}, function (data) {
+                menu.empty();
+                $.each(data.results, function (i, space) {
+                    var item = $('<a href="#">').text(space.name);
+                    if (space.town) {
+                        item.append($('<small class="text-muted">').text(' ' + space.town));
+                    }
+                    item.on('mousedown', function (e) {
+                        e.preventDefault();
+                        choose(space);
+                    });
+                    menu.append($('<li>').append(item));
+                });
+                container.toggleClass('open', data.results.length > 0);
+            });
+        }
+
+        input.on('input', function () {
+            // typing un-chooses the space until a suggestion is picked again
+            hidden.val('');
+            clearTimeout(timer);
+            timer = setTimeout(suggest, 150);
+        });
+        input.on('blur', function () {
+            container.removeClass('open');
+        });
+    });
+});